@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class LibraryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'library'
+
+    def ready(self):
+        import library.signals
+        import library_system.checks
+
+        if settings.RECOMMENDER_PRELOAD:
+            from .recommender.registry import get_registry
+            try:
+                get_registry().get()
+            except FileNotFoundError:
+                pass
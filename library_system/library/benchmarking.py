@@ -0,0 +1,10 @@
+"""Helpers shared by the benchmark_api and benchmark_pool commands."""
+import math
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)
+    return round(sorted_values[rank], 3)
@@ -0,0 +1,156 @@
+import ast
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from django.db import transaction
+from .models import Author, Book, Genre
+from .signals import books_changed
+
+# Placeholders for columns the catalogue CSV doesn't have
+DEFAULT_DATE_OF_BIRTH = '1900-01-01'
+DEFAULT_DESCRIPTION = 'Description not available'
+DEFAULT_QUANTITY = 10
+
+
+def iter_csv_chunks(path, chunk_size, start_row=0, limit=None):
+    """
+    Stream the catalogue CSV as lists of row dicts, ``chunk_size`` rows at a time.
+
+    Only one chunk is held in memory. ``start_row`` skips data rows already
+    imported, ``limit`` caps the total rows read from ``start_row`` on.
+    """
+    if limit is not None and limit <= 0:
+        return
+    reader = pd.read_csv(
+        path,
+        dtype={'isbn': str},
+        chunksize=chunk_size,
+        skiprows=range(1, start_row + 1),
+        nrows=limit,
+    )
+    with reader:
+        for chunk in reader:
+            yield chunk.to_dict('records')
+
+
+def parse_chunks(chunks, workers=0):
+    """
+    Parse chunks of rows, yielding ``(records, errors, row_count)`` in input order.
+
+    With ``workers`` > 0 parsing runs in a process pool while the caller
+    writes, a few chunks ahead at most so memory stays bounded.
+    """
+    if not workers:
+        for rows in chunks:
+            yield (*parse_rows(rows), len(rows))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for rows in chunks:
+            pending.append((executor.submit(parse_rows, rows), len(rows)))
+            if len(pending) >= workers * 2:
+                future, row_count = pending.popleft()
+                yield (*future.result(), row_count)
+        while pending:
+            future, row_count = pending.popleft()
+            yield (*future.result(), row_count)
+
+
+def parse_rows(rows):
+    """
+    Turn raw CSV rows (dicts) into book records.
+
+    Returns ``(records, errors)`` where errors are ``(title, message)`` pairs
+    for rows that could not be parsed.
+    """
+    records, errors = [], []
+    for row in rows:
+        try:
+            genres = ast.literal_eval(row['genres'])
+            # pandas reads an empty cell as NaN, not ''
+            isbn = '' if pd.isna(row['isbn']) else str(row['isbn']).strip()
+            if not isbn:
+                raise ValueError('missing isbn')
+            records.append({
+                # Truncate to the model field lengths
+                'title': row['title'][:255],
+                'isbn': isbn[:13],
+                'author': row['authors'][:100],
+                'genres': [name[:100] for name in genres],
+            })
+        except (KeyError, ValueError, SyntaxError, TypeError) as e:
+            errors.append((row.get('title'), e))
+    return records, errors
+
+
+def import_records(records):
+    """
+    Write one chunk of book records with a fixed number of queries.
+
+    Genres, authors and books are resolved with one ``IN`` query per model,
+    missing rows are inserted with ``bulk_create`` and the M2M through tables
+    are filled with one ``bulk_create`` each. Books are matched on ISBN, the
+    only unique key, and existing books keep their data and gain any new
+    genre or author links. Returns the number of books created.
+    """
+    # Last record wins when an ISBN repeats inside the chunk
+    records = list({record['isbn']: record for record in records}.values())
+    if not records:
+        return 0
+
+    with transaction.atomic():
+        genre_ids = get_or_create_ids(
+            Genre, 'name', {name for record in records for name in record['genres']},
+            lambda name: Genre(name=name),
+        )
+        author_ids = get_or_create_ids(
+            Author, 'full_name', {record['author'] for record in records},
+            lambda name: Author(full_name=name, date_of_birth=DEFAULT_DATE_OF_BIRTH),
+        )
+        by_isbn = {record['isbn']: record for record in records}
+        existing = set(Book.objects.filter(isbn__in=by_isbn).values_list('isbn', flat=True))
+        Book.objects.bulk_create(
+            [
+                Book(
+                    title=record['title'], description=DEFAULT_DESCRIPTION, isbn=isbn,
+                    quantity=DEFAULT_QUANTITY, available=DEFAULT_QUANTITY,
+                )
+                for isbn, record in by_isbn.items()
+                if isbn not in existing
+            ],
+            ignore_conflicts=True,
+        )
+        book_ids = dict(Book.objects.filter(isbn__in=by_isbn).values_list('isbn', 'id'))
+
+        Book.genres.through.objects.bulk_create(
+            [
+                Book.genres.through(book_id=book_ids[isbn], genre_id=genre_ids[name])
+                for isbn, record in by_isbn.items()
+                for name in set(record['genres'])
+            ],
+            ignore_conflicts=True,
+        )
+        Book.authors.through.objects.bulk_create(
+            [
+                Book.authors.through(book_id=book_ids[isbn], author_id=author_ids[record['author']])
+                for isbn, record in by_isbn.items()
+            ],
+            ignore_conflicts=True,
+        )
+
+        books_changed.send(sender=Book, book_ids=list(book_ids.values()))
+
+    return len(by_isbn) - len(existing)
+
+
+def get_or_create_ids(model, field, values, build):
+    """Map each value of ``field`` to a row id, inserting the missing rows in bulk."""
+    lookup = f'{field}__in'
+    ids = dict(model.objects.filter(**{lookup: values}).values_list(field, 'id'))
+    missing = values - ids.keys()
+    if missing:
+        model.objects.bulk_create([build(value) for value in missing], ignore_conflicts=True)
+        ids.update(model.objects.filter(**{lookup: missing}).values_list(field, 'id'))
+    return ids
@@ -0,0 +1,113 @@
+"""
+Copy accounting for borrows.
+
+``Book.quantity`` is the number of copies the library owns and
+``Book.available`` the number of them on the shelf. Checking a copy out
+decrements ``available`` with a conditional ``UPDATE ... WHERE available >= n``
+so concurrent borrows can never take it below zero, and returning a borrow
+flips ``Borrow.returned`` with a conditional update so the copy is put back
+exactly once. Changing ``quantity`` moves the difference on or off the shelf.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.lookups import GreaterThanOrEqual
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from .models import Book, Borrow
+from .response_cache import bump_inventory_version
+
+
+class NoCopiesAvailable(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'No copies of this book are available.'
+    default_code = 'no_copies_available'
+
+
+def take_copies(book_id, count=1):
+    adjust_copies({book_id: -count})
+
+
+def put_back_copies(book_id, count=1):
+    adjust_copies({book_id: count})
+
+
+@transaction.atomic
+def adjust_copies(deltas):
+    """
+    Apply ``{book_id: delta}`` changes, raising NoCopiesAvailable if any book would go negative.
+
+    The whole batch is one conditional ``UPDATE``, a book that would go
+    negative isn't matched and the batch is rolled back. The inventory
+    version is replaced once for the batch, not per book.
+    """
+    deltas = {book_id: delta for book_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    change = Case(*[When(pk=book_id, then=Value(delta)) for book_id, delta in deltas.items()], output_field=IntegerField())
+    updated = Book.objects.filter(GreaterThanOrEqual(F('available') + change, 0), pk__in=deltas).update(
+        available=F('available') + change,
+    )
+    if updated != len(deltas):
+        raise NoCopiesAvailable()
+    bump_inventory_version()
+
+
+def set_quantities(quantities):
+    """
+    Apply ``{book_id: quantity}`` total copy counts, keeping ``available`` in step.
+
+    Raises NoCopiesAvailable if a book would own fewer copies than are borrowed.
+    Call it inside the transaction that saves the new quantities.
+    """
+    current = dict(Book.objects.select_for_update().filter(pk__in=quantities).values_list('id', 'quantity'))
+    try:
+        adjust_copies({book_id: quantity - current[book_id] for book_id, quantity in quantities.items()})
+    except NoCopiesAvailable:
+        raise NoCopiesAvailable('Quantity is lower than the number of copies currently borrowed.')
+
+
+def copies_needed(borrows):
+    """Copies each book loses when ``borrows`` (unsaved, active or returned) are created."""
+    return Counter(borrow.book_id for borrow in borrows if borrow.book_id and not borrow.returned)
+
+
+@transaction.atomic
+def checkout(**fields):
+    """Create a borrow, taking a copy off the shelf unless it's already returned."""
+    borrow = Borrow(**fields)
+    if borrow.book_id and not borrow.returned:
+        take_copies(borrow.book_id)
+    borrow.save()
+    return borrow
+
+
+@transaction.atomic
+def set_returned(borrow, returned):
+    """
+    Flip ``borrow.returned`` and move the copy accordingly.
+
+    Returns False without touching inventory if another request already
+    made the same change.
+    """
+    if not Borrow.objects.filter(pk=borrow.pk, returned=not returned).update(returned=returned):
+        borrow.refresh_from_db(fields=['returned'])
+        return False
+    borrow.returned = returned
+    if borrow.book_id:
+        if returned:
+            put_back_copies(borrow.book_id)
+        else:
+            take_copies(borrow.book_id)
+    return True
+
+
+@transaction.atomic
+def delete_borrows(queryset):
+    """Delete borrows, putting copies of the ones still out back on the shelf."""
+    rows = list(queryset.select_for_update().values_list('id', 'book_id', 'returned'))
+    put_back = Counter(book_id for _, book_id, returned in rows if book_id and not returned)
+    Borrow.objects.filter(id__in=[row[0] for row in rows]).delete()
+    adjust_copies(put_back)
+    return len(rows)
@@ -0,0 +1,241 @@
+import json
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from library.benchmarking import percentile
+from library.models import Book, Borrow
+from library.seeding import seed_library
+
+BENCH_USERNAME_PREFIX = 'bench_user_'
+
+# (name, method, path) where path is formatted with the request number and a book id
+ENDPOINTS = [
+    ('token', 'POST', '/api/token/'),
+    ('books', 'GET', '/api/library/books/'),
+    ('books_page', 'GET', '/api/library/books/?page={page}'),
+    ('books_search', 'GET', '/api/library/books/?q=winter'),
+    ('book_detail', 'GET', '/api/library/books/{book_id}/'),
+    ('borrows', 'GET', '/api/library/borrows/'),
+    ('borrows_overdue', 'GET', '/api/library/borrows/overdue/'),
+    ('recommendations', 'GET', '/api/library/recommentations/'),
+    ('recommendations_async', 'GET', '/api/library/recommentations/async/'),
+]
+
+
+class InProcessTransport:
+    """Django test client, goes through the full middleware and URL stack and counts queries."""
+
+    def __init__(self):
+        # Server errors are reported as 500s like a real server would, not raised
+        self.client = Client(raise_request_exception=False)
+
+    def request(self, method, path, headers, body):
+        with ExitStack() as stack:
+            # Every alias, reads may be served by a replica
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+            if method == 'POST':
+                response = self.client.post(path, body, content_type='application/json', headers=headers)
+            else:
+                response = self.client.get(path, headers=headers)
+            # Streaming responses run their queries while being consumed
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, sum(len(queries) for queries in captured), content
+
+
+class HTTPTransport:
+    """Plain HTTP against a running server, query counts are not available."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, headers, body):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(
+            self.base_url + path, data=data, method=method,
+            headers={**headers, 'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, None, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, None, exc.read()
+
+
+class Command(BaseCommand):
+    help = (
+        'Hit the real API routes with concurrent clients and report throughput, p50/p95/p99 latency and '
+        'database queries per endpoint. Runs in-process through the Django test client by default, or '
+        'against a running server with --url. Save runs with --json and compare them with --compare.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+        parser.add_argument('--only', nargs='*', help='Endpoint names to run')
+        parser.add_argument('--seed', type=int, default=0, help='Seed this many books (and proportional users, borrows, likes) first')
+        parser.add_argument('--cold', action='store_true', help='Clear the cache before each endpoint')
+        parser.add_argument('--json', help='Write the results to this file')
+        parser.add_argument('--compare', help='Results file from an earlier run to compare against')
+        parser.add_argument(
+            '--create-user', action='store_true',
+            help='Required: create a temporary librarian with a random password, deleted when the run ends',
+        )
+
+    def handle(self, *args, **options):
+        # The run needs a librarian, never leave one with a known password in a real database
+        if not options['create_user']:
+            raise CommandError('The benchmark creates a temporary librarian account, pass --create-user to allow it.')
+        if not settings.DEBUG and not is_test_database():
+            raise CommandError('Refusing to create a librarian account outside DEBUG or a test database.')
+
+        if options['seed']:
+            books = options['seed']
+            seed_library(books=books, users=max(books // 10, 1), borrows=books * 5, likes=books * 2, log=self.stdout.write)
+
+        self.book_ids = list(Book.objects.order_by('id').values_list('id', flat=True)[:1000])
+        if not self.book_ids:
+            self.stderr.write('No books, run seed_library or pass --seed first')
+            return
+        self.prepare_user()
+        try:
+            self.benchmark(options)
+        finally:
+            self.user.delete()
+
+    def benchmark(self, options):
+        url = options['url']
+        make_transport = (lambda: HTTPTransport(url)) if url else InProcessTransport
+        status, _, body = make_transport().request('POST', '/api/token/', {}, self.credentials())
+        if status != 200:
+            self.stderr.write(f'Could not obtain a token ({status}): {body[:200]!r}')
+            return
+        self.headers = {'Authorization': f'Bearer {json.loads(body)["access"]}'}
+
+        self.stdout.write(
+            f'{Book.objects.count()} books, {Borrow.objects.count()} borrows, {options["requests"]} requests '
+            f'per endpoint, {options["concurrency"]} clients, {"HTTP " + url if url else "in-process"}\n'
+        )
+        results = {}
+        for name, method, path in ENDPOINTS:
+            if options['only'] and name not in options['only']:
+                continue
+            if options['cold']:
+                cache.clear()
+            results[name] = self.run_endpoint(make_transport, method, path, options['requests'], options['concurrency'])
+
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['results']
+        self.print_table(results, previous)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({
+                    'transport': 'http' if url else 'in-process',
+                    'vendor': connection.vendor,
+                    'books': Book.objects.count(),
+                    'requests': options['requests'],
+                    'concurrency': options['concurrency'],
+                    'results': results,
+                }, f, indent=2)
+            self.stdout.write(f'Results written to {options["json"]}')
+
+    def prepare_user(self):
+        self.password = secrets.token_urlsafe(24)
+        self.user = User.objects.create_user(BENCH_USERNAME_PREFIX + secrets.token_hex(4), password=self.password)
+        # Librarian so the borrow routes are allowed, with likes so recommendations have input
+        self.user.profile.type = 'LIBRARIAN'
+        self.user.profile.save()
+        self.user.profile.liked_books.add(*self.book_ids[:5])
+
+    def credentials(self):
+        return {'username': self.user.username, 'password': self.password}
+
+    def run_endpoint(self, make_transport, method, path, total, concurrency):
+        counter = iter(range(total))
+        lock = threading.Lock()
+        samples = []
+
+        def worker():
+            transport = make_transport()
+            while True:
+                with lock:
+                    number = next(counter, None)
+                if number is None:
+                    return
+                formatted = path.format(page=number % 10 + 1, book_id=self.book_ids[number % len(self.book_ids)])
+                body = self.credentials() if method == 'POST' else None
+                started = time.perf_counter()
+                status, queries, _ = transport.request(method, formatted, self.headers, body)
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    samples.append((elapsed, status, queries))
+
+        def thread_worker():
+            try:
+                worker()
+            finally:
+                # The test client leaves connections open, pooled ones go back to their pool here
+                connections.close_all()
+
+        started = time.perf_counter()
+        if concurrency <= 1:
+            # Same thread and connection, so it also sees data inside a test transaction
+            worker()
+        else:
+            threads = [threading.Thread(target=thread_worker) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        wall = time.perf_counter() - started
+
+        latencies = sorted(sample[0] for sample in samples)
+        statuses = {}
+        for _, status, _ in samples:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        queries = [sample[2] for sample in samples if sample[2] is not None]
+        return {
+            'requests': len(samples),
+            'throughput_rps': round(len(samples) / wall, 1) if wall else None,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'statuses': statuses,
+            'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'queries_max': max(queries) if queries else None,
+        }
+
+    def print_table(self, results, previous):
+        header = f'{"endpoint":<24}{"req/s":>9}{"p50":>10}{"p95":>10}{"p99":>10}{"queries":>9}  statuses'
+        if previous:
+            header += '  (p95 before)'
+        self.stdout.write(header)
+        for name, result in results.items():
+            queries = '-' if result['queries_mean'] is None else f'{result["queries_mean"]:g}'
+            line = (
+                f'{name:<24}{result["throughput_rps"]:>9}{result["p50_ms"]:>8.1f}ms{result["p95_ms"]:>8.1f}ms'
+                f'{result["p99_ms"]:>8.1f}ms{queries:>9}  {result["statuses"]}'
+            )
+            before = previous.get(name)
+            if before and before['p95_ms']:
+                line += f'  ({before["p95_ms"]:.1f}ms, {(result["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100:+.0f}%)'
+            self.stdout.write(line)
+
+
+def is_test_database(alias='default'):
+    connection = connections[alias]
+    return connection.settings_dict['NAME'] == connection.creation._get_test_db_name()
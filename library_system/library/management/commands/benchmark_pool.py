@@ -0,0 +1,101 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.utils import ConnectionHandler
+from library.benchmarking import percentile
+from library_system.db.pool import close_pools
+
+QUERY = 'SELECT COUNT(*) FROM library_book'
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate requests from concurrent threads against the configured database, each opening a '
+        'connection, running one query and closing it as Django does at the end of a request. Runs '
+        'once through the connection pool and once with plain connections, and reports latency and '
+        'pool checkouts, waits and connections opened. Works on PostgreSQL and on the SQLite stand-in.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--requests', type=int, default=100, help='Requests per thread')
+        parser.add_argument('--max-size', type=int, help='Pool size, defaults to the configured one')
+        parser.add_argument('--query', default=QUERY)
+
+    def handle(self, *args, **options):
+        settings_dict = connections[options['database']].settings_dict
+        engine = settings_dict['ENGINE'].rsplit('.', 1)[1]
+        pool = {**settings_dict.get('POOL', {})}
+        if options['max_size']:
+            pool['MAX_SIZE'] = options['max_size']
+        # A ConnectionHandler needs a default, it's never connected
+        handler = ConnectionHandler({
+            'default': {},
+            'pooled': {**settings_dict, 'ENGINE': f'library_system.db.{engine}', 'CONN_MAX_AGE': 0, 'POOL': pool},
+            'direct': {**settings_dict, 'ENGINE': f'django.db.backends.{engine}', 'CONN_MAX_AGE': 0},
+        })
+        self.stdout.write(
+            f'{options["threads"]} threads x {options["requests"]} requests on {engine}, '
+            f'pool of {pool.get("MAX_SIZE", "default")}'
+        )
+        try:
+            for alias in ('pooled', 'direct'):
+                result = self.run(handler, alias, options['threads'], options['requests'], options['query'])
+                self.stdout.write(
+                    f'{alias:<8}{result["throughput_rps"]:>9} req/s  p50 {result["p50_ms"]:.2f}ms  '
+                    f'p95 {result["p95_ms"]:.2f}ms  p99 {result["p99_ms"]:.2f}ms  errors {result["errors"]}'
+                )
+            stats = handler['pooled'].pool.stats
+            self.stdout.write(
+                f'pool: {stats.checkouts} checkouts, {stats.opened} connections opened, {stats.waits} waits '
+                f'({stats.wait_seconds.sum * 1000:.0f}ms total), {stats.timeouts} timeouts, '
+                f'{stats.failed_checks} failed health checks'
+            )
+        finally:
+            close_pools('pooled')
+
+    def run(self, handler, alias, threads, requests, query):
+        lock = threading.Lock()
+        latencies = []
+        errors = []
+
+        def worker():
+            connection = handler[alias]
+            try:
+                for _ in range(requests):
+                    started = time.perf_counter()
+                    try:
+                        with connection.cursor() as cursor:
+                            cursor.execute(query)
+                            cursor.fetchall()
+                    except Exception as exc:
+                        with lock:
+                            errors.append(exc)
+                    finally:
+                        connection.close()
+                    with lock:
+                        latencies.append((time.perf_counter() - started) * 1000)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        wall = time.perf_counter() - started
+        if errors:
+            self.stderr.write(f'{alias}: {len(errors)} errors, first: {errors[0]}')
+
+        latencies.sort()
+        return {
+            'throughput_rps': round(len(latencies) / wall, 1) if wall else None,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'errors': len(errors),
+        }
@@ -0,0 +1,120 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from library.models import Book, Borrow
+from library.reports import overdue_borrows
+from library.seeding import seed_library
+from library.views import BookViewSet, BorrowViewSet, GenreViewSet
+
+# (name, viewset, action, query params) for the filters the API actually serves
+SCENARIOS = [
+    ('books', BookViewSet, 'list', {}),
+    ('books_title', BookViewSet, 'list', {'title': 'river'}),
+    ('books_isbn', BookViewSet, 'list', {'isbn': '9000000000042'}),
+    ('books_genre', BookViewSet, 'list', {'genres': 'Fantasy'}),
+    ('books_search', BookViewSet, 'list', {'q': 'winter garden'}),
+    ('genres_name', GenreViewSet, 'list', {'name': 'fic'}),
+    ('borrows', BorrowViewSet, 'list', {}),
+    ('borrows_book_title', BorrowViewSet, 'list', {'book_title': 'ocean'}),
+    ('borrows_user_full_name', BorrowViewSet, 'list', {'user_full_name': 'Anna Adams'}),
+    ('borrows_overdue', BorrowViewSet, 'overdue', {}),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the viewset querysets against the current database and print EXPLAIN plans and timings. '
+        'Save a run with --json before a schema change and pass it to --compare afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Seed this many books (and proportional borrows) first')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per query')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--only', nargs='*', help='Scenario names to run')
+        parser.add_argument('--analyze', action='store_true', help='Use EXPLAIN ANALYZE where the database supports it')
+        parser.add_argument('--no-explain', action='store_true')
+        parser.add_argument('--json', help='Write the timings to this file')
+        parser.add_argument('--compare', help='Timings file from an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            books = options['seed']
+            counts = seed_library(books=books, users=max(books // 10, 1), borrows=books * 5, likes=books * 2, log=self.stdout.write)
+            self.stdout.write(f'Seeded: {counts}')
+
+        self.stdout.write(
+            f'{Book.objects.count()} books, {Borrow.objects.count()} borrows on {connection.vendor}\n'
+        )
+
+        results = {}
+        for name, queryset in self.get_querysets(options['only']):
+            page = queryset[:options['page_size']]
+            if not options['no_explain']:
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                self.stdout.write(self.explain(page, options['analyze']) + '\n')
+            results[name] = {
+                'page': self.time(lambda: list(page.all()), options['repeat']),
+                'count': self.time(queryset.count, options['repeat']),
+            }
+
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['results']
+        self.print_table(results, previous)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({'vendor': connection.vendor, 'books': Book.objects.count(), 'results': results}, f, indent=2)
+            self.stdout.write(f'Timings written to {options["json"]}')
+
+    def get_querysets(self, only):
+        factory = APIRequestFactory()
+        for name, viewset_class, action, params in SCENARIOS:
+            if only and name not in only:
+                continue
+            view = viewset_class(action=action, format_kwarg=None, kwargs={})
+            view.request = Request(factory.get('/', params))
+            queryset = view.filter_queryset(view.get_queryset())
+            if action == 'overdue':
+                queryset = overdue_borrows(queryset=queryset)
+            yield name, queryset
+
+    def explain(self, queryset, analyze):
+        options = {'analyze': True} if analyze and connection.vendor == 'postgresql' else {}
+        return queryset.explain(**options)
+
+    def time(self, run, repeat):
+        run()  # warm up caches and connections
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            samples.append((time.perf_counter() - started) * 1000)
+            reset_queries()
+        samples.sort()
+        return {
+            'median_ms': round(statistics.median(samples), 3),
+            'p95_ms': round(samples[min(int(len(samples) * 0.95), len(samples) - 1)], 3),
+            'min_ms': round(samples[0], 3),
+        }
+
+    def print_table(self, results, previous):
+        header = f'{"query":<26}{"page median":>14}{"count median":>15}'
+        if previous:
+            header += f'{"page before":>14}{"change":>9}'
+        self.stdout.write(header)
+        for name, timing in results.items():
+            line = f'{name:<26}{timing["page"]["median_ms"]:>12.3f}ms{timing["count"]["median_ms"]:>13.3f}ms'
+            before = previous.get(name)
+            if before:
+                old, new = before['page']['median_ms'], timing['page']['median_ms']
+                change = f'{(new - old) / old * 100:+.0f}%' if old else 'n/a'
+                line += f'{old:>12.3f}ms{change:>9}'
+            self.stdout.write(line)
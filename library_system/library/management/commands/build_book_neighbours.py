@@ -0,0 +1,54 @@
+import time
+from itertools import chain
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from library.models import Book, Borrow
+from library.recommender.registry import get_scorer
+from library.recommender.similarity import build_neighbour_table, save_neighbour_table
+from library_system.db.replicas import reads_from_replica
+from users.models import Profile
+
+
+class Command(BaseCommand):
+    help = (
+        'Precompute the top-K similar books for every book from the recommender item factors '
+        'and co-occurrence in likes and borrows. Meant to run nightly, e.g. from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--k', type=int, default=20, help='Neighbours kept per book')
+        parser.add_argument('--alpha', type=float, default=0.7, help='Weight of factor similarity vs co-occurrence')
+        parser.add_argument('--block-size', type=int, default=256, help='Books scored per block, bounds memory')
+        parser.add_argument('--output', default=settings.RECOMMENDER_NEIGHBOURS_PATH)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with reads_from_replica():
+            book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+
+            item_factors = {}
+            try:
+                scorer = get_scorer()
+                item_factors = dict(zip(scorer.item_ids.tolist(), scorer.qi))
+            except FileNotFoundError:
+                self.stdout.write(self.style.WARNING('No recommender model found, using co-occurrence only'))
+
+            borrows = Borrow.objects.filter(user__isnull=False, book__isnull=False).values_list('user_id', 'book_id')
+            likes = Profile.liked_books.through.objects.values_list('profile__user_id', 'book_id')
+            interactions = chain(borrows.iterator(chunk_size=10000), likes.iterator(chunk_size=10000))
+
+            neighbours, scores = build_neighbour_table(
+                book_ids,
+                item_factors,
+                interactions,
+                k=options['k'],
+                alpha=options['alpha'],
+                block_size=options['block_size'],
+            )
+        save_neighbour_table(options['output'], book_ids, neighbours, scores)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Built neighbours for {len(book_ids)} books in {elapsed:.1f}s -> {options["output"]}'
+        ))
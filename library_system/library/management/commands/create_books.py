@@ -1,54 +1,68 @@
+import json
+import os
+import time
+
 from django.core.management.base import BaseCommand
-from library.models import Book, Author, Genre
-import pandas as pd
+from library.importers import import_records, iter_csv_chunks, parse_chunks
 
 class Command(BaseCommand):
-    help = 'Upload 1000 random books from random_books_with_genres.csv'
-
-    def handle(self, *args, **kwargs):
-        file_path = 'library/management/commands/random_books_with_genres.csv'
-        books_df = pd.read_csv(file_path)
-
-        # Limit to 1000 books
-        books_df = books_df.head(1000)
-
-        for _, row in books_df.iterrows():
-            try:
-                # Create genres if they don't exist
-                genres = []
-                for genre_name in eval(row['genres']):
-                    genre, created = Genre.objects.get_or_create(name=genre_name)
-                    genres.append(genre)
-
-                # Truncate the full_name if it's too long
-                full_name = row['authors'][:100]
-
-                # Create authors if they don't exist
-                author, created = Author.objects.get_or_create(
-                    full_name=full_name,
-                    defaults={
-                        'date_of_birth': '1900-01-01',  # Placeholder date, adjust as necessary
-                        'date_of_death': None
-                    }
-                )
-
-                # Truncate the title if it's too long
-                title = row['title'][:255]
-
-                # Create the book
-                book, created = Book.objects.get_or_create(
-                    title=title,
-                    defaults={
-                        'description': 'Description not available',  # Placeholder, adjust as necessary
-                        'isbn': row['isbn'],
-                        'quantity': 10  # Placeholder, adjust as necessary
-                    }
-                )
-
-                # Associate genres and author with the book
-                book.genres.set(genres)
-                book.authors.set([author])
-
-                self.stdout.write(self.style.SUCCESS(f'Successfully created book: {book.title}'))
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f'Error creating book: {row["title"]}. Error: {e}'))
+    help = 'Upload books from random_books_with_genres.csv (1000 by default), streaming the file in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default='library/management/commands/random_books_with_genres.csv')
+        parser.add_argument('--limit', type=int, default=1000, help='Maximum rows to import, 0 for all')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Rows written per transaction')
+        parser.add_argument('--workers', type=int, default=0, help='Processes parsing chunks ahead of the writer')
+        parser.add_argument('--checkpoint', help='File recording the last committed row, for resuming')
+        parser.add_argument('--resume', action='store_true', help='Continue after the row stored in --checkpoint')
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint']
+        start_row = 0
+        if options['resume'] and checkpoint:
+            start_row = self.read_checkpoint(checkpoint, options['file'])
+            if start_row:
+                self.stdout.write(f'Resuming after row {start_row}')
+
+        limit = options['limit'] or None
+        if limit is not None:
+            limit -= start_row
+
+        chunks = iter_csv_chunks(options['file'], options['chunk_size'], start_row=start_row, limit=limit)
+
+        started = time.perf_counter()
+        rows_done = start_row
+        created = 0
+        for records, errors, row_count in parse_chunks(chunks, workers=options['workers']):
+            for title, error in errors:
+                self.stdout.write(self.style.ERROR(f'Error creating book: {title}. Error: {error}'))
+
+            created += import_records(records)
+            rows_done += row_count
+            # Only record progress once the chunk's transaction has committed
+            if checkpoint:
+                self.write_checkpoint(checkpoint, options['file'], rows_done)
+            self.stdout.write(f'Imported {rows_done} rows')
+
+        elapsed = time.perf_counter() - started
+        rate = (rows_done - start_row) / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully created {created} books from {rows_done - start_row} rows in {elapsed:.1f}s ({rate:.0f} rows/sec)'
+        ))
+
+    def read_checkpoint(self, path, file):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        if data.get('file') != os.path.abspath(file):
+            self.stdout.write(self.style.WARNING(f'Checkpoint {path} is for another file, starting over'))
+            return 0
+        return data['rows']
+
+    def write_checkpoint(self, path, file, rows):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'file': os.path.abspath(file), 'rows': rows}, f)
+        os.replace(tmp_path, path)
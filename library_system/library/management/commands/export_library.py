@@ -0,0 +1,41 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from library.models import Book, Borrow
+from library.reports import EXPORT_FORMATS, stream_export
+
+QUERYSETS = {
+    'books': lambda: Book.objects.order_by('id'),
+    'borrows': lambda: Borrow.objects.order_by('id'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Stream the catalogue or the borrow history to a CSV or NDJSON file, optionally gzipped, in constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=list(QUERYSETS))
+        parser.add_argument('--format', dest='file_format', choices=list(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--output', default='-', help='File to write, - for stdout')
+        parser.add_argument('--chunk-size', type=int, default=settings.LIBRARY_EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        chunks = stream_export(
+            options['name'], QUERYSETS[options['name']](), options['file_format'], options['gzip'], options['chunk_size'],
+        )
+        if options['output'] == '-':
+            self.write(sys.stdout.buffer, chunks)
+            return
+        with open(options['output'], 'wb') as f:
+            written = self.write(f, chunks)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} bytes to {options["output"]}'))
+
+    def write(self, out, chunks):
+        written = 0
+        for chunk in chunks:
+            out.write(chunk)
+            written += len(chunk)
+        out.flush()
+        return written
@@ -0,0 +1,81 @@
+import resource
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from library.recommender.artifacts import save_artifact
+from library.recommender.training import InteractionMatrix, iter_interactions, train_svd
+from library_system.db.replicas import reads_from_replica
+
+
+class Command(BaseCommand):
+    help = 'Train the book recommender on borrows and liked books and write a new model artifact'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--factors', type=int, default=100)
+        parser.add_argument('--epochs', type=int, default=20)
+        parser.add_argument('--lr', type=float, default=0.005)
+        parser.add_argument('--reg', type=float, default=0.02)
+        parser.add_argument('--batch-size', type=int, default=4096, help='Ratings per SGD update')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Rows fetched from the database at a time')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=settings.RECOMMENDER_ARTIFACT_DIR)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        matrix = InteractionMatrix()
+        with reads_from_replica():
+            for chunk in iter_interactions(chunk_size=options['chunk_size']):
+                matrix.add(*chunk)
+        users, items, ratings = matrix.arrays()
+        loaded = time.perf_counter()
+
+        if not len(ratings):
+            self.stdout.write(self.style.WARNING('No borrows or liked books to train on'))
+            return
+
+        self.stdout.write(
+            f'Loaded {len(ratings)} interactions for {len(matrix.user_ids)} users '
+            f'and {len(matrix.item_ids)} books in {loaded - started:.1f}s'
+        )
+
+        arrays, global_mean = train_svd(
+            users, items, ratings,
+            n_users=len(matrix.user_ids),
+            n_items=len(matrix.item_ids),
+            n_factors=options['factors'],
+            n_epochs=options['epochs'],
+            lr=options['lr'],
+            reg=options['reg'],
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+            on_epoch=lambda epoch: self.stdout.write(f'Epoch {epoch + 1}/{options["epochs"]}'),
+        )
+        trained = time.perf_counter()
+
+        # ru_maxrss is reported in kilobytes on Linux
+        peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        trained_at = datetime.now(timezone.utc)
+        version = trained_at.strftime('%Y%m%d%H%M%S')
+        manifest = {
+            'trained_at': trained_at.isoformat(),
+            'algorithm': 'biased-mf-sgd',
+            'global_mean': global_mean,
+            'rating_scale': [1, 5],
+            'params': {key: options[key] for key in ('factors', 'epochs', 'lr', 'reg', 'batch_size', 'seed')},
+            'n_interactions': int(len(ratings)),
+            'load_seconds': round(loaded - started, 3),
+            'train_seconds': round(trained - loaded, 3),
+            'peak_memory_mb': round(peak_memory_mb, 1),
+        }
+        try:
+            directory = save_artifact(options['output'], version, arrays, matrix.user_ids, matrix.item_ids, manifest)
+        except ValueError as exc:
+            raise CommandError(f'Not saving model {version}: {exc}. Try a lower --lr.')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Trained model {version} in {trained - loaded:.1f}s '
+            f'(peak memory {peak_memory_mb:.0f} MB) -> {directory}'
+        ))
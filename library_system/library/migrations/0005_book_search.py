@@ -0,0 +1,81 @@
+# Search structures live outside the ORM, see library/search.py. The SQL is
+# copied here so the migration keeps working when that module changes.
+
+from django.db import migrations
+
+FTS_TABLE = 'library_book_fts'
+SEARCH_CONFIG = 'english'
+
+
+def _tables(apps):
+    Book = apps.get_model('library', 'Book')
+    Author = apps.get_model('library', 'Author')
+    return Book._meta.db_table, Author._meta.db_table, Book.authors.through._meta.db_table
+
+
+def _authors_sql(apps, aggregate):
+    book, author, book_authors = _tables(apps)
+    return f"""
+        (SELECT {aggregate}(a.full_name, ' ') FROM {author} a
+         JOIN {book_authors} ba ON ba.author_id = a.id
+         WHERE ba.book_id = {book}.id)
+    """
+
+
+def fill_search_structures(apps, schema_editor):
+    book, _, _ = _tables(apps)
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"""
+            UPDATE {book} SET search_vector =
+                setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({book}.title, '')), 'A') ||
+                setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({_authors_sql(apps, 'string_agg')}, '')), 'B') ||
+                setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({book}.description, '')), 'C')
+        """)
+    else:
+        schema_editor.execute(f"""
+            INSERT INTO {FTS_TABLE} (rowid, title, description, authors)
+            SELECT {book}.id, {book}.title, {book}.description, coalesce({_authors_sql(apps, 'group_concat')}, '')
+            FROM {book}
+        """)
+
+
+def create_search_structures(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute('ALTER TABLE library_book ADD COLUMN search_vector tsvector')
+        schema_editor.execute('CREATE INDEX library_book_search_vector_idx ON library_book USING gin (search_vector)')
+        # icontains compiles to UPPER(column::text) LIKE UPPER(%s), the index has to be on that expression
+        schema_editor.execute('CREATE INDEX library_book_title_trgm_idx ON library_book USING gin (UPPER(title::text) gin_trgm_ops)')
+        schema_editor.execute(
+            'CREATE INDEX library_author_full_name_trgm_idx ON library_author USING gin (UPPER(full_name::text) gin_trgm_ops)'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(title, description, authors, tokenize='unicode61 remove_diacritics 2')"
+        )
+    else:
+        return
+    fill_search_structures(apps, schema_editor)
+
+
+def drop_search_structures(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS library_author_full_name_trgm_idx')
+        schema_editor.execute('DROP INDEX IF EXISTS library_book_title_trgm_idx')
+        schema_editor.execute('DROP INDEX IF EXISTS library_book_search_vector_idx')
+        schema_editor.execute('ALTER TABLE library_book DROP COLUMN IF EXISTS search_vector')
+    elif vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_alter_book_quantity_alter_book_title'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_structures, drop_search_structures),
+    ]
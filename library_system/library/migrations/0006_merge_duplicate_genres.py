@@ -0,0 +1,39 @@
+# Genre.name becomes unique in 0007. Folding the duplicates is a migration of
+# its own: on PostgreSQL the deletes leave deferred constraint triggers
+# pending, and ALTER TABLE can't run in the same transaction.
+
+from django.db import migrations, models
+
+
+def merge_duplicate_genres(apps, schema_editor):
+    # Genre.name was not unique before, fold duplicates into the oldest row
+    Genre = apps.get_model('library', 'Genre')
+    BookGenre = apps.get_model('library', 'Book').genres.through
+    db = schema_editor.connection.alias
+
+    duplicates = (
+        Genre.objects.using(db).values('name')
+        .annotate(count=models.Count('id'), keep=models.Min('id'))
+        .filter(count__gt=1)
+    )
+    for row in duplicates:
+        others = list(
+            Genre.objects.using(db).filter(name=row['name']).exclude(id=row['keep']).values_list('id', flat=True)
+        )
+        book_ids = BookGenre.objects.using(db).filter(genre_id__in=others).values_list('book_id', flat=True)
+        BookGenre.objects.using(db).bulk_create(
+            [BookGenre(book_id=book_id, genre_id=row['keep']) for book_id in set(book_ids)],
+            ignore_conflicts=True,
+        )
+        Genre.objects.using(db).filter(id__in=others).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_book_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_genres, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Indexes matching the filters used by the library viewsets
+
+from django.db import migrations, models
+
+
+def create_user_name_indexes(apps, schema_editor):
+    # Borrows are filtered with user__first_name/last_name__icontains, only trigram indexes help there.
+    # icontains compiles to UPPER(column::text) LIKE UPPER(%s), the index has to be on that expression
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS auth_user_first_name_trgm_idx ON auth_user USING gin (UPPER(first_name::text) gin_trgm_ops)'
+    )
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS auth_user_last_name_trgm_idx ON auth_user USING gin (UPPER(last_name::text) gin_trgm_ops)'
+    )
+
+
+def drop_user_name_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS auth_user_first_name_trgm_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS auth_user_last_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('library', '0006_merge_duplicate_genres'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='genre',
+            name='name',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='borrow',
+            index=models.Index(condition=models.Q(('returned', False)), fields=['return_date'], name='borrow_active_return_date_idx'),
+        ),
+        migrations.RunPython(create_user_name_indexes, drop_user_name_indexes),
+    ]
@@ -0,0 +1,62 @@
+# Denormalised authors and genres, see library/read_model.py. The fill is
+# copied here with historical models so later changes there don't alter it.
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+AUTHOR_FIELDS = ['id', 'full_name', 'date_of_birth', 'date_of_death']
+GENRE_FIELDS = ['id', 'name']
+
+
+def _related(through, name, fields, book_ids, db):
+    rows = (
+        through.objects.using(db).filter(book_id__in=book_ids)
+        .order_by(f'{name}_id')
+        .values_list('book_id', *[f'{name}__{field}' for field in fields])
+    )
+    by_book = defaultdict(list)
+    for book_id, *values in rows:
+        by_book[book_id].append({
+            field: value.isoformat() if hasattr(value, 'isoformat') else value
+            for field, value in zip(fields, values)
+        })
+    return by_book
+
+
+def fill_related_data(apps, schema_editor):
+    Book = apps.get_model('library', 'Book')
+    db = schema_editor.connection.alias
+
+    # Keyset batches, no cursor stays open on the table being updated
+    last_id = 0
+    while True:
+        book_ids = list(
+            Book.objects.using(db).filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:BATCH_SIZE]
+        )
+        if not book_ids:
+            return
+        authors = _related(Book.authors.through, 'author', AUTHOR_FIELDS, book_ids, db)
+        genres = _related(Book.genres.through, 'genre', GENRE_FIELDS, book_ids, db)
+        Book.objects.using(db).bulk_update([
+            Book(id=book_id, related_data={'authors': authors.get(book_id, []), 'genres': genres.get(book_id, [])})
+            for book_id in book_ids
+        ], ['related_data'])
+        last_id = book_ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0007_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='related_data',
+            field=models.JSONField(default=dict, editable=False),
+        ),
+        migrations.RunPython(fill_related_data, migrations.RunPython.noop),
+    ]
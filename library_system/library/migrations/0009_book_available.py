@@ -0,0 +1,38 @@
+# Book.available counts the copies on the shelf, Book.quantity stays the total
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+
+def fill_available(apps, schema_editor):
+    Book = apps.get_model('library', 'Book')
+    Borrow = apps.get_model('library', 'Borrow')
+    db = schema_editor.connection.alias
+    borrowed = (
+        Borrow.objects.using(db).filter(book=OuterRef('pk'), returned=False)
+        .order_by().values('book').annotate(count=Count('id')).values('count')
+    )
+    Book.objects.using(db).update(available=Greatest(F('quantity') - Coalesce(Subquery(borrowed), 0), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_book_related_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='available',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_available, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='book',
+            name='available',
+            field=models.PositiveIntegerField(default=None, editable=False),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# The SQLite FTS5 table from 0005 as an unmanaged model, nothing changes in the database
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0009_book_available'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSearchEntry',
+            fields=[
+                ('book', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='library.book')),
+                ('match', models.TextField(db_column='library_book_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'library_book_fts',
+                'managed': False,
+            },
+        ),
+    ]
@@ -10,7 +10,8 @@ class Author(models.Model):
         return self.full_name
 
 class Genre(models.Model):
-    name = models.CharField(max_length=100)
+    # Unique so concurrent get-or-create by name cannot insert duplicates
+    name = models.CharField(max_length=100, unique=True)
 
     def __str__(self):
         return self.name
@@ -19,10 +20,34 @@ class Book(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField()
     isbn = models.CharField(max_length=13, unique=True)
+    # Copies the library owns, and how many of them aren't borrowed (library/inventory.py)
     quantity = models.PositiveIntegerField(default=1)
+    available = models.PositiveIntegerField(default=None, editable=False)
     genres = models.ManyToManyField(Genre, related_name='books')
     authors = models.ManyToManyField(Author, related_name='books')
+    # Denormalised authors and genres for single-row reads, maintained by library/read_model.py
+    related_data = models.JSONField(default=dict, editable=False)
 
+    def save(self, *args, **kwargs):
+        # New books start with every copy on the shelf, bulk_create callers set it themselves
+        if self.available is None:
+            self.available = self.quantity
+        super().save(*args, **kwargs)
+
+
+class BookSearchEntry(models.Model):
+    # A row of the FTS5 table migration 0005 creates on SQLite, written by library/search.py.
+    # Filtering on the column named after the table is an FTS5 MATCH, rank is its bm25 score
+    book = models.OneToOneField(
+        Book, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid', db_constraint=False,
+        related_name='search_entry',
+    )
+    match = models.TextField(db_column='library_book_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'library_book_fts'
 
 class Borrow(models.Model):
     book = models.ForeignKey(Book, on_delete=models.SET_NULL, null=True)
@@ -38,4 +63,8 @@ class Borrow(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['book', 'user', 'borrow_date'], name='unique_borrow')
         ]
+        indexes = [
+            # Only active borrows are looked up by due date (overdue lists, reminders)
+            models.Index(fields=['return_date'], condition=models.Q(returned=False), name='borrow_active_return_date_idx'),
+        ]
 
@@ -0,0 +1,44 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+class LibraryCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size = settings.LIBRARY_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.LIBRARY_MAX_PAGE_SIZE
+
+class LibraryPagination(PageNumberPagination):
+    """
+    Page number pagination, switching to keyset pagination on ``id`` when the
+    request passes ``?pagination=cursor`` or a ``cursor``. Deep cursor pages
+    seek by id instead of scanning past an OFFSET and skip the COUNT query.
+    """
+    page_size = settings.LIBRARY_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.LIBRARY_MAX_PAGE_SIZE
+    mode_query_param = 'pagination'
+
+    def __init__(self):
+        self.cursor_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        cursor_paginator = LibraryCursorPagination()
+        if request.query_params.get(self.mode_query_param) == 'cursor' or cursor_paginator.cursor_query_param in request.query_params:
+            self.cursor_paginator = cursor_paginator
+            return cursor_paginator.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_paginated_response_schema(schema)
+        return super().get_paginated_response_schema(schema)
+
+    def to_html(self):
+        if self.cursor_paginator:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
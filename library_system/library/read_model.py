@@ -0,0 +1,62 @@
+"""
+Denormalised author and genre data on ``Book.related_data``.
+
+The column holds the nested ``authors`` and ``genres`` exactly as
+``BookDetailSerializer`` renders them, so book reads are one row fetch
+instead of a query per relation. It's written with set-based queries here
+and kept in sync from signals (library/signals.py) on relation changes,
+author and genre renames and deletes, and ``books_changed`` after bulk
+writes. ``refresh_book_relations()`` with no ids rebuilds every book.
+"""
+from collections import defaultdict
+
+from .models import Author, Book, Genre
+
+BATCH_SIZE = 500
+
+
+def refresh_book_relations(book_ids=None, using='default'):
+    """Rebuild ``related_data`` for ``book_ids``, or for every book when None."""
+    if book_ids is not None:
+        book_ids = sorted(set(book_ids))
+        for start in range(0, len(book_ids), BATCH_SIZE):
+            _refresh_batch(book_ids[start:start + BATCH_SIZE], using)
+        return
+
+    # Walk ids in keyset batches, no cursor stays open on the table being updated
+    last_id = 0
+    while True:
+        batch = list(
+            Book.objects.using(using).filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+        _refresh_batch(batch, using)
+        last_id = batch[-1]
+
+
+def _refresh_batch(book_ids, using):
+    authors = _related(Book.authors.through, 'author', Author, ['id', 'full_name', 'date_of_birth', 'date_of_death'], book_ids, using)
+    genres = _related(Book.genres.through, 'genre', Genre, ['id', 'name'], book_ids, using)
+    books = [
+        Book(id=book_id, related_data={'authors': authors.get(book_id, []), 'genres': genres.get(book_id, [])})
+        for book_id in book_ids
+    ]
+    # Only touches related_data, the books themselves aren't loaded
+    Book.objects.using(using).bulk_update(books, ['related_data'])
+
+
+def _related(through, name, model, fields, book_ids, using):
+    rows = (
+        through.objects.using(using).filter(book_id__in=book_ids)
+        .order_by(f'{name}_id')
+        .values_list('book_id', *[f'{name}__{field}' for field in fields])
+    )
+    by_book = defaultdict(list)
+    for book_id, *values in rows:
+        by_book[book_id].append({
+            field: value.isoformat() if hasattr(value, 'isoformat') else value
+            for field, value in zip(fields, values)
+        })
+    return by_book
+
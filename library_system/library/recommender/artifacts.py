@@ -0,0 +1,71 @@
+"""
+Versioned, pickle-free model artifacts.
+
+Each version is a directory holding one ``.npy`` file per factor array, an
+``id_map.json`` with the raw user and book ids in inner-index order and a
+``manifest.json`` describing the run. A ``CURRENT`` file in the artifact
+root names the version to serve.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .scoring import Scorer
+
+ARRAYS = ('pu', 'qi', 'bu', 'bi')
+CURRENT = 'CURRENT'
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def save_artifact(root, version, arrays, user_ids, item_ids, manifest):
+    """Write a new artifact version and point CURRENT at it, refusing arrays with NaN or inf."""
+    for name in ARRAYS:
+        if not np.isfinite(arrays[name]).all():
+            raise ValueError(f'{name} has non-finite values, the training diverged')
+    directory = os.path.join(root, version)
+    tmp_directory = f'{directory}.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    for name in ARRAYS:
+        np.save(os.path.join(tmp_directory, f'{name}.npy'), arrays[name])
+    with open(os.path.join(tmp_directory, 'id_map.json'), 'w') as f:
+        json.dump({'users': list(user_ids), 'items': list(item_ids)}, f)
+    with open(os.path.join(tmp_directory, 'manifest.json'), 'w') as f:
+        json.dump(dict(manifest, version=version), f, indent=2)
+    os.replace(tmp_directory, directory)
+
+    tmp_current = os.path.join(root, f'{CURRENT}.tmp')
+    with open(tmp_current, 'w') as f:
+        f.write(version)
+    os.replace(tmp_current, os.path.join(root, CURRENT))
+    return directory
+
+
+def load_artifact(root, version, mmap=False):
+    """Load an artifact version as a Scorer, memory-mapping the arrays when asked."""
+    directory = os.path.join(root, version)
+    mmap_mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+    with open(os.path.join(directory, 'id_map.json')) as f:
+        id_map = json.load(f)
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    return Scorer(
+        arrays['pu'],
+        arrays['qi'],
+        arrays['bu'],
+        arrays['bi'],
+        manifest['global_mean'],
+        id_map['users'],
+        id_map['items'],
+    )
@@ -0,0 +1,151 @@
+import hashlib
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .registry import get_model_version
+
+GENERATION_KEY = 'recs:generation'
+# Most borrowed books, the last resort when recommendations time out
+POPULAR_KEY = 'recs:popular'
+
+
+class CacheStats:
+    """Process-local hit/miss counters for the recommendation cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else None,
+        }
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[settings.RECOMMENDER_CACHE_ALIAS]
+
+
+def get_generation_cache():
+    # Shared so a catalogue change in one worker reaches the entries of every worker
+    return caches[settings.SHARED_CACHE_ALIAS]
+
+
+def new_generation():
+    return uuid.uuid4().hex[:12]
+
+
+def get_generation():
+    """
+    The current catalogue generation, a random token.
+
+    A token that was evicted is replaced by a new one rather than a default,
+    so entries computed under an earlier generation can't become valid again.
+    """
+    cache = get_generation_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, new_generation(), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+async def aget_generation():
+    cache = get_generation_cache()
+    generation = await cache.aget(GENERATION_KEY)
+    if generation is None:
+        await cache.aadd(GENERATION_KEY, new_generation(), None)
+        generation = await cache.aget(GENERATION_KEY)
+    return generation
+
+
+def user_key(user_id):
+    return f'recs:user:{user_id}'
+
+
+def liked_books_hash(liked_book_ids):
+    return hashlib.sha1(','.join(map(str, liked_book_ids)).encode()).hexdigest()
+
+
+def get_or_compute(user_id, liked_book_ids, compute):
+    """
+    Return the cached recommendation pool for a user, calling ``compute`` on a miss.
+
+    An entry is only valid for the liked books it was computed from, the
+    catalogue generation and the model current at the time, so changed likes,
+    deleted books or a retrained model never serve stale results even if an
+    explicit invalidation was missed.
+    """
+    cache = get_cache()
+    key = user_key(user_id)
+    liked = liked_books_hash(liked_book_ids)
+    entry = cache.get(key)
+    generation = get_generation()
+    model = get_model_version()
+
+    if entry is not None and (entry['liked'], entry['generation'], entry.get('model')) == (liked, generation, model):
+        stats.record(hit=True)
+        return entry['recommendations']
+
+    stats.record(hit=False)
+    recommendations = compute()
+    entry = {'liked': liked, 'generation': generation, 'model': model, 'recommendations': recommendations}
+    cache.set(key, entry, settings.RECOMMENDER_CACHE_TIMEOUT)
+    return recommendations
+
+
+async def aget_or_compute(user_id, liked_book_ids, compute):
+    """Async ``get_or_compute``, ``compute`` is a coroutine function."""
+    cache = get_cache()
+    key = user_key(user_id)
+    liked = liked_books_hash(liked_book_ids)
+    entry = await cache.aget(key)
+    generation = await aget_generation()
+    # A stat or a read of the small CURRENT file, not worth a thread
+    model = get_model_version()
+
+    if entry is not None and (entry['liked'], entry['generation'], entry.get('model')) == (liked, generation, model):
+        stats.record(hit=True)
+        return entry['recommendations']
+
+    stats.record(hit=False)
+    recommendations = await compute()
+    entry = {'liked': liked, 'generation': generation, 'model': model, 'recommendations': recommendations}
+    await cache.aset(key, entry, settings.RECOMMENDER_CACHE_TIMEOUT)
+    return recommendations
+
+
+async def aget_stale(user_id):
+    """The last pool cached for a user even if likes or the catalogue changed since, or None."""
+    entry = await get_cache().aget(user_key(user_id))
+    return entry['recommendations'] if entry is not None else None
+
+
+def invalidate_user(user_id):
+    get_cache().delete(user_key(user_id))
+
+
+def invalidate_users(user_ids):
+    get_cache().delete_many([user_key(user_id) for user_id in user_ids])
+
+
+def invalidate_all():
+    """Start a new catalogue generation, every cached entry becomes stale."""
+    get_generation_cache().set(GENERATION_KEY, new_generation(), None)
@@ -0,0 +1,47 @@
+"""
+Helpers for serving recommendations from async views.
+
+Scoring is CPU bound numpy work, so it runs in a small dedicated thread
+pool: the event loop stays free and at most ``RECOMMENDER_ASYNC_WORKERS``
+scorings run at once however many requests arrive. Identical requests
+arriving while one is being computed share its result instead of queueing
+their own.
+"""
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+executor = ThreadPoolExecutor(max_workers=settings.RECOMMENDER_ASYNC_WORKERS, thread_name_prefix='recommender')
+
+# In-flight computations per event loop, a task can only be awaited from its own loop
+_in_flight = weakref.WeakKeyDictionary()
+
+
+async def run_in_executor(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def coalesce(key, coroutine_factory):
+    """
+    Return the running task for ``key``, starting ``coroutine_factory()`` if there is none.
+
+    The task is removed once it finishes, so later requests compute afresh.
+    Callers should await it through ``asyncio.shield`` when they may give up
+    early, so the shared computation keeps running for the others.
+    """
+    tasks = _in_flight.setdefault(asyncio.get_running_loop(), {})
+    task = tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(coroutine_factory())
+        tasks[key] = task
+
+        def forget(task):
+            tasks.pop(key, None)
+            if not task.cancelled():
+                # Retrieve the exception so it isn't logged as unhandled when every waiter timed out
+                task.exception()
+
+        task.add_done_callback(forget)
+    return task
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import pickle
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+from django.conf import settings
+
+from .artifacts import CURRENT, current_version, load_artifact
+from .scoring import Scorer
+
+
+class ModelRegistry:
+    """
+    Keeps one deserialised recommender model per worker process.
+
+    The model is loaded lazily on first use and reloaded whenever the file on
+    disk changes (mtime/size first, content hash to confirm), so retraining
+    only requires replacing the file.
+    """
+
+    def __init__(self, path, mmap=False):
+        self.path = str(path)
+        self.mmap = mmap
+        self.model = None
+        self.version = None
+        self.loaded_at = None
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        stat = self._file_stat()
+        if self.model is None or stat != self._stat:
+            with self._lock:
+                if self.model is None or stat != self._stat:
+                    self._load(stat)
+        return self.model
+
+    def info(self):
+        return {
+            'path': self.path,
+            'version': self.version,
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'mmap': self.mmap,
+        }
+
+    def _file_stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load(self, stat):
+        version = file_hash(self.path)
+        if self.model is not None and version == self.version:
+            # Touched but not changed, keep the model we already have
+            self._stat = stat
+            return
+
+        with open(self.path, 'rb') as f:
+            model = pickle.load(f)
+
+        if self.mmap:
+            share_factors(model, self.path, version)
+
+        self.model = model
+        self.version = version
+        self.loaded_at = datetime.now(timezone.utc)
+        self._stat = stat
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def share_factors(model, path, version):
+    """
+    Swap the model's factor matrices for read-only memory maps so every worker
+    on the host shares one physical copy through the page cache.
+    """
+    base, _ = os.path.splitext(path)
+    for name in ('pu', 'qi', 'bu', 'bi'):
+        array = getattr(model, name, None)
+        if not isinstance(array, np.ndarray):
+            continue
+        array_path = f'{base}.{version}.{name}.npy'
+        if not os.path.exists(array_path):
+            tmp_path = f'{array_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, array_path)
+        setattr(model, name, np.load(array_path, mmap_mode='r'))
+
+
+class ArtifactRegistry:
+    """
+    Serves the artifact version named by ``CURRENT`` as a ready-built Scorer.
+
+    Same lazy load and hot reload as ModelRegistry, but the version is the
+    artifact name so no hashing is needed, and arrays are memory-mapped
+    straight from their .npy files when ``mmap`` is set.
+    """
+
+    def __init__(self, root, mmap=False):
+        self.root = str(root)
+        self.mmap = mmap
+        self.scorer = None
+        self.version = None
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def is_available(self):
+        return os.path.exists(os.path.join(self.root, CURRENT))
+
+    def get(self):
+        version = current_version(self.root)
+        if version is None:
+            raise FileNotFoundError(f'No model artifact in {self.root}')
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.scorer = load_artifact(self.root, version, mmap=self.mmap)
+                    self.version = version
+                    self.loaded_at = datetime.now(timezone.utc)
+        return self.scorer
+
+    def info(self):
+        return {
+            'path': self.root,
+            'version': self.version,
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'mmap': self.mmap,
+        }
+
+
+_registries = {}
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Return the registry serving the current model.
+
+    Trained artifacts take precedence, the legacy pickle is used until the
+    first train_recommender run.
+    """
+    if not _registries:
+        with _registry_lock:
+            if not _registries:
+                _registries['artifact'] = ArtifactRegistry(settings.RECOMMENDER_ARTIFACT_DIR, mmap=settings.RECOMMENDER_MMAP)
+                _registries['pickle'] = ModelRegistry(settings.RECOMMENDER_MODEL_PATH, mmap=settings.RECOMMENDER_MMAP)
+    if _registries['artifact'].is_available():
+        return _registries['artifact']
+    return _registries['pickle']
+
+
+def get_model_version():
+    """
+    Identify the model ``get_scorer()`` serves without loading it.
+
+    The artifact version, or the pickle's mtime and size, None when there is
+    no model yet.
+    """
+    registry = get_registry()
+    if isinstance(registry, ArtifactRegistry):
+        return current_version(registry.root)
+    try:
+        return '{}-{}'.format(*registry._file_stat())
+    except FileNotFoundError:
+        return None
+
+
+_scorer = (None, None)
+_scorer_lock = threading.Lock()
+
+
+def get_scorer():
+    """Return the Scorer for the current model, rebuilt when the model reloads."""
+    global _scorer
+    registry = get_registry()
+    if isinstance(registry, ArtifactRegistry):
+        return registry.get()
+
+    model = registry.get()
+    version, scorer = _scorer
+    if version != registry.version:
+        with _scorer_lock:
+            version, scorer = _scorer
+            if version != registry.version:
+                scorer = Scorer.from_surprise(model)
+                _scorer = (registry.version, scorer)
+    return scorer
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class Scorer:
+    """
+    Scores the whole catalogue for a user with one matrix-vector product.
+
+    Uses the same formula as Surprise's SVD.estimate:
+    ``mean + bu[u] + bi[i] + qi[i] . pu[u]``, falling back to the item
+    baseline for users the model has not seen.
+    """
+
+    def __init__(self, pu, qi, bu, bi, global_mean, user_ids, item_ids):
+        self.pu = pu
+        self.qi = qi
+        self.bu = bu
+        self.bi = bi
+        self.global_mean = global_mean
+        self.item_ids = np.asarray(item_ids)
+        self.user_index = {raw_id: inner_id for inner_id, raw_id in enumerate(user_ids)}
+        self.item_index = {raw_id: inner_id for inner_id, raw_id in enumerate(item_ids)}
+
+    @classmethod
+    def from_surprise(cls, model):
+        trainset = model.trainset
+        user_ids = [normalise_id(trainset.to_raw_uid(i)) for i in range(trainset.n_users)]
+        item_ids = [normalise_id(trainset.to_raw_iid(i)) for i in range(trainset.n_items)]
+        if getattr(model, 'biased', True):
+            bu, bi, global_mean = model.bu, model.bi, trainset.global_mean
+        else:
+            bu, bi, global_mean = np.zeros(trainset.n_users), np.zeros(trainset.n_items), 0.0
+        return cls(model.pu, model.qi, bu, bi, global_mean, user_ids, item_ids)
+
+    def scores(self, user_id):
+        scores = self.global_mean + np.asarray(self.bi, dtype=np.float64)
+        inner_id = self.user_index.get(user_id)
+        if inner_id is not None:
+            scores += self.bu[inner_id] + self.qi @ self.pu[inner_id]
+        return scores
+
+    def top_k(self, user_id, k, exclude=()):
+        scores = self.scores(user_id)
+        excluded = np.zeros(len(scores), dtype=bool)
+        excluded[[self.item_index[book_id] for book_id in exclude if book_id in self.item_index]] = True
+        scores[excluded] = -np.inf
+
+        # Candidates left after the mask, repeated or unknown excluded ids don't count
+        k = min(k, len(scores) - int(excluded.sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self.item_ids[top].tolist()
+
+
+def normalise_id(raw_id):
+    # Surprise keeps raw ids as they were read, book and user ids are ints here
+    try:
+        return int(raw_id)
+    except (TypeError, ValueError):
+        return raw_id
@@ -0,0 +1,157 @@
+import os
+import threading
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+
+def build_neighbour_table(book_ids, item_factors, interactions, k, alpha=0.7, block_size=256):
+    """
+    Compute the top-k most similar books for every book in ``book_ids``.
+
+    Similarity blends cosine similarity of the model's item factors (weight
+    ``alpha``) with normalised co-occurrence of books in the same user's likes
+    and borrows. ``item_factors`` maps book id to factor vector, books without
+    one only get co-occurrence neighbours. ``interactions`` is an iterable of
+    ``(user_id, book_id)`` pairs.
+
+    Returns ``(neighbours, scores)`` arrays of shape ``(len(book_ids), k)``,
+    padded with -1 / 0 when a book has fewer than k neighbours.
+    """
+    book_ids = np.asarray(book_ids, dtype=np.int64)
+    n_books = len(book_ids)
+    position = {book_id: i for i, book_id in enumerate(book_ids.tolist())}
+    k = min(k, max(n_books - 1, 0))
+
+    factors = None
+    if item_factors:
+        n_factors = len(next(iter(item_factors.values())))
+        factors = np.zeros((n_books, n_factors), dtype=np.float32)
+        for book_id, vector in item_factors.items():
+            if book_id in position:
+                factors[position[book_id]] = vector
+        norms = np.linalg.norm(factors, axis=1, keepdims=True)
+        np.divide(factors, norms, out=factors, where=norms > 0)
+
+    cooccurrence = _cooccurrence_matrix(interactions, position, n_books)
+
+    neighbours = np.full((n_books, k), -1, dtype=np.int64)
+    scores = np.zeros((n_books, k), dtype=np.float32)
+    if k == 0:
+        return neighbours, scores
+
+    for start in range(0, n_books, block_size):
+        stop = min(start + block_size, n_books)
+        block = np.zeros((stop - start, n_books), dtype=np.float32)
+        if factors is not None:
+            block += alpha * (factors[start:stop] @ factors.T)
+        if cooccurrence is not None:
+            block += (1 - alpha) * cooccurrence[start:stop].toarray()
+        # A book is never its own neighbour
+        block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        keep = top_scores > 0
+        neighbours[start:stop] = np.where(keep, book_ids[top], -1)
+        scores[start:stop] = np.where(keep, top_scores, 0)
+
+    return neighbours, scores
+
+
+def _cooccurrence_matrix(interactions, position, n_books):
+    users = {}
+    rows, cols = [], []
+    for user_id, book_id in interactions:
+        column = position.get(book_id)
+        if column is None:
+            continue
+        rows.append(users.setdefault(user_id, len(users)))
+        cols.append(column)
+    if not rows:
+        return None
+
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(users), n_books),
+    )
+    # Count each user/book pair once even if borrowed several times
+    matrix.data[:] = 1
+    counts = (matrix.T @ matrix).tocsr()
+    counts.setdiag(0)
+    counts.eliminate_zeros()
+
+    # Cosine normalisation so popular books don't dominate every list
+    popularity = np.sqrt(np.asarray(matrix.sum(axis=0)).ravel())
+    popularity[popularity == 0] = 1
+    inverse = sparse.diags(1 / popularity)
+    return (inverse @ counts @ inverse).tocsr()
+
+
+def save_neighbour_table(path, book_ids, neighbours, scores):
+    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, book_ids=np.asarray(book_ids, dtype=np.int64), neighbours=neighbours, scores=scores)
+    # Replace atomically so running workers never read a half written file
+    os.replace(tmp_path, path)
+
+
+class NeighbourIndex:
+    """Precomputed nearest neighbours, looked up by binary search on book id."""
+
+    def __init__(self, book_ids, neighbours, scores):
+        self.book_ids = book_ids
+        self.neighbours = neighbours
+        self.scores = scores
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['book_ids'], data['neighbours'], data['scores'])
+
+    def neighbours_of(self, book_id):
+        i = np.searchsorted(self.book_ids, book_id)
+        if i == len(self.book_ids) or self.book_ids[i] != book_id:
+            return []
+        return [
+            (int(neighbour), float(score))
+            for neighbour, score in zip(self.neighbours[i], self.scores[i])
+            if neighbour != -1
+        ]
+
+    def recommend(self, book_ids, k, exclude=()):
+        """Merge the neighbour lists of ``book_ids``, summing scores of books that repeat."""
+        merged = defaultdict(float)
+        for book_id in book_ids:
+            for neighbour, score in self.neighbours_of(book_id):
+                if neighbour not in exclude:
+                    merged[neighbour] += score
+        return sorted(merged, key=merged.get, reverse=True)[:k]
+
+
+_index = (None, None)
+_index_lock = threading.Lock()
+
+
+def get_neighbour_index():
+    """Return the neighbour index, reloaded when the file is rebuilt, or None if it hasn't been built."""
+    global _index
+    path = settings.RECOMMENDER_NEIGHBOURS_PATH
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    loaded_key, index = _index
+    if loaded_key != key:
+        with _index_lock:
+            loaded_key, index = _index
+            if loaded_key != key:
+                index = NeighbourIndex.load(path)
+                _index = (key, index)
+    return index
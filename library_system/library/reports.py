@@ -0,0 +1,161 @@
+"""
+Reports and exports that can run on the full tables.
+
+Reports read rows in id-ordered batches (``WHERE id > last_id ORDER BY id
+LIMIT n``) instead of one huge result set or growing OFFSETs, so memory
+stays bounded by the batch size and every batch is a cheap index seek.
+Exports stream from ``QuerySet.iterator`` (a server-side cursor on
+PostgreSQL) and encode a chunk of rows at a time. Aggregates are computed
+by the database with ``values``/``annotate``.
+"""
+import csv
+import json
+import zlib
+from collections import defaultdict
+from datetime import date
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Min
+from .models import Book, Borrow
+
+OVERDUE_CSV_FIELDS = ['id', 'user_id', 'user__username', 'book_id', 'book__title', 'borrow_date', 'return_date']
+
+
+def overdue_borrows(today=None, queryset=None):
+    """Borrows still out after their return date, served by the partial index on active borrows."""
+    queryset = Borrow.objects.all() if queryset is None else queryset
+    return queryset.filter(returned=False, return_date__lt=today or date.today())
+
+
+def iter_batches(queryset, fields, batch_size=5000):
+    """Yield lists of ``values_list`` tuples of ``fields`` (which must start with id), walking the ids in order."""
+    queryset = queryset.values_list(*fields).order_by('id')
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+
+
+def overdue_by(field, today=None):
+    """Overdue count and oldest due date per ``'user'`` or ``'book'``, most overdue loans first."""
+    group = {
+        'user': ['user_id', 'user__username'],
+        'book': ['book_id', 'book__title'],
+    }[field]
+    return (
+        overdue_borrows(today).values(*group)
+        .annotate(overdue=Count('id'), oldest_return_date=Min('return_date'))
+        .order_by('-overdue', group[0])
+    )
+
+
+def write_overdue_csv(out, today=None, batch_size=5000):
+    """Write every overdue borrow as CSV to ``out``, one batch in memory at a time. Returns the row count."""
+    today = today or date.today()
+    writer = csv.writer(out)
+    writer.writerow(OVERDUE_CSV_FIELDS + ['days_overdue'])
+    return_date_index = OVERDUE_CSV_FIELDS.index('return_date')
+    rows = 0
+    for batch in iter_batches(overdue_borrows(today), OVERDUE_CSV_FIELDS, batch_size):
+        writer.writerows(row + ((today - row[return_date_index]).days,) for row in batch)
+        rows += len(batch)
+    return rows
+
+
+# Exports are ``values()`` rows, no model or serializer instance per row
+EXPORT_FIELDS = {
+    'books': ['id', 'title', 'isbn', 'quantity', 'available', 'description', 'authors', 'genres'],
+    'borrows': ['id', 'book_id', 'book__title', 'user_id', 'user__username', 'borrow_date', 'return_date', 'returned'],
+}
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+# Separator for many-valued columns in CSV
+CSV_LIST_SEPARATOR = '|'
+
+
+def export_rows(name, queryset, chunk_size=2000):
+    """Yield export dicts for a ``books`` or ``borrows`` queryset."""
+    fields = EXPORT_FIELDS[name]
+    if name == 'borrows':
+        yield from queryset.values(*fields).iterator(chunk_size=chunk_size)
+        return
+
+    # Authors and genres are fetched per chunk of books, two queries per chunk
+    book_fields = [field for field in fields if field not in ('authors', 'genres')]
+    for chunk in _chunked(queryset.values(*book_fields).iterator(chunk_size=chunk_size), chunk_size):
+        ids = [row['id'] for row in chunk]
+        authors = _names_by_book(Book.authors.through, 'author__full_name', ids)
+        genres = _names_by_book(Book.genres.through, 'genre__name', ids)
+        for row in chunk:
+            row['authors'] = authors.get(row['id'], [])
+            row['genres'] = genres.get(row['id'], [])
+            yield row
+
+
+def stream_export(name, queryset, file_format='csv', compress=False, chunk_size=2000):
+    """Yield the encoded (and optionally gzipped) bytes of an export, a chunk of rows at a time."""
+    rows = export_rows(name, queryset, chunk_size)
+    if file_format == 'ndjson':
+        chunks = _ndjson_chunks(rows, chunk_size)
+    else:
+        chunks = _csv_chunks(rows, EXPORT_FIELDS[name], chunk_size)
+    chunks = (chunk.encode() for chunk in chunks)
+    return _gzip_chunks(chunks) if compress else chunks
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _names_by_book(through, name_field, book_ids):
+    names = defaultdict(list)
+    rows = through.objects.filter(book_id__in=book_ids).order_by(name_field).values_list('book_id', name_field)
+    for book_id, name in rows:
+        names[book_id].append(name)
+    return names
+
+
+class _Line:
+    # csv.writer target that hands back the formatted line instead of storing it
+    def write(self, value):
+        return value
+
+
+def _csv_chunks(rows, fields, chunk_size):
+    writer = csv.writer(_Line())
+    yield writer.writerow(fields)
+    for chunk in _chunked(rows, chunk_size):
+        yield ''.join(
+            writer.writerow([
+                CSV_LIST_SEPARATOR.join(value) if isinstance(value, list) else value
+                for value in (row[field] for field in fields)
+            ])
+            for row in chunk
+        )
+
+
+def _ndjson_chunks(rows, chunk_size):
+    for chunk in _chunked(rows, chunk_size):
+        yield ''.join(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in chunk)
+
+
+def _gzip_chunks(chunks):
+    # wbits=31 writes a gzip header so the output is a regular .gz file
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
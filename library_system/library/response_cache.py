@@ -0,0 +1,125 @@
+"""
+Cached book list and detail responses with conditional GET.
+
+Payloads are keyed by the request URL and two versions: the catalogue
+version, replaced whenever books, authors, genres or their links change,
+and the inventory version, replaced when copies are checked out or put
+back. Book lists don't show availability, so they only depend on the
+catalogue version and survive checkouts. A new version orphans every
+entry built on the old one, nothing is deleted.
+
+Versions are random tokens in the shared cache (``SHARED_CACHE_ALIAS``), so
+every worker sees a write at once and an evicted version can never come
+back as an old value. Payloads can stay in a per-process cache.
+
+Payloads are always rendered from the primary. A lagging replica would
+store old rows under the new versions, and every user would be served
+them until the next change.
+
+The ETag is derived from the same versions and the URL, so a matching
+``If-None-Match`` is answered with 304 after reading only the versions.
+"""
+import hashlib
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from library_system.db.replicas import reads_from_primary
+from rest_framework import status
+from rest_framework.response import Response
+
+CATALOGUE_VERSION_KEY = 'books:catalogue_version'
+INVENTORY_VERSION_KEY = 'books:inventory_version'
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache():
+    return caches[settings.LIBRARY_CACHE_ALIAS]
+
+
+def get_version_cache():
+    return caches[settings.SHARED_CACHE_ALIAS]
+
+
+def _new_version():
+    return uuid.uuid4().hex[:12]
+
+
+def _bump(key):
+    # Invalidation must never fail a write, least of all one that already committed
+    try:
+        get_version_cache().set(key, _new_version(), None)
+    except Exception:
+        logger.exception('Could not replace %s, cached responses may be stale until it changes again', key)
+
+
+def get_versions(version_keys):
+    """The current versions, missing ones are started afresh rather than read as a default."""
+    cache = get_version_cache()
+    versions = cache.get_many(version_keys)
+    missing = [key for key in version_keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, _new_version(), None)
+        versions.update(cache.get_many(missing))
+    return versions
+
+
+def _bump_now_and_on_commit(key, using):
+    # Now, so the writing request reads its own changes, and again after commit
+    # so a request that read the old rows mid-transaction can't keep its entry
+    _bump(key)
+    transaction.on_commit(lambda: _bump(key), using=using, robust=True)
+
+
+def bump_catalogue_version(using='default'):
+    _bump_now_and_on_commit(CATALOGUE_VERSION_KEY, using)
+
+
+def bump_inventory_version(using='default'):
+    _bump_now_and_on_commit(INVENTORY_VERSION_KEY, using)
+
+
+def cached_response(request, render, version_keys):
+    """
+    Return the cached payload for ``request`` or the one ``render()`` builds.
+
+    ``version_keys`` are the versions the payload depends on. Only 200
+    responses are cached, anything else is returned as rendered.
+    """
+    cache = get_cache()
+    versions = get_versions(version_keys)
+    state = ':'.join(versions[key] for key in version_keys)
+    url_hash = hashlib.sha1(request.build_absolute_uri().encode()).hexdigest()
+    etag = f'"{state}-{url_hash[:20]}"'
+
+    if etag in _if_none_match(request):
+        return _with_cache_headers(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+
+    key = f'books:response:{url_hash}:{state}'
+    data = cache.get(key)
+    if data is None:
+        with reads_from_primary():
+            response = render()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        data = response.data
+        cache.set(key, data, settings.LIBRARY_CACHE_TIMEOUT)
+    return _with_cache_headers(Response(data), etag)
+
+
+def _if_none_match(request):
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    # Weak and strong validators compare equal for GET
+    return {tag.strip().removeprefix('W/') for tag in header.split(',') if tag.strip()}
+
+
+def _with_cache_headers(response, etag):
+    response['ETag'] = etag
+    # Clients may keep the body but must revalidate, and shared caches must key on the token
+    response['Cache-Control'] = 'no-cache'
+    response['Vary'] = 'Authorization'
+    return response
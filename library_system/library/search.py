@@ -0,0 +1,140 @@
+"""
+Full-text search over books.
+
+PostgreSQL keeps a weighted ``tsvector`` column on ``library_book`` (title,
+author names, description) behind a GIN index, plus trigram indexes on
+``UPPER(title)`` and ``UPPER(full_name)``, the expressions ``icontains``
+compiles to, so those filters stop doing sequential scans.
+SQLite keeps an FTS5 table keyed by book id instead, read through the
+unmanaged ``BookSearchEntry`` model. Both are created by migration 0005
+and the ORM doesn't write them, so they are maintained here from signals
+and after bulk writes. Other databases fall back to ``icontains``.
+"""
+from django.db import connections
+from django.db.models import F, FloatField, Q
+from django.db.models.expressions import RawSQL
+from .models import Author, Book, BookSearchEntry
+
+FTS_TABLE = BookSearchEntry._meta.db_table
+SEARCH_CONFIG = 'english'
+# SQLite variable limit, ids are indexed in batches of this size
+BATCH_SIZE = 500
+
+
+def _tables():
+    return Book._meta.db_table, Author._meta.db_table, Book.authors.through._meta.db_table
+
+
+def _postgres_document_sql():
+    book, author, book_authors = _tables()
+    return f"""
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({book}.title, '')), 'A') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce((
+            SELECT string_agg(a.full_name, ' ') FROM {author} a
+            JOIN {book_authors} ba ON ba.author_id = a.id
+            WHERE ba.book_id = {book}.id
+        ), '')), 'B') ||
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({book}.description, '')), 'C')
+    """
+
+
+def _sqlite_authors_sql(book_alias):
+    _, author, book_authors = _tables()
+    return f"""
+        (SELECT group_concat(a.full_name, ' ') FROM {author} a
+         JOIN {book_authors} ba ON ba.author_id = a.id
+         WHERE ba.book_id = {book_alias}.id)
+    """
+
+
+def index_books(book_ids=None, using='default'):
+    """Refresh the search entries of ``book_ids``, or of every book when None."""
+    connection = connections[using]
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    if book_ids is None:
+        batches = [None]
+    else:
+        book_ids = list(book_ids)
+        batches = [book_ids[i:i + BATCH_SIZE] for i in range(0, len(book_ids), BATCH_SIZE)]
+
+    book = Book._meta.db_table
+    with connection.cursor() as cursor:
+        for batch in batches:
+            params = batch or []
+            in_batch = f"IN ({', '.join(['%s'] * len(params))})"
+
+            if connection.vendor == 'postgresql':
+                sql = f'UPDATE {book} SET search_vector = {_postgres_document_sql()}'
+                if batch is not None:
+                    sql += f' WHERE id {in_batch}'
+                cursor.execute(sql, params)
+                continue
+
+            delete_sql = f'DELETE FROM {FTS_TABLE}'
+            insert_sql = f"""
+                INSERT INTO {FTS_TABLE} (rowid, title, description, authors)
+                SELECT b.id, b.title, b.description, coalesce({_sqlite_authors_sql('b')}, '')
+                FROM {book} b
+            """
+            if batch is not None:
+                delete_sql += f' WHERE rowid {in_batch}'
+                insert_sql += f' WHERE b.id {in_batch}'
+            cursor.execute(delete_sql, params)
+            cursor.execute(insert_sql, params)
+
+
+def unindex_books(book_ids, using='default'):
+    # The Postgres column is deleted with its row, only FTS5 needs cleaning up
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    book_ids = list(book_ids)
+    with connection.cursor() as cursor:
+        for i in range(0, len(book_ids), BATCH_SIZE):
+            batch = book_ids[i:i + BATCH_SIZE]
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(batch))})", batch)
+
+
+def search_books(queryset, query):
+    """Filter ``queryset`` to books matching ``query``, best matches first."""
+    vendor = connections[queryset.db].vendor
+    book = Book._meta.db_table
+
+    if vendor == 'postgresql':
+        tsquery = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+        return queryset.filter(
+            id__in=RawSQL(f'SELECT id FROM {book} WHERE search_vector @@ {tsquery}', [query])
+        ).annotate(
+            search_rank=RawSQL(f'ts_rank_cd({book}.search_vector, {tsquery})', [query], output_field=FloatField())
+        ).order_by('-search_rank', 'id')
+
+    if vendor == 'sqlite':
+        match = _fts5_query(query)
+        if not match:
+            return queryset.none()
+        # Joined once so MATCH runs a single time, bm25 (rank) is lower for better matches
+        return queryset.filter(search_entry__match=match).annotate(
+            search_rank=-F('search_entry__rank'),
+        ).order_by('-search_rank', 'id')
+
+    return queryset.filter(
+        Q(title__icontains=query) | Q(description__icontains=query) | Q(authors__full_name__icontains=query)
+    ).distinct()
+
+
+def search_authors(queryset, query):
+    """Filter authors by name substring, closest names first on PostgreSQL."""
+    queryset = queryset.filter(full_name__icontains=query)
+    if connections[queryset.db].vendor == 'postgresql':
+        # The trigram index serves the icontains filter, similarity() ranks the matches
+        queryset = queryset.annotate(
+            search_rank=RawSQL(f'similarity({Author._meta.db_table}.full_name, %s)', [query], output_field=FloatField())
+        ).order_by('-search_rank', 'id')
+    return queryset
+
+
+def _fts5_query(query):
+    # Quote every word so user input can't inject FTS5 syntax, prefix-match each
+    words = query.split()
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
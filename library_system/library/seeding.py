@@ -0,0 +1,135 @@
+"""
+Synthetic catalogue data for benchmarks and local load testing.
+
+Everything is generated from a seeded ``random.Random`` so two runs with the
+same arguments produce the same rows, and written with ``bulk_create`` in
+batches. Seeded users have unusable passwords and ``seed_user_`` usernames,
+seeded books have ISBNs starting with ``9`` so they are easy to tell apart
+from imported ones. Running it again reuses existing rows instead of
+failing on unique keys.
+"""
+import random
+from collections import Counter
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from users.models import Profile
+from .importers import DEFAULT_QUANTITY, import_records
+from .models import Book, Borrow
+from .response_cache import bump_inventory_version
+
+SEED_USERNAME_PREFIX = 'seed_user_'
+SEED_ISBN_PREFIX = '9'
+
+FIRST_NAMES = ['Anna', 'Ben', 'Clara', 'David', 'Emma', 'Felix', 'Grace', 'Henry', 'Iris', 'Jack', 'Lena', 'Max']
+LAST_NAMES = ['Adams', 'Brown', 'Clark', 'Davis', 'Evans', 'Fischer', 'Garcia', 'Hill', 'Ito', 'Jones', 'King', 'Lee']
+WORDS = ['river', 'shadow', 'garden', 'winter', 'empire', 'secret', 'stone', 'light', 'ocean', 'city', 'night', 'fire']
+GENRES = ['Fantasy', 'Science Fiction', 'Mystery', 'Romance', 'History', 'Biography', 'Poetry', 'Horror', 'Travel', 'Science']
+
+
+def seed_isbn(number):
+    return f'{SEED_ISBN_PREFIX}{number:012d}'
+
+
+def seed_library(books=10000, users=1000, borrows=50000, likes=20000, authors=2000, seed=0, batch_size=2000, log=None):
+    """
+    Create up to the given number of books, users, borrows and likes.
+
+    Active borrows are capped at ``DEFAULT_QUANTITY`` per book and taken off
+    ``Book.available`` so the inventory stays consistent. Returns a dict with
+    the number of rows of each kind that exist after seeding.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+
+    log(f'Seeding {books} books')
+    for start in range(0, books, batch_size):
+        import_records([
+            {
+                'isbn': seed_isbn(number),
+                'title': ' '.join(rng.choice(WORDS) for _ in range(3)).title(),
+                'author': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.randrange(authors)}',
+                'genres': rng.sample(GENRES, rng.randint(1, 3)),
+            }
+            for number in range(start, min(start + batch_size, books))
+        ])
+    book_ids = list(
+        Book.objects.filter(isbn__startswith=SEED_ISBN_PREFIX).order_by('id').values_list('id', flat=True)[:books]
+    )
+
+    log(f'Seeding {users} users')
+    # One hash shared by every seeded user, hashing per user would dominate the run
+    password = make_password(None)
+    for start in range(0, users, batch_size):
+        User.objects.bulk_create(
+            [
+                User(
+                    username=f'{SEED_USERNAME_PREFIX}{number}', password=password,
+                    first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES),
+                )
+                for number in range(start, min(start + batch_size, users))
+            ],
+            ignore_conflicts=True,
+        )
+    user_ids = list(
+        User.objects.filter(username__startswith=SEED_USERNAME_PREFIX).order_by('id').values_list('id', flat=True)[:users]
+    )
+    # bulk_create skips the post_save receiver that creates profiles
+    Profile.objects.bulk_create([Profile(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+
+    if book_ids and user_ids:
+        log(f'Seeding {borrows} borrows')
+        seed_borrows(rng, book_ids, user_ids, borrows, batch_size)
+        log(f'Seeding {likes} likes')
+        profile_ids = list(Profile.objects.filter(user_id__in=user_ids).values_list('id', flat=True))
+        Liked = Profile.liked_books.through
+        Liked.objects.bulk_create(
+            [Liked(profile_id=rng.choice(profile_ids), book_id=rng.choice(book_ids)) for _ in range(likes)],
+            ignore_conflicts=True, batch_size=batch_size,
+        )
+
+    return {
+        'books': len(book_ids),
+        'users': len(user_ids),
+        'borrows': Borrow.objects.filter(book__isbn__startswith=SEED_ISBN_PREFIX).count(),
+        'likes': Profile.liked_books.through.objects.filter(book__isbn__startswith=SEED_ISBN_PREFIX).count(),
+    }
+
+
+@transaction.atomic
+def seed_borrows(rng, book_ids, user_ids, count, batch_size):
+    today = date.today()
+    active = Counter(
+        Borrow.objects.filter(book__isbn__startswith=SEED_ISBN_PREFIX, returned=False).values_list('book_id', flat=True)
+    )
+    taken = Counter()
+    rows = []
+    for _ in range(count):
+        book_id = rng.choice(book_ids)
+        borrow_date = today - timedelta(days=rng.randrange(730))
+        return_date = borrow_date + timedelta(days=14)
+        # Most old borrows came back, a few recent or overdue ones are still out
+        returned = return_date < today and rng.random() < 0.9
+        if not returned and active[book_id] + taken[book_id] >= DEFAULT_QUANTITY:
+            returned = True
+        if not returned:
+            taken[book_id] += 1
+        rows.append(Borrow(
+            book_id=book_id, user_id=rng.choice(user_ids),
+            borrow_date=borrow_date, return_date=return_date, returned=returned,
+        ))
+
+    # Unique (book, user, borrow_date) collisions are skipped, only count what was written
+    Borrow.objects.bulk_create(rows, ignore_conflicts=True, batch_size=batch_size)
+    after = Counter(
+        Borrow.objects.filter(book__isbn__startswith=SEED_ISBN_PREFIX, returned=False).values_list('book_id', flat=True)
+    )
+
+    books = list(Book.objects.filter(isbn__startswith=SEED_ISBN_PREFIX).only('id', 'available'))
+    books = [book for book in books if after[book.id] != active[book.id]]
+    for book in books:
+        book.available = max(book.available - (after[book.id] - active[book.id]), 0)
+    Book.objects.bulk_update(books, ['available'], batch_size=batch_size)
+    bump_inventory_version()
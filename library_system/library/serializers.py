@@ -1,5 +1,12 @@
+from collections import Counter
+
 from .models import Author, Genre, Book, Borrow
 from rest_framework import serializers
+from django.db import transaction
+from . import inventory
+from .importers import get_or_create_ids
+from .signals import books_changed
+from .recommender import cache as recommendation_cache
 from django.contrib.auth.models import User
 
 class AuthorSerializer(serializers.ModelSerializer):
@@ -12,16 +19,19 @@ class GenreSerializer(serializers.ModelSerializer):
         model = Genre
         fields = '__all__'
 
+class NestedGenreSerializer(GenreSerializer):
+    # Nested genres are matched by name, so existing names are valid here
+    class Meta(GenreSerializer.Meta):
+        extra_kwargs = {'name': {'validators': []}}
+
 class BulkGenreSerializer(serializers.Serializer):
-    genres = GenreSerializer(many=True)
+    genres = NestedGenreSerializer(many=True)
 
     def create(self, validated_data):
         genres_data = validated_data.pop('genres')
-        genres = []
-        for genre_data in genres_data:
-            genre, created = Genre.objects.get_or_create(name=genre_data['name'])
-            genres.append(genre)
-        return genres
+        genre_ids = resolve_genres(genres_data)
+        genres = Genre.objects.in_bulk(genre_ids.values())
+        return [genres[genre_ids[genre_data['name']]] for genre_data in genres_data]
 
 class BookListSerializer(serializers.ModelSerializer):
     class Meta:
@@ -30,27 +40,25 @@ class BookListSerializer(serializers.ModelSerializer):
 
 class BookDetailSerializer(serializers.ModelSerializer):
     authors = AuthorSerializer(many=True, required=False)
-    genres = GenreSerializer(many=True, required=False)
+    genres = NestedGenreSerializer(many=True, required=False)
 
     class Meta:
         model = Book
-        fields = '__all__'
+        fields = ['id', 'authors', 'genres', 'title', 'description', 'isbn', 'quantity', 'available']
 
+    @transaction.atomic
     def create(self, validated_data):
         authors_data = validated_data.pop('authors', [])
         genres_data = validated_data.pop('genres', [])
         book = Book.objects.create(**validated_data)
 
-        for author_data in authors_data:
-            author, created = Author.objects.get_or_create(full_name=author_data['full_name'], defaults=author_data)
-            book.authors.add(author)
-
-        for genre_data in genres_data:
-            genre, created = Genre.objects.get_or_create(name=genre_data['name'], defaults=genre_data)
-            book.genres.add(genre)
+        set_book_relations('authors', {book.pk: set(resolve_authors(authors_data).values())})
+        set_book_relations('genres', {book.pk: set(resolve_genres(genres_data).values())})
+        books_changed.send(sender=Book, book_ids=[book.pk])
 
         return book
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         authors_data = validated_data.pop('authors', None)
         genres_data = validated_data.pop('genres', None)
@@ -58,23 +66,196 @@ class BookDetailSerializer(serializers.ModelSerializer):
         instance.title = validated_data.get('title', instance.title)
         instance.description = validated_data.get('description', instance.description)
         instance.isbn = validated_data.get('isbn', instance.isbn)
-        instance.quantity = validated_data.get('quantity', instance.quantity)
-        instance.save()
+        if 'quantity' in validated_data:
+            inventory.set_quantities({instance.pk: validated_data['quantity']})
+            instance.quantity = validated_data['quantity']
+            instance.refresh_from_db(fields=['available'])
+        # related_data is maintained from the relation changes below
+        instance.save(update_fields=['title', 'description', 'isbn', 'quantity'])
 
         if authors_data is not None:
-            instance.authors.clear()
-            for author_data in authors_data:
-                author, created = Author.objects.get_or_create(full_name=author_data['full_name'], defaults=author_data)
-                instance.authors.add(author)
-
+            set_book_relations('authors', {instance.pk: set(resolve_authors(authors_data).values())})
         if genres_data is not None:
-            instance.genres.clear()
-            for genre_data in genres_data:
-                genre, created = Genre.objects.get_or_create(name=genre_data['name'], defaults=genre_data)
-                instance.genres.add(genre)
+            set_book_relations('genres', {instance.pk: set(resolve_genres(genres_data).values())})
+        if authors_data is not None or genres_data is not None:
+            books_changed.send(sender=Book, book_ids=[instance.pk])
 
         return instance
 
+class BookDetailReadSerializer(serializers.ModelSerializer):
+    """Same output as BookDetailSerializer, authors and genres come from the denormalised ``related_data``."""
+    authors = serializers.SerializerMethodField()
+    genres = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Book
+        fields = BookDetailSerializer.Meta.fields
+
+    def get_authors(self, obj):
+        return obj.related_data.get('authors', [])
+
+    def get_genres(self, obj):
+        return obj.related_data.get('genres', [])
+
+def resolve_authors(authors_data):
+    """Map nested author data to ``{full_name: id}``, one lookup by name plus one bulk insert for new authors."""
+    by_name = {}
+    for author_data in authors_data:
+        by_name.setdefault(author_data['full_name'], author_data)
+    return get_or_create_ids(Author, 'full_name', set(by_name), lambda name: Author(**by_name[name]))
+
+def resolve_genres(genres_data):
+    names = {genre_data['name'] for genre_data in genres_data}
+    return get_or_create_ids(Genre, 'name', names, lambda name: Genre(name=name))
+
+def set_book_relations(field_name, targets):
+    """
+    Make each book's ``field_name`` relation point at exactly the ids in
+    ``targets`` (``{book_id: set of ids}``) by diffing the through table:
+    one read, one delete for removed rows, one bulk insert for added ones.
+    """
+    through = getattr(Book, field_name).through
+    column = getattr(Book, field_name).field.m2m_reverse_name()
+
+    current = {}
+    removed = []
+    for row_id, book_id, related_id in through.objects.filter(book_id__in=targets).values_list('id', 'book_id', column):
+        current.setdefault(book_id, set()).add(related_id)
+        if related_id not in targets[book_id]:
+            removed.append(row_id)
+    if removed:
+        through.objects.filter(id__in=removed).delete()
+
+    through.objects.bulk_create([
+        through(book_id=book_id, **{column: related_id})
+        for book_id, related_ids in targets.items()
+        for related_id in related_ids - current.get(book_id, set())
+    ])
+
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    List serializer for bulk endpoints.
+
+    Every item is validated, then ``validate_batch`` runs the checks that
+    need the database once for the whole batch. Errors come back as a list
+    aligned with the payload, ``{}`` for valid items.
+    """
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            raise serializers.ValidationError({'non_field_errors': ['Expected a list of items.']}, code='not_a_list')
+        if self.max_length is not None and len(data) > self.max_length:
+            message = self.error_messages['max_length'].format(max_length=self.max_length)
+            raise serializers.ValidationError({'non_field_errors': [message]}, code='max_length')
+
+        items, errors = [], []
+        for item in data:
+            try:
+                items.append(self.run_child_validation(item))
+                errors.append({})
+            except serializers.ValidationError as exc:
+                items.append(None)
+                errors.append(exc.detail)
+
+        self.validate_batch([(i, item) for i, item in enumerate(items) if item is not None], errors)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+    def validate_batch(self, items, errors):
+        """Add errors for ``(index, item)`` pairs into ``errors[index]``."""
+
+class BulkBookListSerializer(BulkListSerializer):
+    """
+    Validates and writes many books with a fixed number of queries.
+
+    ISBN uniqueness is checked for the whole batch at once instead of by the
+    per-item UniqueValidator.
+    """
+
+    def validate_batch(self, items, errors):
+        updating = self.instance is not None
+        instances = {book.pk: book for book in self.instance} if updating else {}
+
+        for i, item in items:
+            if updating and item.get('id') not in instances:
+                errors[i]['id'] = ['Book not found.' if item.get('id') else 'This field is required.']
+
+        isbns = [item['isbn'] for _, item in items if 'isbn' in item]
+        taken = dict(Book.objects.filter(isbn__in=isbns).values_list('isbn', 'id'))
+        seen = set()
+        for i, item in items:
+            isbn = item.get('isbn')
+            if isbn is None:
+                continue
+            if isbn in seen:
+                errors[i]['isbn'] = ['Duplicate isbn in this batch.']
+            elif isbn in taken and taken[isbn] != item.get('id'):
+                errors[i]['isbn'] = ['book with this isbn already exists.']
+            seen.add(isbn)
+
+    @transaction.atomic
+    def create(self, validated_data):
+        books = [
+            Book(**{key: value for key, value in item.items() if key not in ('id', 'authors', 'genres')})
+            for item in validated_data
+        ]
+        for book in books:
+            book.available = book.quantity
+        books = Book.objects.bulk_create(books)
+        book_ids = dict(Book.objects.filter(isbn__in=[book.isbn for book in books]).values_list('isbn', 'id'))
+        for book in books:
+            book.pk = book_ids[book.isbn]
+
+        self.write_relations(books, validated_data)
+        books_changed.send(sender=Book, book_ids=list(book_ids.values()))
+        return books
+
+    @transaction.atomic
+    def update(self, instances, validated_data):
+        instances = {book.pk: book for book in instances}
+        quantities = {item['id']: item['quantity'] for item in validated_data if 'quantity' in item}
+        if quantities:
+            inventory.set_quantities(quantities)
+        books, fields = [], set()
+        for item in validated_data:
+            book = instances[item['id']]
+            for field in ('title', 'description', 'isbn', 'quantity'):
+                if field in item:
+                    setattr(book, field, item[field])
+                    fields.add(field)
+            books.append(book)
+        if fields:
+            Book.objects.bulk_update(books, fields)
+
+        self.write_relations(books, validated_data)
+        books_changed.send(sender=Book, book_ids=[book.pk for book in books])
+        return books
+
+    def write_relations(self, books, validated_data):
+        for field_name, resolve in (('authors', resolve_authors), ('genres', resolve_genres)):
+            given = [(book, item[field_name]) for book, item in zip(books, validated_data) if field_name in item]
+            if not given:
+                continue
+            ids = resolve([related for _, related_data in given for related in related_data])
+            key = 'full_name' if field_name == 'authors' else 'name'
+            set_book_relations(field_name, {
+                book.pk: {ids[related[key]] for related in related_data}
+                for book, related_data in given
+            })
+
+class BulkBookSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(required=False)
+    # Uniqueness is checked batch-wide by BulkBookListSerializer
+    isbn = serializers.CharField(max_length=13)
+    authors = AuthorSerializer(many=True, required=False)
+    genres = NestedGenreSerializer(many=True, required=False)
+
+    class Meta:
+        model = Book
+        fields = ['id', 'title', 'description', 'isbn', 'quantity', 'authors', 'genres']
+        list_serializer_class = BulkBookListSerializer
+
     
 class BorrowSerializer(serializers.ModelSerializer):
     book = BookListSerializer(read_only=True)
@@ -89,4 +270,117 @@ class BorrowSerializer(serializers.ModelSerializer):
     def get_user_full_name(self, obj):
         return f"{obj.user.first_name} {obj.user.last_name}"
 
-    
\ No newline at end of file
+    def create(self, validated_data):
+        return inventory.checkout(**validated_data)
+
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        returned = validated_data.pop('returned', None)
+        # Lock the row so inventory changes are based on its current state
+        instance.returned, instance.book_id = Borrow.objects.select_for_update().values_list('returned', 'book_id').get(pk=instance.pk)
+
+        book = validated_data.get('book')
+        if book is not None and book.pk != instance.book_id and not instance.returned:
+            # An active borrow moving to another book swaps the copies
+            deltas = {book.pk: -1}
+            if instance.book_id:
+                deltas[instance.book_id] = 1
+            inventory.adjust_copies(deltas)
+
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        if validated_data:
+            instance.save(update_fields=list(validated_data))
+
+        if returned is not None and returned != instance.returned:
+            inventory.set_returned(instance, returned)
+        return instance
+
+    
+
+class BulkBorrowListSerializer(BulkListSerializer):
+    """
+    Validates and writes many borrows with a fixed number of queries: one
+    lookup each for the referenced books, users and already existing borrows.
+    """
+
+    def validate_batch(self, items, errors):
+        updating = self.instance is not None
+        instances = {borrow.pk: borrow for borrow in self.instance} if updating else {}
+
+        book_ids = Book.objects.filter(id__in={item['book_id'] for _, item in items if 'book_id' in item}).values_list('id', flat=True)
+        user_ids = User.objects.filter(id__in={item['user_id'] for _, item in items if 'user_id' in item}).values_list('id', flat=True)
+        book_ids, user_ids = set(book_ids), set(user_ids)
+
+        for i, item in items:
+            if updating and item.get('id') not in instances:
+                errors[i]['id'] = ['Borrow not found.' if item.get('id') else 'This field is required.']
+            if 'book_id' in item and item['book_id'] not in book_ids:
+                errors[i]['book_id'] = [f'Invalid pk "{item["book_id"]}" - object does not exist.']
+            if 'user_id' in item and item['user_id'] not in user_ids:
+                errors[i]['user_id'] = [f'Invalid pk "{item["user_id"]}" - object does not exist.']
+
+        if not updating:
+            keys = [(i, (item['book_id'], item['user_id'], item['borrow_date'])) for i, item in items]
+            existing = set(Borrow.objects.filter(
+                book_id__in={key[0] for _, key in keys},
+                user_id__in={key[1] for _, key in keys},
+                borrow_date__in={key[2] for _, key in keys},
+            ).values_list('book_id', 'user_id', 'borrow_date'))
+            seen = set()
+            for i, key in keys:
+                if key in existing or key in seen:
+                    errors[i]['non_field_errors'] = ['The fields book, user, borrow_date must make a unique set.']
+                seen.add(key)
+
+    @transaction.atomic
+    def create(self, validated_data):
+        borrows = [Borrow(**{key: value for key, value in item.items() if key != 'id'}) for item in validated_data]
+        inventory.adjust_copies({book_id: -count for book_id, count in inventory.copies_needed(borrows).items()})
+        borrows = Borrow.objects.bulk_create(borrows)
+        # bulk_create skips the post_save receiver that does this per borrow
+        recommendation_cache.invalidate_users({borrow.user_id for borrow in borrows})
+        return borrows
+
+    @transaction.atomic
+    def update(self, instances, validated_data):
+        instances = {borrow.pk: borrow for borrow in instances}
+        current = {
+            borrow_id: (returned, book_id)
+            for borrow_id, returned, book_id in Borrow.objects.select_for_update().filter(id__in=instances).values_list('id', 'returned', 'book_id')
+        }
+
+        # Net copies each book gains from returns and loses from re-borrows or moved borrows
+        deltas = Counter()
+        for item in validated_data:
+            returned, book_id = current[item['id']]
+            if not returned and book_id:
+                deltas[book_id] += 1
+            if not item.get('returned', returned) and item.get('book_id', book_id):
+                deltas[item.get('book_id', book_id)] -= 1
+        inventory.adjust_copies(deltas)
+
+        borrows, fields = [], set()
+        for item in validated_data:
+            borrow = instances[item['id']]
+            for field, value in item.items():
+                if field != 'id':
+                    setattr(borrow, field, value)
+                    fields.add(field)
+            borrows.append(borrow)
+        if fields:
+            Borrow.objects.bulk_update(borrows, fields)
+        return borrows
+
+class BulkBorrowSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(required=False)
+    # Plain ids, resolved for the whole batch by BulkBorrowListSerializer
+    book_id = serializers.IntegerField()
+    user_id = serializers.IntegerField()
+
+    class Meta:
+        model = Borrow
+        fields = ['id', 'book_id', 'user_id', 'borrow_date', 'return_date', 'returned']
+        list_serializer_class = BulkBorrowListSerializer
+        # The unique_borrow constraint is checked batch-wide
+        validators = []
@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+from .models import Author, Book, Borrow, Genre
+from .recommender import cache as recommendation_cache
+from . import read_model, response_cache, search
+
+# Sent with ``book_ids`` after bulk writes that bypass model signals
+books_changed = Signal()
+# Sent with ``book_ids`` after a bulk delete, in place of the work post_delete does for each book
+books_deleted = Signal()
+
+_book_deletes_deferred = ContextVar('book_deletes_deferred', default=False)
+
+@contextmanager
+def deferring_book_deletes():
+    """Skip the per-book post_delete work inside the block, the caller sends ``books_deleted`` instead."""
+    token = _book_deletes_deferred.set(True)
+    try:
+        yield
+    finally:
+        _book_deletes_deferred.reset(token)
+
+@receiver(post_delete, sender=Book)
+def invalidate_recommendations_on_book_delete(sender, instance, **kwargs):
+    if _book_deletes_deferred.get():
+        return
+    recommendation_cache.invalidate_all()
+    search.unindex_books([instance.pk], using=kwargs.get('using', 'default'))
+
+@receiver(books_deleted)
+def invalidate_recommendations_on_bulk_delete(sender, book_ids, using='default', **kwargs):
+    recommendation_cache.invalidate_all()
+    search.unindex_books(book_ids, using=using)
+
+@receiver(post_save, sender=Borrow)
+def invalidate_recommendations_on_borrow(sender, instance, created, **kwargs):
+    if created and instance.user_id:
+        recommendation_cache.invalidate_user(instance.user_id)
+
+@receiver(post_save, sender=Book)
+def index_saved_book(sender, instance, using, **kwargs):
+    search.index_books([instance.pk], using=using)
+
+@receiver(m2m_changed, sender=Book.authors.through)
+def index_books_on_author_change(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        search.index_books([instance.pk], using=using)
+    elif pk_set:
+        search.index_books(pk_set, using=using)
+    else:
+        # Clearing from the author side doesn't say which books were affected
+        search.index_books(using=using)
+
+@receiver(post_save, sender=Author)
+def index_books_on_author_rename(sender, instance, created, using, **kwargs):
+    if not created:
+        search.index_books(instance.books.values_list('id', flat=True), using=using)
+
+@receiver(post_delete, sender=Author)
+def index_books_on_author_delete(sender, instance, using, **kwargs):
+    # Links are cascade-deleted without m2m_changed, remember_related_books kept the book ids
+    search.index_books(getattr(instance, '_related_book_ids', []), using=using)
+
+@receiver(books_changed)
+def index_changed_books(sender, book_ids, using='default', **kwargs):
+    search.index_books(book_ids, using=using)
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def bump_catalogue_version(sender, using='default', **kwargs):
+    if sender is Book and _book_deletes_deferred.get():
+        return
+    response_cache.bump_catalogue_version(using)
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.genres.through)
+def bump_catalogue_version_on_links(sender, action, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        response_cache.bump_catalogue_version(using)
+
+@receiver(books_changed)
+@receiver(books_deleted)
+def bump_catalogue_version_on_bulk_write(sender, using='default', **kwargs):
+    response_cache.bump_catalogue_version(using)
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.genres.through)
+def refresh_related_data_on_links(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if reverse and action == 'pre_clear':
+        # Nothing is left to tell which books lost the author or genre after the clear
+        instance._cleared_book_ids = list(instance.books.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        read_model.refresh_book_relations([instance.pk] if not reverse else pk_set, using=using)
+    elif action == 'post_clear':
+        read_model.refresh_book_relations(getattr(instance, '_cleared_book_ids', []) if reverse else [instance.pk], using=using)
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def refresh_related_data_on_rename(sender, instance, created, using, **kwargs):
+    if not created:
+        read_model.refresh_book_relations(instance.books.values_list('id', flat=True), using=using)
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def remember_related_books(sender, instance, **kwargs):
+    # The links are cascade-deleted without m2m_changed
+    instance._related_book_ids = list(instance.books.values_list('id', flat=True))
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def refresh_related_data_on_delete(sender, instance, using, **kwargs):
+    read_model.refresh_book_relations(getattr(instance, '_related_book_ids', []), using=using)
+
+@receiver(books_changed)
+def refresh_related_data_on_bulk_write(sender, book_ids, using='default', **kwargs):
+    read_model.refresh_book_relations(book_ids, using=using)
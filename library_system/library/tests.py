@@ -1,3 +1,1371 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.utils import ConnectionHandler
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from library_system import metrics
+from library_system.db.pool import close_pools
+from library_system.checks import check_persistent_connections, check_replica_pins
+from library_system.db.replicas import ReplicaSet, get_pin_cache, pin_key, reads_from_replica
+from rest_framework.test import APITestCase, APITransactionTestCase
+from surprise import SVD, Dataset, Reader
+
+from . import inventory, reports, response_cache
+from .importers import DEFAULT_QUANTITY, import_records, iter_csv_chunks, parse_chunks, parse_rows
+from .models import Author, Book, Borrow, Genre
+from .recommender import cache as recommendation_cache
+from .recommender.artifacts import save_artifact
+from .recommender.registry import ArtifactRegistry, ModelRegistry, get_model_version
+from .recommender.scoring import Scorer
+from .recommender.similarity import NeighbourIndex, build_neighbour_table, get_neighbour_index, save_neighbour_table
+from .recommender.training import BORROWED_RATING, LIKED_RATING, InteractionMatrix, iter_interactions, train_svd
+from .views import BookRecommendationsView
+from users.models import Profile
+
+
+def factor_arrays(n_users, n_items, n_factors=2, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'pu': rng.normal(size=(n_users, n_factors)).astype(np.float32),
+        'qi': rng.normal(size=(n_items, n_factors)).astype(np.float32),
+        'bu': rng.normal(size=n_users).astype(np.float32),
+        'bi': rng.normal(size=n_items).astype(np.float32),
+    }
+
+
+class ModelRegistryTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def write_pickle(self, path, model, mtime_ns):
+        with open(path, 'wb') as f:
+            pickle.dump(model, f)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_pickle_is_reloaded_only_when_its_content_changes(self):
+        path = os.path.join(self.root, 'model.pkl')
+        self.write_pickle(path, {'name': 'first'}, 1_000_000_000)
+        registry = ModelRegistry(path)
+        model = registry.get()
+        self.assertEqual(model, {'name': 'first'})
+        self.assertIs(registry.get(), model)
+
+        # Touched with the same content, the loaded model is kept
+        os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+        self.assertIs(registry.get(), model)
+
+        self.write_pickle(path, {'name': 'other'}, 3_000_000_000)
+        self.assertEqual(registry.get(), {'name': 'other'})
+
+    def test_artifact_registry_serves_the_current_version(self):
+        registry = ArtifactRegistry(self.root, mmap=True)
+        self.assertFalse(registry.is_available())
+        with self.assertRaises(FileNotFoundError):
+            registry.get()
+
+        save_artifact(self.root, 'v1', factor_arrays(2, 3), [10, 11], [1, 2, 3], {'global_mean': 4.0})
+        scorer = registry.get()
+        self.assertIs(registry.get(), scorer)
+        self.assertEqual(registry.version, 'v1')
+        self.assertIsInstance(scorer.qi, np.memmap)
+
+        save_artifact(self.root, 'v2', factor_arrays(2, 4, seed=1), [10, 11], [1, 2, 3, 4], {'global_mean': 4.0})
+        self.assertEqual(registry.get().item_ids.tolist(), [1, 2, 3, 4])
+        self.assertEqual(registry.version, 'v2')
+
+    def test_model_version_follows_the_served_model(self):
+        pickle_path = os.path.join(self.root, 'model.pkl')
+        registries = {'artifact': ArtifactRegistry(self.root), 'pickle': ModelRegistry(pickle_path)}
+        with mock.patch.dict('library.recommender.registry._registries', registries):
+            self.assertIsNone(get_model_version())
+            self.write_pickle(pickle_path, {'name': 'first'}, 1_000_000_000)
+            first = get_model_version()
+            self.write_pickle(pickle_path, {'name': 'other'}, 2_000_000_000)
+            self.assertNotEqual(get_model_version(), first)
+
+            save_artifact(self.root, 'v1', factor_arrays(2, 3), [10, 11], [1, 2, 3], {'global_mean': 4.0})
+            self.assertEqual(get_model_version(), 'v1')
+
+
+class ScorerTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = np.random.default_rng(0)
+        ratings = pd.DataFrame({
+            'user': rng.integers(1, 30, 400),
+            'book': rng.integers(100, 160, 400),
+            'rating': rng.integers(1, 6, 400),
+        })
+        trainset = Dataset.load_from_df(ratings, Reader(rating_scale=(1, 5))).build_full_trainset()
+        cls.model = SVD(n_factors=5, n_epochs=5, random_state=0).fit(trainset)
+        cls.scorer = Scorer.from_surprise(cls.model)
+
+    def expected(self, user_id):
+        return {
+            book_id: self.model.predict(user_id, book_id, clip=False).est
+            for book_id in self.scorer.item_ids.tolist()
+        }
+
+    def test_scores_match_surprise_predictions(self):
+        for user_id in (1, 5, 999):
+            expected = self.expected(user_id)
+            scores = dict(zip(self.scorer.item_ids.tolist(), self.scorer.scores(user_id)))
+            for book_id, estimate in expected.items():
+                self.assertAlmostEqual(scores[book_id], estimate, places=5)
+
+    def test_top_k_is_the_best_unexcluded_books_in_order(self):
+        expected = self.expected(5)
+        excluded = set(sorted(expected, key=expected.get, reverse=True)[:3])
+        best = sorted((book_id for book_id in expected if book_id not in excluded), key=expected.get, reverse=True)
+
+        self.assertEqual(self.scorer.top_k(5, 10, exclude=excluded | {12345}), best[:10])
+        self.assertEqual(self.scorer.top_k(5, 1000, exclude=excluded), best)
+        self.assertEqual(self.scorer.top_k(5, 10, exclude=set(expected)), [])
+
+    def test_repeated_excluded_ids_do_not_shrink_top_k(self):
+        expected = self.expected(5)
+        ranked = sorted(expected, key=expected.get, reverse=True)
+        # Every book but the last two excluded, the first one five times over
+        exclude = ranked[:-2] + [ranked[0]] * 5 + [12345]
+        self.assertEqual(self.scorer.top_k(5, 10, exclude=exclude), ranked[-2:])
+
+
+class NeighbourIndexTest(SimpleTestCase):
+    book_ids = [1, 2, 3, 4]
+    # 1 and 2 point the same way, 3 is orthogonal to 1, 4 has no factors
+    item_factors = {1: [1.0, 0.0], 2: [0.9, 0.1], 3: [0.0, 1.0]}
+    interactions = [(10, 3), (10, 4), (11, 3), (11, 4), (11, 4)]
+
+    def build(self, k=2):
+        return build_neighbour_table(self.book_ids, self.item_factors, self.interactions, k)
+
+    def test_neighbours_blend_factors_and_cooccurrence(self):
+        neighbours, scores = self.build()
+
+        self.assertEqual(neighbours.tolist(), [[2, -1], [1, 3], [4, 2], [3, -1]])
+        # Only co-occurrence links 4 to 3, and a repeated borrow counts once
+        self.assertAlmostEqual(float(scores[3, 0]), 0.3, places=5)
+        self.assertEqual(float(scores[0, 1]), 0)
+        for i, book_id in enumerate(self.book_ids):
+            self.assertNotIn(book_id, neighbours[i].tolist())
+            self.assertEqual(scores[i].tolist(), sorted(scores[i].tolist(), reverse=True))
+
+    def test_k_is_capped_by_the_catalogue(self):
+        neighbours, scores = self.build(k=10)
+        self.assertEqual(neighbours.shape, (4, 3))
+        self.assertEqual(build_neighbour_table([1], {1: [1.0, 0.0]}, [], 5)[0].shape, (1, 0))
+
+    def test_saved_table_is_loaded_and_merged(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'neighbours.npz')
+        save_neighbour_table(path, self.book_ids, *self.build())
+        index = NeighbourIndex.load(path)
+
+        self.assertEqual([neighbour for neighbour, _ in index.neighbours_of(3)], [4, 2])
+        self.assertEqual(index.neighbours_of(1), [(2, mock.ANY)])
+        self.assertEqual(index.neighbours_of(99), [])
+        self.assertEqual(index.recommend([4, 2], 5), [1, 3])
+        self.assertEqual(index.recommend([4, 2], 5, exclude={1}), [3])
+
+    def test_recommend_sums_the_scores_of_repeated_neighbours(self):
+        index = NeighbourIndex(
+            np.array([1, 2, 3]),
+            np.array([[4, 5], [5, 6], [-1, -1]]),
+            np.array([[0.5, 0.4], [0.3, 0.6], [0, 0]], dtype=np.float32),
+        )
+        # 5 is a neighbour of both 1 and 2, 0.4 + 0.3 puts it first
+        self.assertEqual(index.recommend([1, 2, 3], 5), [5, 6, 4])
+        self.assertEqual(index.recommend([1, 2], 2, exclude={6}), [5, 4])
+
+    def test_index_is_reloaded_when_the_file_is_rebuilt(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'neighbours.npz')
+
+        with override_settings(RECOMMENDER_NEIGHBOURS_PATH=path):
+            self.assertIsNone(get_neighbour_index())
+
+            save_neighbour_table(path, self.book_ids, *self.build())
+            os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+            index = get_neighbour_index()
+            self.assertEqual(index.book_ids.tolist(), self.book_ids)
+            self.assertIs(get_neighbour_index(), index)
+
+            save_neighbour_table(path, self.book_ids[:2], *build_neighbour_table(self.book_ids[:2], self.item_factors, [], 1))
+            os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+            self.assertEqual(get_neighbour_index().book_ids.tolist(), [1, 2])
+
+
+class ScorePoolTest(SimpleTestCase):
+    def setUp(self):
+        # Book 1's only neighbour is 2, book 3 has none
+        self.index = NeighbourIndex(
+            np.array([1, 3]), np.array([[2, -1], [-1, -1]]), np.array([[0.5, 0], [0, 0]], dtype=np.float32),
+        )
+        self.scorer = mock.Mock()
+        self.scorer.top_k.side_effect = lambda user_id, k, exclude: [b for b in (2, 7, 8, 9) if b not in exclude][:k]
+
+    def score_pool(self, liked_book_ids, excluded, index=None):
+        with (
+            mock.patch('library.views.get_neighbour_index', return_value=index),
+            mock.patch('library.views.get_scorer', return_value=self.scorer),
+            mock.patch.object(BookRecommendationsView, 'candidate_pool_size', 3),
+        ):
+            return BookRecommendationsView.score_pool(5, liked_book_ids, excluded)
+
+    def test_neighbours_are_topped_up_by_the_model(self):
+        self.assertEqual(self.score_pool([1], {1}, self.index), [2, 7, 8])
+        self.scorer.top_k.assert_called_once_with(5, 2, exclude={1, 2})
+
+    def test_books_without_neighbours_fall_back_to_the_model(self):
+        self.assertEqual(self.score_pool([3], {3}, self.index), [2, 7, 8])
+        self.assertEqual(self.score_pool([3], {3}), [2, 7, 8])
+
+    def test_neighbours_are_served_without_a_model(self):
+        with (
+            mock.patch('library.views.get_neighbour_index', return_value=self.index),
+            mock.patch('library.views.get_scorer', side_effect=FileNotFoundError),
+        ):
+            self.assertEqual(BookRecommendationsView.score_pool(5, [1], {1}), [2])
+            with self.assertRaises(FileNotFoundError):
+                BookRecommendationsView.score_pool(5, [3], {3})
+
+
+class RecommendationCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def compute(self, result):
+        return mock.Mock(return_value=result)
+
+    def test_catalogue_changes_make_entries_stale(self):
+        recommendation_cache.get_or_compute(1, [1], self.compute([2, 3]))
+        compute = self.compute([4])
+        self.assertEqual(recommendation_cache.get_or_compute(1, [1], compute), [2, 3])
+        compute.assert_not_called()
+
+        recommendation_cache.invalidate_all()
+        self.assertEqual(recommendation_cache.get_or_compute(1, [1], compute), [4])
+
+    def test_evicted_generation_does_not_revive_old_entries(self):
+        recommendation_cache.get_or_compute(1, [1], self.compute([2, 3]))
+        recommendation_cache.invalidate_all()
+        recommendation_cache.get_generation_cache().delete(recommendation_cache.GENERATION_KEY)
+
+        self.assertEqual(recommendation_cache.get_or_compute(1, [1], self.compute([4])), [4])
+
+    def test_a_new_model_makes_entries_stale(self):
+        with mock.patch('library.recommender.cache.get_model_version', return_value='v1'):
+            recommendation_cache.get_or_compute(1, [1], self.compute([2, 3]))
+            self.assertEqual(recommendation_cache.get_or_compute(1, [1], self.compute([4])), [2, 3])
+        with mock.patch('library.recommender.cache.get_model_version', return_value='v2'):
+            self.assertEqual(recommendation_cache.get_or_compute(1, [1], self.compute([4])), [4])
+
+    def test_changed_likes_are_recomputed(self):
+        recommendation_cache.get_or_compute(1, [1], self.compute([2, 3]))
+        self.assertEqual(recommendation_cache.get_or_compute(1, [1, 5], self.compute([6])), [6])
+        # Another user's likes have their own entry
+        self.assertEqual(recommendation_cache.get_or_compute(2, [1, 5], self.compute([7])), [7])
+        self.assertEqual(recommendation_cache.get_or_compute(1, [1, 5], self.compute([8])), [6])
+
+    def test_invalidated_users_are_recomputed(self):
+        for user_id in (1, 2, 3):
+            recommendation_cache.get_or_compute(user_id, [1], self.compute([user_id]))
+        recommendation_cache.invalidate_user(1)
+        recommendation_cache.invalidate_users([2])
+
+        self.assertEqual(
+            [recommendation_cache.get_or_compute(user_id, [1], self.compute([0])) for user_id in (1, 2, 3)],
+            [[0], [0], [3]],
+        )
+
+    def test_deleting_a_book_starts_a_new_generation(self):
+        book = Book.objects.create(title='Gone', isbn='9780000000001', quantity=1)
+        recommendation_cache.get_or_compute(1, [1], self.compute([book.id]))
+        book.delete()
+        self.assertEqual(recommendation_cache.get_or_compute(1, [1], self.compute([2])), [2])
+
+    async def test_async_entries_are_shared_with_the_sync_path(self):
+        async def compute():
+            return [2, 3]
+
+        self.assertEqual(await recommendation_cache.aget_or_compute(1, [1], compute), [2, 3])
+        self.assertEqual(await recommendation_cache.aget_or_compute(1, [1], mock.AsyncMock()), [2, 3])
+        self.assertEqual(await sync_to_async(recommendation_cache.get_or_compute)(1, [1], self.compute([4])), [2, 3])
+
+        # Stale entries are still served as a fallback once likes change
+        await recommendation_cache.aget_or_compute(1, [1, 5], mock.AsyncMock(return_value=[6]))
+        self.assertEqual(await recommendation_cache.aget_stale(1), [6])
+        self.assertIsNone(await recommendation_cache.aget_stale(2))
+
+
+class TrainSVDTest(SimpleTestCase):
+    def skewed_interactions(self):
+        rng = np.random.default_rng(0)
+        n = 20000
+        users = rng.integers(0, 1000, n).astype(np.int32)
+        # A third of all interactions on one book, the rest zipf distributed
+        items = np.where(rng.random(n) < 0.3, 0, np.minimum(rng.zipf(1.3, n), 499)).astype(np.int32)
+        ratings = rng.choice([4.0, 5.0], n).astype(np.float32)
+        return users, items, ratings
+
+    def test_skewed_items_train_to_finite_factors(self):
+        users, items, ratings = self.skewed_interactions()
+        arrays, global_mean = train_svd(users, items, ratings, 1000, 500, n_factors=20, n_epochs=20)
+
+        for name, values in arrays.items():
+            self.assertTrue(np.isfinite(values).all(), name)
+        predictions = (
+            global_mean + arrays['bu'][users] + arrays['bi'][items]
+            + np.einsum('ij,ij->i', arrays['pu'][users], arrays['qi'][items])
+        )
+        self.assertLess(np.sqrt(np.mean((predictions - ratings) ** 2)), 0.6)
+
+    def test_learns_which_books_each_group_of_users_prefers(self):
+        # Users 0-19 rate books 0-9 high and 10-19 low, users 20-39 the other way round
+        users, items = (grid.ravel().astype(np.int32) for grid in np.meshgrid(np.arange(40), np.arange(20)))
+        ratings = np.where((users < 20) == (items < 10), 5.0, 1.0).astype(np.float32)
+        rng = np.random.default_rng(1)
+        train = rng.random(len(ratings)) < 0.8
+
+        arrays, global_mean = train_svd(
+            users[train], items[train], ratings[train], 40, 20, n_factors=5, n_epochs=200, lr=0.05, batch_size=64,
+        )
+        predictions = (
+            global_mean + arrays['bu'][users] + arrays['bi'][items]
+            + np.einsum('ij,ij->i', arrays['pu'][users], arrays['qi'][items])
+        )
+        # Held out ratings are told apart too
+        held_out = ~train
+        high = held_out & (ratings == 5)
+        low = held_out & (ratings == 1)
+        self.assertGreater(predictions[high].min(), predictions[low].max())
+
+    def test_training_is_reproducible(self):
+        users, items, ratings = self.skewed_interactions()
+        first, _ = train_svd(users, items, ratings, 1000, 500, n_factors=5, n_epochs=2)
+        second, _ = train_svd(users, items, ratings, 1000, 500, n_factors=5, n_epochs=2)
+        for name in first:
+            np.testing.assert_array_equal(first[name], second[name])
+
+    def test_interaction_matrix_keeps_the_highest_rating(self):
+        matrix = InteractionMatrix()
+        matrix.add(np.array([7, 7, 8]), np.array([100, 200, 100]), np.array([4, 4, 4], np.float32))
+        matrix.add(np.array([7, 8]), np.array([100, 100]), np.array([5, 3], np.float32))
+        users, items, ratings = matrix.arrays()
+
+        self.assertEqual(matrix.user_ids, [7, 8])
+        self.assertEqual(matrix.item_ids, [100, 200])
+        triplets = {(matrix.user_ids[u], matrix.item_ids[i]): r for u, i, r in zip(users, items, ratings)}
+        self.assertEqual(triplets, {(7, 100): 5, (7, 200): 4, (8, 100): 4})
+
+    def test_non_finite_arrays_are_not_saved(self):
+        arrays = {name: np.zeros((2, 2), np.float32) for name in ('pu', 'qi')}
+        arrays.update(bu=np.zeros(2, np.float32), bi=np.array([0, np.nan], np.float32))
+        with tempfile.TemporaryDirectory() as root:
+            with self.assertRaises(ValueError):
+                save_artifact(root, 'v1', arrays, [1, 2], [1, 2], {})
+            self.assertEqual(os.listdir(root), [])
+
+
+class InteractionsTest(TestCase):
+    def test_borrows_and_likes_are_streamed_in_chunks(self):
+        books = [Book.objects.create(title=f'Book {i}', description='', isbn=f'{i:013d}') for i in range(3)]
+        user = User.objects.create_user('reader')
+        for book in books:
+            Borrow.objects.create(book=book, user=user, borrow_date=date(2024, 1, 1), return_date=date(2024, 2, 1))
+        Borrow.objects.create(book=None, user=user, borrow_date=date(2024, 1, 1), return_date=date(2024, 2, 1))
+        user.profile.liked_books.add(books[0])
+
+        chunks = list(iter_interactions(chunk_size=2))
+        self.assertEqual([len(chunk[0]) for chunk in chunks], [2, 1, 1])
+        rows = sorted((int(u), int(b), float(r)) for chunk in chunks for u, b, r in zip(*chunk))
+        self.assertEqual(rows, sorted(
+            [(user.id, book.id, BORROWED_RATING) for book in books] + [(user.id, books[0].id, LIKED_RATING)]
+        ))
+
+
+class ImportRecordsTest(TestCase):
+    def records(self, count, start=0):
+        return [
+            {'title': f'Book {i}', 'isbn': f'{i:013d}', 'author': f'Author {i % 3}', 'genres': ['Fiction', f'Genre {i % 2}']}
+            for i in range(start, start + count)
+        ]
+
+    def test_books_authors_and_genres_are_created(self):
+        self.assertEqual(import_records(self.records(4)), 4)
+
+        self.assertEqual(Book.objects.count(), 4)
+        self.assertEqual(Author.objects.count(), 3)
+        self.assertEqual(set(Genre.objects.values_list('name', flat=True)), {'Fiction', 'Genre 0', 'Genre 1'})
+        book = Book.objects.get(isbn=f'{3:013d}')
+        self.assertEqual((book.quantity, book.available), (DEFAULT_QUANTITY, DEFAULT_QUANTITY))
+        self.assertEqual(list(book.authors.values_list('full_name', flat=True)), ['Author 0'])
+        self.assertEqual(set(book.genres.values_list('name', flat=True)), {'Fiction', 'Genre 1'})
+
+    def test_last_record_wins_for_a_repeated_isbn(self):
+        first, second = self.records(1) * 2
+        second = {**second, 'title': 'Second', 'author': 'Other'}
+
+        self.assertEqual(import_records([first, second]), 1)
+        book = Book.objects.get()
+        self.assertEqual(book.title, 'Second')
+        self.assertEqual(list(book.authors.values_list('full_name', flat=True)), ['Other'])
+
+    def test_existing_books_keep_their_data_and_gain_links(self):
+        import_records(self.records(2))
+        Book.objects.filter(isbn=f'{0:013d}').update(title='Edited', quantity=3)
+        record = {**self.records(1)[0], 'title': 'Renamed', 'author': 'New author', 'genres': ['Poetry']}
+
+        self.assertEqual(import_records([record]), 0)
+        book = Book.objects.get(isbn=f'{0:013d}')
+        self.assertEqual((book.title, book.quantity), ('Edited', 3))
+        self.assertEqual(set(book.authors.values_list('full_name', flat=True)), {'Author 0', 'New author'})
+        self.assertEqual(set(book.genres.values_list('name', flat=True)), {'Fiction', 'Genre 0', 'Poetry'})
+
+    def test_query_count_does_not_grow_with_the_chunk(self):
+        with CaptureQueriesContext(connection) as small:
+            import_records(self.records(3))
+        # New authors and genres too, so both chunks take the same path
+        records = [
+            {**record, 'author': f'Large {record["author"]}', 'genres': [f'Large {name}' for name in record['genres']]}
+            for record in self.records(30, start=3)
+        ]
+        with CaptureQueriesContext(connection) as large:
+            import_records(records)
+
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(Book.objects.count(), 33)
+
+    def test_empty_chunk_runs_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(import_records([]), 0)
+
+
+class ParseChunksTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'books.csv')
+        with open(self.path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['title', 'isbn', 'authors', 'genres'])
+            for i in range(7):
+                writer.writerow([f'Book {i}', f'{i:013d}', f'Author {i}', repr(['Fiction'])])
+
+    def titles(self, chunks):
+        return [[row['title'] for row in rows] for rows in chunks]
+
+    def test_csv_is_read_in_chunks(self):
+        self.assertEqual(
+            self.titles(iter_csv_chunks(self.path, 3)),
+            [['Book 0', 'Book 1', 'Book 2'], ['Book 3', 'Book 4', 'Book 5'], ['Book 6']],
+        )
+        # ISBNs keep their leading zeros
+        self.assertEqual(next(iter_csv_chunks(self.path, 1))[0]['isbn'], '0000000000000')
+
+    def test_start_row_and_limit(self):
+        self.assertEqual(self.titles(iter_csv_chunks(self.path, 2, start_row=3, limit=3)), [['Book 3', 'Book 4'], ['Book 5']])
+        self.assertEqual(self.titles(iter_csv_chunks(self.path, 2, start_row=6)), [['Book 6']])
+        self.assertEqual(list(iter_csv_chunks(self.path, 2, limit=0)), [])
+
+    def test_unparseable_rows_are_reported(self):
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Bad genres', '1234567890123', 'Author', 'Fiction, Poetry'])
+            writer.writerow(['No isbn', '', 'Author', repr(['Fiction'])])
+        rows = [row for rows in iter_csv_chunks(self.path, 100) for row in rows]
+
+        records, errors = parse_rows(rows)
+        self.assertEqual(len(records), 7)
+        self.assertEqual([title for title, _ in errors], ['Bad genres', 'No isbn'])
+        self.assertEqual(
+            records[0], {'title': 'Book 0', 'isbn': '0000000000000', 'author': 'Author 0', 'genres': ['Fiction']},
+        )
+
+    def test_worker_processes_yield_the_same_chunks_in_order(self):
+        serial = list(parse_chunks(iter_csv_chunks(self.path, 2)))
+        parallel = list(parse_chunks(iter_csv_chunks(self.path, 2), workers=2))
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual([row_count for _, _, row_count in parallel], [2, 2, 2, 1])
+        self.assertEqual([record['isbn'] for records, _, _ in parallel for record in records], [f'{i:013d}' for i in range(7)])
+
+
+class BorrowListQueriesTest(APITestCase):
+    def setUp(self):
+        self.librarian = User.objects.create_user('librarian', password='password')
+        self.librarian.profile.type = 'LIBRARIAN'
+        self.librarian.profile.save()
+        self.client.force_authenticate(self.librarian)
+
+    def create_borrows(self, count):
+        for i in range(count):
+            book = Book.objects.create(title=f'Book {i}', description='', isbn=f'{Book.objects.count():013d}')
+            user = User.objects.create_user(f'reader{User.objects.count()}', first_name='Reader', last_name=str(i))
+            Borrow.objects.create(book=book, user=user, borrow_date=date(2024, 1, 1), return_date=date(2024, 2, 1))
+
+    def count_list_queries(self):
+        # Fresh user object so nothing cached on it from the previous request is reused
+        self.client.force_authenticate(User.objects.get(pk=self.librarian.pk))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/library/borrows/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.create_borrows(2)
+        few = self.count_list_queries()
+        self.create_borrows(20)
+        many = self.count_list_queries()
+        self.assertEqual(few, many)
+
+    def test_list_includes_book_and_user(self):
+        self.create_borrows(1)
+        response = self.client.get('/api/library/borrows/')
+        borrow = response.data['results'][0]
+        self.assertEqual(borrow['book']['title'], 'Book 0')
+        self.assertEqual(borrow['user_full_name'], 'Reader 0')
+
+
+class BookPaginationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reader', password='password')
+        self.client.force_authenticate(self.user)
+        for i in range(5):
+            Book.objects.create(title=f'Book {i}', description='', isbn=f'{i:013d}')
+
+    def test_page_number_pagination(self):
+        response = self.client.get('/api/library/books/', {'page_size': 2, 'page': 2})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual([book['title'] for book in response.data['results']], ['Book 2', 'Book 3'])
+
+    def test_cursor_pagination_walks_all_books_by_id(self):
+        titles = []
+        response = self.client.get('/api/library/books/', {'pagination': 'cursor', 'page_size': 2})
+        while True:
+            self.assertNotIn('count', response.data)
+            titles += [book['title'] for book in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(titles, [f'Book {i}' for i in range(5)])
+
+
+class BookSearchTest(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create_user('reader', password='password'))
+        self.dune = Book.objects.create(title='Dune', description='Desert planet and spice', isbn='0000000000001')
+        self.dune.authors.add(Author.objects.create(full_name='Frank Herbert'))
+        Book.objects.create(title='Spice Route', description='A history of the spice trade', isbn='0000000000002')
+
+    def search(self, q):
+        response = self.client.get('/api/library/books/', {'q': q})
+        return [book['title'] for book in response.data['results']]
+
+    def test_search_matches_title_description_and_authors(self):
+        self.assertEqual(self.search('herbert'), ['Dune'])
+        self.assertEqual(self.search('desert'), ['Dune'])
+        self.assertEqual(sorted(self.search('spice')), ['Dune', 'Spice Route'])
+
+    def test_search_follows_author_changes(self):
+        author = self.dune.authors.get()
+        author.full_name = 'Brian Herbert'
+        author.save()
+        self.assertEqual(self.search('brian'), ['Dune'])
+        self.dune.authors.clear()
+        self.assertEqual(self.search('herbert'), [])
+
+    def test_search_forgets_deleted_authors(self):
+        self.dune.authors.get().delete()
+        self.assertEqual(self.search('herbert'), [])
+        self.assertEqual(self.search('dune'), ['Dune'])
+
+    def test_search_ignores_query_syntax(self):
+        self.assertEqual(self.search('"dune AND OR ('), [])
+
+
+class BookDetailWritesTest(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user('admin', password='password')
+        self.admin.profile.type = 'ADMIN'
+        self.admin.profile.save()
+        self.client.force_authenticate(self.admin)
+
+    def create_book(self, isbn, authors, genres):
+        self.client.force_authenticate(User.objects.get(pk=self.admin.pk))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/library/books/', {
+                'title': 'Book', 'description': 'Description', 'isbn': isbn,
+                'authors': [{'full_name': name} for name in authors],
+                'genres': [{'name': name} for name in genres],
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response, len(queries)
+
+    def test_create_query_count_does_not_grow_with_relations(self):
+        _, few = self.create_book('0000000000001', ['A1'], ['G1'])
+        _, many = self.create_book('0000000000002', [f'B{i}' for i in range(20)], [f'H{i}' for i in range(20)])
+        self.assertEqual(few, many)
+
+    def test_update_replaces_relations(self):
+        Author.objects.create(full_name='Kept')
+        response, _ = self.create_book('0000000000001', ['Kept', 'Removed'], ['Genre'])
+        book_id = response.data['id']
+        response = self.client.patch(f'/api/library/books/{book_id}/', {
+            'authors': [{'full_name': 'Kept'}, {'full_name': 'Added'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        book = Book.objects.get(pk=book_id)
+        self.assertEqual(sorted(book.authors.values_list('full_name', flat=True)), ['Added', 'Kept'])
+        self.assertEqual(list(book.genres.values_list('name', flat=True)), ['Genre'])
+        self.assertEqual(Author.objects.filter(full_name='Kept').count(), 1)
+
+
+class BulkEndpointsTest(APITestCase):
+    def setUp(self):
+        librarian = User.objects.create_user('librarian', password='password')
+        librarian.profile.type = 'LIBRARIAN'
+        librarian.profile.save()
+        self.client.force_authenticate(librarian)
+        self.reader = User.objects.create_user('reader', password='password')
+
+    def book_item(self, i, **extra):
+        return dict({'title': f'Book {i}', 'description': 'Description', 'isbn': f'{i:013d}'}, **extra)
+
+    def test_bulk_create_books(self):
+        items = [self.book_item(i, authors=[{'full_name': 'Shared'}], genres=[{'name': f'Genre {i % 2}'}]) for i in range(50)]
+        response = self.client.post('/api/library/books/bulk/', items, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['count'], 50)
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(Book.objects.get(isbn='0000000000003').genres.get().name, 'Genre 1')
+
+    def test_bulk_create_reports_errors_per_item_and_writes_nothing(self):
+        Book.objects.create(**self.book_item(1))
+        items = [self.book_item(0), self.book_item(1), self.book_item(2, title=''), self.book_item(0)]
+        response = self.client.post('/api/library/books/bulk/', items, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('isbn', response.data[1])
+        self.assertIn('title', response.data[2])
+        self.assertIn('isbn', response.data[3])
+        self.assertEqual(Book.objects.count(), 1)
+
+    def test_bulk_update_and_delete_books(self):
+        ids = self.client.post('/api/library/books/bulk/', [self.book_item(i) for i in range(3)], format='json').data['ids']
+        response = self.client.patch('/api/library/books/bulk/', [{'id': ids[0], 'quantity': 7}, {'id': ids[1], 'genres': [{'name': 'New'}]}], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Book.objects.get(pk=ids[0]).quantity, 7)
+        self.assertEqual(Book.objects.get(pk=ids[1]).genres.get().name, 'New')
+
+        response = self.client.delete('/api/library/books/bulk/', {'ids': ids[:2]}, format='json')
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(list(Book.objects.values_list('id', flat=True)), ids[2:])
+
+    def count_bulk_queries(self, count):
+        books = Book.objects.bulk_create([Book(**self.book_item(Book.objects.count() + i), quantity=2, available=2) for i in range(count)])
+        ids = [book.id for book in books]
+        queries = []
+        for method, url, data in (
+            ('patch', '/api/library/books/bulk/', [{'id': book_id, 'quantity': 3} for book_id in ids]),
+            ('post', '/api/library/borrows/bulk/', [
+                {'book_id': book_id, 'user_id': self.reader.id, 'borrow_date': '2024-01-01', 'return_date': '2024-02-01'}
+                for book_id in ids
+            ]),
+            ('delete', '/api/library/books/bulk/', {'ids': ids}),
+        ):
+            with CaptureQueriesContext(connection) as captured:
+                response = getattr(self.client, method)(url, data, format='json')
+            self.assertLess(response.status_code, 300, response.data)
+            queries.append(len(captured))
+        return queries
+
+    def test_bulk_query_count_does_not_grow_with_the_items(self):
+        # The first request also loads the librarian's profile
+        self.count_bulk_queries(1)
+        small = self.count_bulk_queries(2)
+        self.assertEqual(self.count_bulk_queries(20), small)
+
+    def test_bulk_delete_updates_search_and_copies_set_wise(self):
+        ids = self.client.post('/api/library/books/bulk/', [self.book_item(i) for i in range(3)], format='json').data['ids']
+        borrow = Borrow.objects.create(book_id=ids[0], user=self.reader, borrow_date=date(2024, 1, 1), return_date=date(2024, 2, 1))
+        self.client.delete('/api/library/books/bulk/', {'ids': ids[:2]}, format='json')
+
+        borrow.refresh_from_db()
+        self.assertIsNone(borrow.book_id)
+        self.assertEqual([book['id'] for book in self.client.get('/api/library/books/?q=Book').data['results']], ids[2:])
+
+    def test_bulk_create_and_return_borrows(self):
+        books = Book.objects.bulk_create([Book(**self.book_item(i), available=1) for i in range(3)])
+        items = [
+            {'book_id': book.id, 'user_id': self.reader.id, 'borrow_date': '2024-01-01', 'return_date': '2024-02-01'}
+            for book in books
+        ]
+        response = self.client.post('/api/library/borrows/bulk/', items, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.patch('/api/library/borrows/bulk/', [{'id': borrow_id, 'returned': True} for borrow_id in response.data['ids']], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Borrow.objects.filter(returned=False).exists())
+
+        response = self.client.post('/api/library/borrows/bulk/', items[:1] + [dict(items[1], book_id=0)], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('non_field_errors', response.data[0])
+        self.assertIn('book_id', response.data[1])
+
+    def test_bulk_genres_upsert(self):
+        Genre.objects.create(name='Existing')
+        response = self.client.post('/api/library/bulk-genres/', {'genres': [{'name': 'Existing'}, {'name': 'New'}]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([genre['name'] for genre in response.data], ['Existing', 'New'])
+        self.assertEqual(Genre.objects.count(), 2)
+
+    def test_genre_names_are_unique(self):
+        Genre.objects.create(name='Existing')
+        response = self.client.post('/api/library/genres/', {'name': 'Existing'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Genre.objects.count(), 1)
+
+
+class CheckoutTest(APITestCase):
+    def setUp(self):
+        librarian = User.objects.create_user('librarian', password='password')
+        librarian.profile.type = 'LIBRARIAN'
+        librarian.profile.save()
+        self.client.force_authenticate(librarian)
+        self.book = Book.objects.create(title='Book', description='', isbn='0000000000001', quantity=1)
+
+    def test_checkout_and_return_move_copies(self):
+        response = self.client.post('/api/library/borrows/checkout/', {'book_id': self.book.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.quantity, self.book.available), (1, 0))
+
+        reader = User.objects.create_user('reader')
+        response = self.client.post('/api/library/borrows/checkout/', {'book_id': self.book.id, 'user_id': reader.id}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+        borrow = Borrow.objects.get()
+        self.assertEqual(self.client.post(f'/api/library/borrows/{borrow.id}/return/').status_code, 200)
+        self.assertEqual(self.client.post(f'/api/library/borrows/{borrow.id}/return/').status_code, 409)
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.quantity, self.book.available), (1, 1))
+
+    def test_deleting_active_borrow_puts_copy_back(self):
+        borrow_id = self.client.post('/api/library/borrows/checkout/', {'book_id': self.book.id}, format='json').data['id']
+        self.client.delete(f'/api/library/borrows/{borrow_id}/')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 1)
+
+    def test_quantity_changes_keep_borrowed_copies_out(self):
+        self.client.post('/api/library/borrows/checkout/', {'book_id': self.book.id}, format='json')
+        url = f'/api/library/books/{self.book.id}/'
+
+        response = self.client.patch(url, {'quantity': 3}, format='json')
+        self.assertEqual((response.data['quantity'], response.data['available']), (3, 2))
+        self.assertEqual(self.client.patch(url, {'quantity': 0}, format='json').status_code, 409)
+
+        response = self.client.patch('/api/library/books/bulk/', [{'id': self.book.id, 'quantity': 1}], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.quantity, self.book.available), (1, 0))
+
+
+    def test_failed_version_bump_does_not_fail_the_checkout(self):
+        version_cache = response_cache.get_version_cache()
+        with (
+            mock.patch.object(version_cache, 'set', side_effect=OperationalError('database is locked')),
+            self.assertLogs('library.response_cache', 'ERROR'),
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            response = self.client.post('/api/library/borrows/checkout/', {'book_id': self.book.id}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 0)
+
+
+    def test_inventory_version_is_bumped_once_per_batch(self):
+        other = Book.objects.create(title='Other', description='', isbn='0000000000002', quantity=2)
+        version_cache = response_cache.get_version_cache()
+        with mock.patch.object(version_cache, 'set', wraps=version_cache.set) as set_version:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with transaction.atomic():
+                    inventory.adjust_copies({self.book.id: -1, other.id: -2})
+
+        self.assertEqual(len(callbacks), 1)
+        # Once right away and once after commit
+        self.assertEqual(set_version.call_count, 2)
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    copies = 5
+    attempts = 40
+
+    def test_concurrent_checkouts_never_oversubscribe(self):
+        book = Book.objects.create(title='Book', description='', isbn='0000000000001', quantity=self.copies)
+        users = [User.objects.create_user(f'reader{i}') for i in range(self.attempts)]
+
+        def borrow(user):
+            try:
+                while True:
+                    try:
+                        inventory.checkout(book_id=book.id, user=user, borrow_date=date(2024, 1, 1), return_date=date(2024, 2, 1))
+                        return True
+                    except inventory.NoCopiesAvailable:
+                        return False
+                    except OperationalError:
+                        # SQLite reports lock contention instead of waiting, try again
+                        continue
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(borrow, users))
+
+        # The database is the record, a thread's tally can't tell where a failure happened
+        book.refresh_from_db()
+        self.assertEqual((book.quantity, book.available), (self.copies, 0))
+        self.assertEqual(Borrow.objects.filter(book=book).count(), self.copies)
+
+
+class OverdueTest(APITestCase):
+    def setUp(self):
+        librarian = User.objects.create_user('librarian', password='password', first_name='Lib', last_name='Rarian')
+        librarian.profile.type = 'LIBRARIAN'
+        librarian.profile.save()
+        self.client.force_authenticate(librarian)
+        book = Book.objects.create(title='Book', description='', isbn='0000000000001')
+        self.overdue = Borrow.objects.create(book=book, user=librarian, borrow_date=date(2024, 1, 1), return_date=date(2024, 1, 15))
+        Borrow.objects.create(book=book, user=librarian, borrow_date=date(2024, 2, 1), return_date=date(2024, 2, 15), returned=True)
+        Borrow.objects.create(book=book, user=librarian, borrow_date=date.today(), return_date=date.today())
+
+    def test_overdue_action_lists_only_late_active_borrows(self):
+        response = self.client.get('/api/library/borrows/overdue/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([borrow['id'] for borrow in response.data['results']], [self.overdue.id])
+
+    def test_overdue_csv_is_written_in_batches(self):
+        Borrow.objects.create(book=self.overdue.book, user=self.overdue.user, borrow_date=date(2024, 1, 2), return_date=date(2024, 1, 16))
+        out = io.StringIO()
+        self.assertEqual(reports.write_overdue_csv(out, today=date(2024, 1, 20), batch_size=1), 2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(',')[-1], 'days_overdue')
+        self.assertEqual([line.split(',')[-1] for line in lines[1:]], ['5', '4'])
+
+
+class ExportTest(APITestCase):
+    def setUp(self):
+        librarian = User.objects.create_user('librarian', password='password')
+        librarian.profile.type = 'LIBRARIAN'
+        librarian.profile.save()
+        self.client.force_authenticate(librarian)
+        self.book = Book.objects.create(title='Book, with comma', description='', isbn='0000000000001')
+        self.book.authors.set([Author.objects.create(full_name='B'), Author.objects.create(full_name='A')])
+        Borrow.objects.create(book=self.book, user=librarian, borrow_date=date(2024, 1, 1), return_date=date(2024, 1, 15))
+
+    def test_books_csv(self):
+        response = self.client.get('/api/library/books/export/')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], reports.EXPORT_FIELDS['books'])
+        self.assertEqual(rows[1][1], 'Book, with comma')
+        self.assertEqual(rows[1][6], 'A|B')
+
+    def test_borrows_gzipped_ndjson(self):
+        response = self.client.get('/api/library/borrows/export/', {'file_format': 'ndjson', 'gzip': '1'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="borrows.ndjson.gz"')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(json.loads(lines[0])['book__title'], 'Book, with comma')
+        self.assertEqual(json.loads(lines[0])['return_date'], '2024-01-15')
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get('/api/library/books/export/', {'file_format': 'xml'}).status_code, 400)
+
+
+class BookResponseCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.librarian = User.objects.create_user('librarian', password='password')
+        self.librarian.profile.type = 'LIBRARIAN'
+        self.librarian.profile.save()
+        self.client.force_authenticate(self.librarian)
+        self.book = Book.objects.create(title='Book', description='', isbn='0000000000001', quantity=2)
+
+    def test_list_is_cached_and_revalidated(self):
+        response = self.client.get('/api/library/books/')
+        etag = response['ETag']
+        # Only the versions are read, from the shared cache table
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/library/books/').data, response.data)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/library/books/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.book.authors.add(Author.objects.create(full_name='Author'))
+        response = self.client.get('/api/library/books/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_evicted_version_does_not_revive_old_entries(self):
+        etag = self.client.get('/api/library/books/')['ETag']
+        response_cache.bump_catalogue_version()
+        response_cache.get_version_cache().delete(response_cache.CATALOGUE_VERSION_KEY)
+
+        response = self.client.get('/api/library/books/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_detail_follows_inventory(self):
+        url = f'/api/library/books/{self.book.id}/'
+        list_etag = self.client.get('/api/library/books/')['ETag']
+        self.assertEqual(self.client.get(url).data['available'], 2)
+
+        inventory.checkout(book=self.book, user=self.librarian, borrow_date=date(2024, 1, 1), return_date=date(2024, 1, 15))
+        self.assertEqual(self.client.get(url).data['available'], 1)
+        self.assertEqual(self.client.get('/api/library/books/', HTTP_IF_NONE_MATCH=list_etag).status_code, 304)
+
+    def test_errors_are_not_cached(self):
+        self.assertEqual(self.client.get('/api/library/books/999/').status_code, 404)
+        book = Book.objects.create(title='Other', description='', isbn='0000000000002')
+        Book.objects.filter(pk=book.pk).update(id=999)
+        self.assertEqual(self.client.get('/api/library/books/999/').status_code, 200)
+
+
+class BookReadModelTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        admin = User.objects.create_user('admin', password='password')
+        admin.profile.type = 'ADMIN'
+        admin.profile.save()
+        self.client.force_authenticate(admin)
+        response = self.client.post('/api/library/books/', {
+            'title': 'Book', 'description': 'Description', 'isbn': '0000000000001', 'quantity': 1,
+            'authors': [{'full_name': 'Author', 'date_of_birth': '1950-01-02'}],
+            'genres': [{'name': 'Genre'}, {'name': 'Other'}],
+        }, format='json')
+        self.book = Book.objects.get(pk=response.data['id'])
+        self.url = f'/api/library/books/{self.book.id}/'
+
+    def test_detail_is_a_single_query_with_the_same_payload(self):
+        with self.settings(LIBRARY_BOOK_READ_MODEL=False):
+            joined = self.client.get(self.url).data
+        cache.clear()
+        # The read model row, and the versions from the shared cache table
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data, joined)
+        self.assertEqual(response.data['authors'][0]['date_of_birth'], '1950-01-02')
+
+    def test_renames_and_deletes_are_synced(self):
+        author = Author.objects.get(full_name='Author')
+        author.full_name = 'Renamed'
+        author.save()
+        Genre.objects.get(name='Other').delete()
+        self.book.refresh_from_db()
+        self.assertEqual([a['full_name'] for a in self.book.related_data['authors']], ['Renamed'])
+        self.assertEqual([g['name'] for g in self.book.related_data['genres']], ['Genre'])
+
+    def test_clearing_from_the_genre_side_is_synced(self):
+        Genre.objects.get(name='Genre').books.clear()
+        self.book.refresh_from_db()
+        self.assertEqual([g['name'] for g in self.book.related_data['genres']], ['Other'])
+
+
+class AsyncRecommendationsTest(TransactionTestCase):
+    url = '/api/library/recommentations/async/'
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user('reader', password='password')
+        self.user_id = user.id
+        books = [Book.objects.create(title=f'Book {i}', description='', isbn=f'{i:013d}') for i in range(10)]
+        self.book_ids = [book.id for book in books]
+        user.profile.liked_books.add(books[0])
+        Borrow.objects.create(book=books[9], user=user, borrow_date=date(2024, 1, 1), return_date=date(2024, 1, 15))
+        access = self.client.post('/api/token/', {'username': 'reader', 'password': 'password'}).data['access']
+        self.headers = {'Authorization': f'Bearer {access}'}
+
+    def get(self):
+        return self.async_client.get(self.url, headers=self.headers)
+
+    async def test_concurrent_requests_share_one_scoring(self):
+        calls = []
+
+        def score_pool(user_id, liked_book_ids, excluded):
+            calls.append(excluded)
+            time.sleep(0.2)
+            return self.book_ids[1:4]
+
+        with mock.patch.object(BookRecommendationsView, 'score_pool', side_effect=score_pool):
+            responses = await asyncio.gather(*(self.get() for _ in range(5)))
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0], {self.book_ids[0], self.book_ids[9]})
+        for response in responses:
+            self.assertEqual(response['X-Recommendations-Source'], 'model')
+            self.assertEqual({book['id'] for book in response.json()}, set(self.book_ids[1:4]))
+
+    async def test_timeout_falls_back_to_popular_books(self):
+        # The most borrowed book is one the user already borrowed, so it's left out
+        other = await User.objects.acreate(username='other')
+        for book_id in (self.book_ids[9], self.book_ids[7]):
+            await Borrow.objects.acreate(book_id=book_id, user=other, borrow_date=date(2024, 1, 1), return_date=date(2024, 1, 15))
+        with self.settings(RECOMMENDER_ASYNC_TIMEOUT=0.05), \
+                mock.patch.object(BookRecommendationsView, 'score_pool', side_effect=lambda *args: time.sleep(0.5) or []):
+            response = await self.get()
+        self.assertEqual(response['X-Recommendations-Source'], 'popular')
+        self.assertEqual([book['id'] for book in response.json()], [self.book_ids[7]])
+
+    async def test_timeout_serves_the_last_cached_pool(self):
+        with mock.patch.object(BookRecommendationsView, 'score_pool', return_value=self.book_ids[1:3]):
+            await self.get()
+        await Profile.liked_books.through.objects.acreate(profile_id=await Profile.objects.values_list('id', flat=True).aget(user_id=self.user_id), book_id=self.book_ids[5])
+
+        with self.settings(RECOMMENDER_ASYNC_TIMEOUT=0.05), \
+                mock.patch.object(BookRecommendationsView, 'score_pool', side_effect=lambda *args: time.sleep(0.5) or []):
+            response = await self.get()
+        self.assertEqual(response['X-Recommendations-Source'], 'cache')
+        self.assertEqual({book['id'] for book in response.json()}, set(self.book_ids[1:3]))
+
+    async def test_requires_a_token(self):
+        self.assertEqual((await self.async_client.get(self.url)).status_code, 401)
+
+
+class BenchmarkCommandsTest(APITestCase):
+    def test_seeding_is_deterministic_and_repeatable(self):
+        options = {'books': 30, 'users': 5, 'borrows': 60, 'likes': 20, 'stdout': io.StringIO()}
+        call_command('seed_library', **options)
+        first = list(Borrow.objects.order_by('id').values_list('book__isbn', 'user__username', 'borrow_date', 'returned'))
+        quantities = dict(Book.objects.values_list('id', 'available'))
+        call_command('seed_library', **options)
+
+        self.assertEqual(Book.objects.count(), 30)
+        self.assertEqual(User.objects.count(), 5)
+        self.assertEqual(list(Borrow.objects.order_by('id').values_list('book__isbn', 'user__username', 'borrow_date', 'returned')), first)
+        self.assertEqual(dict(Book.objects.values_list('id', 'available')), quantities)
+        for book in Book.objects.all():
+            self.assertEqual(book.available + book.borrow_set.filter(returned=False).count(), book.quantity)
+
+    def test_api_benchmark_reports_each_endpoint(self):
+        call_command('seed_library', books=10, users=2, borrows=10, likes=5, stdout=io.StringIO())
+        path = os.path.join(tempfile.mkdtemp(), 'results.json')
+        users = set(User.objects.values_list('username', flat=True))
+        call_command(
+            'benchmark_api', requests=3, concurrency=1, only=['books', 'book_detail', 'borrows'], json=path,
+            create_user=True, stdout=io.StringIO(),
+        )
+        with open(path) as f:
+            results = json.load(f)['results']
+        self.assertEqual(set(results), {'books', 'book_detail', 'borrows'})
+        self.assertEqual(results['borrows']['statuses'], {'200': 3})
+        self.assertIsNotNone(results['books']['p99_ms'])
+        # The temporary librarian is gone
+        self.assertEqual(set(User.objects.values_list('username', flat=True)), users)
+
+    def test_api_benchmark_refuses_to_create_a_librarian_unasked(self):
+        Book.objects.create(title='Book', description='', isbn='0000000000001')
+        with self.assertRaisesMessage(CommandError, '--create-user'):
+            call_command('benchmark_api', requests=1, stdout=io.StringIO())
+        with mock.patch('library.management.commands.benchmark_api.is_test_database', return_value=False):
+            with self.assertRaisesMessage(CommandError, 'Refusing'):
+                call_command('benchmark_api', requests=1, create_user=True, stdout=io.StringIO())
+        self.assertFalse(User.objects.exists())
+
+
+@override_settings(METRICS_TOKEN='secret')
+class MetricsTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user('reader', password='password')
+        access = self.client.post('/api/token/', {'username': 'reader', 'password': 'password'}).data['access']
+        self.headers = {'Authorization': f'Bearer {access}'}
+        self.client.force_authenticate(user)
+        Book.objects.create(title='Book', description='', isbn='0000000000001')
+        metrics.registry.reset()
+
+    def test_requests_are_labelled_by_route_with_query_counts(self):
+        self.client.get('/api/library/books/')
+        self.client.get('/api/library/books/')
+        body = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').content.decode()
+
+        self.assertIn('library_http_requests_total{route="book-list",method="GET",status="200"} 2', body)
+        self.assertIn('library_http_request_duration_seconds_count{route="book-list",method="GET"} 2', body)
+        # Versions, count and page on the first request, the second one only reads the versions
+        self.assertIn('library_db_queries_per_request_sum{route="book-list",method="GET"} 4', body)
+        self.assertIn('library_recommendation_cache_hits_total', body)
+
+    async def test_async_requests_are_measured(self):
+        response = await self.async_client.get('/api/library/books/', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        body = metrics.registry.render()
+        self.assertIn('library_http_requests_total{route="book-list",method="GET",status="200"} 1', body)
+        # Counted from the thread the view ran in: the user's status, versions, count and page
+        self.assertIn('library_db_queries_per_request_sum{route="book-list",method="GET"} 4', body)
+
+    def test_sampling_skips_query_instrumentation(self):
+        with self.settings(METRICS_SAMPLE_RATE=0):
+            self.client.get('/api/library/books/')
+        body = metrics.registry.render()
+        self.assertIn('library_http_requests_total{route="book-list",method="GET",status="200"} 1', body)
+        self.assertNotIn('library_db_queries_per_request_count{route="book-list"', body)
+
+    def test_slow_requests_log_top_statements(self):
+        with self.settings(METRICS_SLOW_REQUEST_MS=0), self.assertLogs('library_system.metrics', 'WARNING') as logs:
+            self.client.get('/api/library/books/')
+        self.assertIn('(book-list) 200', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_token_protects_the_endpoint(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    """The pooled SQLite backend on a scratch file, standing in for PostgreSQL."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'pool.sqlite3')
+        self.addCleanup(close_pools, 'pool_test')
+
+    def connections(self, **pool):
+        handler = ConnectionHandler({'default': {}, 'pool_test': {
+            'ENGINE': 'library_system.db.sqlite3', 'NAME': self.path,
+            'POOL': {'MIN_SIZE': 0, 'MAX_SIZE': 3, 'TIMEOUT': 5, **pool},
+        }})
+        self.addCleanup(handler.close_all)
+        return handler
+
+    def request(self, connection, sql, params=()):
+        # Like a request: query, then Django closes the connection when it's done
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+        finally:
+            connection.close()
+
+    def test_persistent_connections_are_refused_under_asgi(self):
+        databases = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'CONN_MAX_AGE': 60}}
+        with self.settings(DATABASES=databases, SERVER_INTERFACE='asgi'):
+            self.assertEqual([error.id for error in check_persistent_connections(None)], ['library_system.E002'])
+        with self.settings(DATABASES=databases, SERVER_INTERFACE='wsgi'):
+            self.assertEqual(check_persistent_connections(None), [])
+        databases['default']['CONN_MAX_AGE'] = 0
+        with self.settings(DATABASES=databases, SERVER_INTERFACE='asgi'):
+            self.assertEqual(check_persistent_connections(None), [])
+
+    def test_concurrent_threads_share_at_most_max_size_connections(self):
+        handler = self.connections()
+        self.request(handler['pool_test'], 'CREATE TABLE hits (thread INTEGER)')
+
+        def worker(number):
+            for _ in range(25):
+                self.request(handler['pool_test'], 'INSERT INTO hits VALUES (%s)', [number])
+            handler['pool_test'].close()
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(worker, range(8)))
+
+        self.assertEqual(self.request(handler['pool_test'], 'SELECT COUNT(*) FROM hits'), [(200,)])
+        pool = handler['pool_test'].pool
+        self.assertEqual(pool.stats.checkouts, 202)
+        self.assertLessEqual(pool.stats.opened, 3)
+        self.assertEqual(pool.stats.timeouts, 0)
+        self.assertEqual(pool.in_use, 0)
+        self.assertEqual(pool.stats.wait_seconds.count, 202)
+
+    def test_checkout_times_out_when_the_pool_is_exhausted(self):
+        handler = self.connections(MAX_SIZE=1, TIMEOUT=0.05)
+        holder = handler['pool_test']
+        holder.ensure_connection()
+
+        def other_thread():
+            with self.assertRaises(OperationalError):
+                handler['pool_test'].ensure_connection()
+
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(other_thread).result()
+        holder.close()
+        self.assertEqual(holder.pool.stats.timeouts, 1)
+        self.assertEqual(holder.pool.stats.waits, 0)
+        self.assertEqual(holder.pool.idle, 1)
+
+    def test_waiting_checkout_gets_the_released_connection(self):
+        handler = self.connections(MAX_SIZE=1)
+        holder = handler['pool_test']
+        holder.ensure_connection()
+        with ThreadPoolExecutor(1) as executor:
+            waiting = executor.submit(lambda: self.request(handler['pool_test'], 'SELECT 1'))
+            time.sleep(0.05)
+            holder.close()
+            self.assertEqual(waiting.result(), [(1,)])
+        self.assertEqual(holder.pool.stats.waits, 1)
+        self.assertEqual(holder.pool.stats.opened, 1)
+
+    def test_expired_and_broken_connections_are_replaced(self):
+        handler = self.connections(MAX_LIFETIME=0)
+        connection = handler['pool_test']
+        self.request(connection, 'SELECT 1')
+        self.request(connection, 'SELECT 1')
+        self.assertEqual(connection.pool.stats.opened, 2)
+        self.assertEqual(connection.pool.size, 0)
+
+        handler = self.connections(HEALTH_CHECK_AFTER=0)
+        connection = handler['pool_test']
+        close_pools('pool_test')
+        connection.ensure_connection()
+        raw = connection.connection
+        connection.close()
+        raw.close()
+        self.assertEqual(self.request(connection, 'SELECT 1'), [(1,)])
+        self.assertEqual(connection.pool.stats.failed_checks, 1)
+        self.assertEqual(connection.pool.stats.opened, 2)
+
+    def test_connections_in_a_transaction_are_not_reused(self):
+        handler = self.connections()
+        connection = handler['pool_test']
+        connection.set_autocommit(False)
+        connection.close()
+        self.assertEqual(connection.pool.stats.closed, 1)
+        self.assertEqual(connection.pool.idle, 0)
+
+    def test_pool_metrics_are_exported(self):
+        handler = self.connections(MIN_SIZE=2)
+        self.request(handler['pool_test'], 'SELECT 1')
+        body = metrics.registry.render()
+        labels = f'{{alias="pool_test",database="{self.path}"}}'
+        self.assertIn(f'library_db_pool_size{labels} 2', body)
+        self.assertIn(f'library_db_pool_idle{labels} 2', body)
+        self.assertIn(f'library_db_pool_checkouts_total{labels} 1', body)
+        self.assertIn(f'library_db_pool_wait_seconds_count{labels} 1', body)
+
+
+REPLICA = 'replica_test'
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA])
+class ReplicaRoutingTest(APITransactionTestCase):
+    """The test database as primary and a scratch SQLite file as its replica, replication left out."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Registered after the test database setup, which only knows the configured aliases
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.settings[REPLICA] = {
+            **connections['default'].settings_dict, 'NAME': os.path.join(cls.directory.name, 'replica.sqlite3'),
+        }
+        call_command('migrate', database=REPLICA, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        close_pools(REPLICA)
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        # The cache table isn't emptied between transaction test cases
+        get_pin_cache().clear()
+        self.librarian = User.objects.create_user('librarian', password='password')
+        self.librarian.profile.type = 'LIBRARIAN'
+        self.librarian.profile.save()
+        # The replica only has the user, so the genres listed show which database served them
+        User.objects.using(REPLICA).bulk_create([User(id=self.librarian.id, username='librarian')])
+        Profile.objects.using(REPLICA).bulk_create([Profile(user_id=self.librarian.id, type='LIBRARIAN')])
+        Genre.objects.create(name='Primary')
+        Genre.objects.using(REPLICA).create(name='Replica')
+        self.addCleanup(Genre.objects.using(REPLICA).all().delete)
+        self.addCleanup(User.objects.using(REPLICA).all().delete)
+        self.addCleanup(Profile.objects.using(REPLICA).all().delete)
+        access = self.client.post('/api/token/', {'username': 'librarian', 'password': 'password'}).data['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.headers = {'Authorization': f'Bearer {access}'}
+
+    def genre_names(self):
+        response = self.client.get('/api/library/genres/')
+        self.assertEqual(response.status_code, 200)
+        return [genre['name'] for genre in response.data['results']]
+
+    def test_reads_go_to_the_replica_until_the_user_writes(self):
+        self.assertEqual(self.genre_names(), ['Replica'])
+
+        self.assertEqual(self.client.post('/api/library/genres/', {'name': 'New'}).status_code, 201)
+        self.assertEqual(self.genre_names(), ['Primary', 'New'])
+
+        get_pin_cache().delete(pin_key(self.librarian.id))
+        self.assertEqual(self.genre_names(), ['Replica'])
+
+    def test_replicas_require_a_shared_pin_cache(self):
+        self.assertEqual(check_replica_pins(None), [])
+        locmem = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        with self.settings(CACHES={'default': locmem, 'shared': locmem}):
+            self.assertEqual([error.id for error in check_replica_pins(None)], ['library_system.E001'])
+
+    async def test_async_requests_are_routed_and_pinned(self):
+        async def genre_names():
+            response = await self.async_client.get('/api/library/genres/', headers=self.headers)
+            return [genre['name'] for genre in response.json()['results']]
+
+        self.assertEqual(await genre_names(), ['Replica'])
+        response = await self.async_client.post(
+            '/api/library/genres/', {'name': 'New'}, content_type='application/json', headers=self.headers,
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(await genre_names(), ['Primary', 'New'])
+
+    def test_cached_book_responses_are_rendered_from_the_primary(self):
+        Book.objects.create(title='Primary', description='', isbn='0000000000001')
+        response = self.client.get('/api/library/books/')
+        self.assertEqual([book['title'] for book in response.data['results']], ['Primary'])
+        # Uncached views still read from the replica
+        self.assertEqual(self.genre_names(), ['Replica'])
+
+    def test_unhealthy_replica_falls_back_to_the_primary(self):
+        with mock.patch.object(ReplicaSet, 'is_healthy', return_value=False):
+            self.assertEqual(self.genre_names(), ['Primary'])
+
+    def test_reads_from_replica_outside_requests(self):
+        with reads_from_replica() as alias:
+            self.assertEqual(alias, REPLICA)
+            self.assertEqual(list(Genre.objects.values_list('name', flat=True)), ['Replica'])
+        self.assertEqual(list(Genre.objects.values_list('name', flat=True)), ['Primary'])
+
+    def test_replicas_are_chosen_round_robin_and_checked_once_per_interval(self):
+        replicas = ReplicaSet(['first', 'second', 'down'], check_interval=60, max_lag=30)
+        with mock.patch.object(ReplicaSet, 'check', side_effect=lambda alias: alias != 'down') as check:
+            chosen = [replicas.choose() for _ in range(4)]
+        self.assertEqual(chosen, ['first', 'second', 'first', 'second'])
+        self.assertEqual(check.call_count, 3)
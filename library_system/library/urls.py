@@ -1,5 +1,5 @@
 from django.urls import path, include
-from .views import BookViewSet, AuthorViewSet, GenreViewSet, BorrowViewSet, BulkGenreView, BookRecommendationsView
+from .views import BookViewSet, AuthorViewSet, GenreViewSet, BorrowViewSet, BulkGenreView, AsyncBookRecommendationsView, BookRecommendationsView, RecommendationCacheStatsView
 from rest_framework.routers import DefaultRouter
 
 router = DefaultRouter()
@@ -13,4 +13,6 @@ urlpatterns = [
     path('', include(router.urls)),
     path('bulk-genres/', BulkGenreView.as_view(), name='bulk-genres'),
     path('recommentations/', BookRecommendationsView.as_view(), name='book_recommendations'),
+    path('recommentations/async/', AsyncBookRecommendationsView.as_view(), name='book_recommendations_async'),
+    path('recommentations/cache-stats/', RecommendationCacheStatsView.as_view(), name='recommendation_cache_stats'),
 ]
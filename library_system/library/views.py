@@ -1,36 +1,58 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db.models import Count
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework.exceptions import AuthenticationFailed
+from library_system.authentication import TokenUserAuthentication
 from library_system.permissions import IsLibrarian, IsAdmin
 from .models import Author, Book, Genre, Borrow
+from users.models import Profile
 from rest_framework import viewsets
-from .serializers import AuthorSerializer, GenreSerializer, BorrowSerializer, BookDetailSerializer, BookListSerializer, BulkGenreSerializer
+from .serializers import AuthorSerializer, GenreSerializer, BorrowSerializer, BookDetailReadSerializer, BookDetailSerializer, BookListSerializer, BulkGenreSerializer, BulkBookSerializer, BulkBorrowSerializer
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework import status
+from rest_framework.decorators import action
+from django.db import IntegrityError, transaction
 from rest_framework.views import APIView
-import os
-import pickle
+from . import inventory
+from . import reports, response_cache
+from .reports import overdue_borrows
+from .search import search_authors, search_books
+from .signals import books_deleted, deferring_book_deletes
+from .recommender import cache as recommendation_cache
+from .recommender import concurrency as recommendation_concurrency
+from .recommender.registry import get_registry, get_scorer
+from .recommender.similarity import get_neighbour_index
 import random
+from datetime import date, timedelta
 import pandas as pd
 
 class AuthorViewSet(viewsets.ModelViewSet):
-    queryset = Author.objects.all()
+    queryset = Author.objects.order_by('id')
     serializer_class = AuthorSerializer
     permission_classes = [IsLibrarian | IsAdmin]
 
     def get_queryset(self):
-        queryset = Author.objects.all()
+        queryset = Author.objects.order_by('id')
         full_name = self.request.query_params.get("full_name", None)
+        q = self.request.query_params.get("q", None)
         if full_name:
             queryset = queryset.filter(full_name__icontains=full_name)
+        if q:
+            queryset = search_authors(queryset, q)
         return queryset
     
 class GenreViewSet(viewsets.ModelViewSet):
-    queryset = Genre.objects.all()
+    queryset = Genre.objects.order_by('id')
     serializer_class = GenreSerializer
     permission_classes = [IsLibrarian | IsAdmin]
 
     def get_queryset(self):
-        queryset = Genre.objects.all()
+        queryset = Genre.objects.order_by('id')
         name = self.request.query_params.get("name", None)
         if name:
             queryset = queryset.filter(name__icontains=name)
@@ -45,8 +67,91 @@ class BulkGenreView(APIView):
             return Response(genre_serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
-class BookViewSet(viewsets.ModelViewSet):
-    queryset = Book.objects.all()
+class BulkMixin:
+    """
+    Adds ``<prefix>/bulk/`` to a viewset: POST a list to create, PATCH a list
+    of items with ``id`` to update, DELETE ``{"ids": [...]}`` to delete.
+    Each call is validated in one pass and written in one transaction.
+    """
+    bulk_serializer_class = None
+
+    @action(detail=False, methods=['post', 'patch', 'delete'], url_path='bulk')
+    def bulk(self, request, *args, **kwargs):
+        model = self.bulk_serializer_class.Meta.model
+        if request.method == 'DELETE':
+            return self.bulk_destroy(request, model)
+
+        if not isinstance(request.data, list):
+            return Response({"detail": "Expected a list of items."}, status=status.HTTP_400_BAD_REQUEST)
+
+        instance = None
+        if request.method == 'PATCH':
+            ids = [item.get('id') for item in request.data if isinstance(item, dict)]
+            instance = list(model.objects.filter(id__in=[i for i in ids if isinstance(i, int)]))
+
+        serializer = self.bulk_serializer_class(
+            instance,
+            data=request.data,
+            many=True,
+            partial=instance is not None,
+            max_length=settings.LIBRARY_MAX_BULK_ITEMS,
+            context=self.get_serializer_context(),
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            objects = serializer.save()
+        except IntegrityError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        response_status = status.HTTP_201_CREATED if instance is None else status.HTTP_200_OK
+        return Response({"count": len(objects), "ids": [obj.pk for obj in objects]}, status=response_status)
+
+    def bulk_destroy(self, request, model):
+        ids = request.data.get('ids') if isinstance(request.data, dict) else None
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            return Response({"ids": ["Expected a list of ids."]}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > settings.LIBRARY_MAX_BULK_ITEMS:
+            return Response({"ids": [f"Ensure this field has no more than {settings.LIBRARY_MAX_BULK_ITEMS} elements."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            deleted = self.perform_bulk_destroy(model.objects.filter(id__in=ids))
+        return Response({"count": deleted}, status=status.HTTP_200_OK)
+
+    def perform_bulk_destroy(self, queryset):
+        _, deleted = queryset.delete()
+        return deleted.get(queryset.model._meta.label, 0)
+
+class ExportMixin:
+    """
+    Adds ``<prefix>/export/``, streaming the filtered queryset as
+    ``?file_format=csv`` (default) or ``ndjson``, gzipped with ``?gzip=1``.
+    """
+    export_name = None
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        # ``format`` is taken by DRF's renderer negotiation
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in reports.EXPORT_FORMATS:
+            return Response({"message": f"Unknown file_format, use one of: {', '.join(reports.EXPORT_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        compress = request.query_params.get('gzip') in ('1', 'true')
+
+        queryset = self.filter_queryset(self.get_queryset())
+        filename = f'{self.export_name}.{file_format}'
+        response = StreamingHttpResponse(
+            reports.stream_export(self.export_name, queryset, file_format, compress, settings.LIBRARY_EXPORT_CHUNK_SIZE),
+            content_type='application/gzip' if compress else reports.EXPORT_FORMATS[file_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="{filename}{".gz" if compress else ""}"'
+        return response
+
+class BookViewSet(ExportMixin, BulkMixin, viewsets.ModelViewSet):
+    queryset = Book.objects.order_by('id')
+    # List and retrieve authenticate from the token claims without loading the User
+    authentication_classes = [TokenUserAuthentication]
+    bulk_serializer_class = BulkBookSerializer
+    export_name = 'books'
     permission_classes = [IsLibrarian | IsAdmin]
 
     def get_permissions(self):
@@ -59,21 +164,45 @@ class BookViewSet(viewsets.ModelViewSet):
     def get_serializer_class(self):
         if self.action == 'list':
             return BookListSerializer
+        if self.action == 'retrieve' and settings.LIBRARY_BOOK_READ_MODEL:
+            return BookDetailReadSerializer
         return BookDetailSerializer
 
     def get_queryset(self):
         queryset = super().get_queryset()
+        if self.action == 'list':
+            # Only what BookListSerializer shows, the read model and description can be large
+            queryset = queryset.only('id', 'title', 'isbn')
+        elif self.action == 'retrieve' and not settings.LIBRARY_BOOK_READ_MODEL:
+            # Nested authors and genres in two queries whatever the number of books
+            queryset = queryset.prefetch_related('authors', 'genres')
         title = self.request.query_params.get('title', None)
         isbn = self.request.query_params.get('isbn', None)
         genres = self.request.query_params.getlist('genres', None)
+        q = self.request.query_params.get('q', None)
         if title:
             queryset = queryset.filter(title__icontains=title)
         if isbn:
             queryset = queryset.filter(isbn=isbn)
         if genres:
             queryset = queryset.filter(genres__name__in=genres).distinct()
+        if q:
+            queryset = search_books(queryset, q)
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        # The list shows no quantities, checkouts don't invalidate it
+        return response_cache.cached_response(
+            request, lambda: super(BookViewSet, self).list(request, *args, **kwargs),
+            [response_cache.CATALOGUE_VERSION_KEY],
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return response_cache.cached_response(
+            request, lambda: super(BookViewSet, self).retrieve(request, *args, **kwargs),
+            [response_cache.CATALOGUE_VERSION_KEY, response_cache.INVENTORY_VERSION_KEY],
+        )
+
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -100,13 +229,28 @@ class BookViewSet(viewsets.ModelViewSet):
         self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class BorrowViewSet(viewsets.ModelViewSet):
-    queryset = Borrow.objects.all()
+    def perform_bulk_destroy(self, queryset):
+        # Cascades run set-wise, the search index, recommendations and response cache are updated once
+        book_ids = list(queryset.values_list('id', flat=True))
+        with deferring_book_deletes():
+            deleted = super().perform_bulk_destroy(Book.objects.filter(id__in=book_ids))
+        books_deleted.send(sender=Book, book_ids=book_ids, using=queryset.db)
+        return deleted
+
+class BorrowViewSet(ExportMixin, BulkMixin, viewsets.ModelViewSet):
+    queryset = Borrow.objects.order_by('id')
     serializer_class = BorrowSerializer
+    bulk_serializer_class = BulkBorrowSerializer
+    export_name = 'borrows'
     permission_classes = [IsLibrarian | IsAdmin]
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        # Fetch the nested book and user in the same query, only with the columns the serializer reads
+        queryset = super().get_queryset().select_related('book', 'user').only(
+            'id', 'borrow_date', 'return_date', 'returned',
+            'book__id', 'book__title', 'book__isbn',
+            'user__id', 'user__first_name', 'user__last_name',
+        )
         book_title = self.request.query_params.get("book_title", None)
         user_full_name = self.request.query_params.get("user_full_name", None)
         if book_title:
@@ -143,38 +287,61 @@ class BorrowViewSet(viewsets.ModelViewSet):
         self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def perform_destroy(self, instance):
+        inventory.delete_borrows(Borrow.objects.filter(pk=instance.pk))
+
+    def perform_bulk_destroy(self, queryset):
+        return inventory.delete_borrows(queryset)
+
+    @action(detail=False, methods=['post'])
+    def checkout(self, request, *args, **kwargs):
+        """Borrow a copy of a book, by default for the requesting user, today, for the standard loan period."""
+        data = request.data.copy()
+        today = date.today()
+        data.setdefault('user_id', request.user.id)
+        data.setdefault('borrow_date', today)
+        data.setdefault('return_date', today + timedelta(days=settings.LIBRARY_LOAN_DAYS))
+        serializer = self.get_serializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'])
+    def overdue(self, request, *args, **kwargs):
+        """Active borrows past their return date, with the same filters as the list."""
+        queryset = overdue_borrows(queryset=self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(queryset, many=True).data)
+
+    @action(detail=True, methods=['post'], url_path='return')
+    def return_book(self, request, *args, **kwargs):
+        borrow = self.get_object()
+        if not inventory.set_returned(borrow, True):
+            return Response({"message": "Borrow already returned"}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(borrow).data, status=status.HTTP_200_OK)
+
 class BookRecommendationsView(APIView):
     permission_classes = [IsAuthenticated]
+    # Size of the top-scored pool the final recommendations are sampled from
+    candidate_pool_size = 25
 
     def get(self, request, *args, **kwargs):
         user = request.user
-        # Get the last 5 liked books of the user
-        liked_books = user.profile.liked_books.all().order_by('-id')[:5]
+        liked_book_ids = list(user.profile.liked_books.order_by('-id').values_list('id', flat=True))
 
-        if not liked_books.exists():
+        if not liked_book_ids:
             return Response({"message": "No liked books found"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Load the recommendation model
-        model_path = os.path.join(settings.BASE_DIR, 'library', 'recommender', 'book_recommender_model.pkl')
-        with open(model_path, 'rb') as f:
-            recommender_model = pickle.load(f)
-
-        # Get all books
-        all_books = Book.objects.all()
-
-        # Get recommendations based on the liked books
-        recommendations = []
-        for book in liked_books:
-            try:
-                book_recommendations = self.get_recommendations_for_book(recommender_model, user.id, book.id, all_books)
-                recommendations.extend(book_recommendations)
-            except Exception as e:
-                print(f"Error recommending for book {book.title}: {e}")
+        recommendations = recommendation_cache.get_or_compute(
+            user.id, liked_book_ids, lambda: self.get_recommendation_pool(user, liked_book_ids)
+        )
 
         if not recommendations:
             return Response({"message": "No recommendations available"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Select 5 random recommendations from the collected recommendations
+        # Select 5 random recommendations from the top scored books
         final_recommendations = random.sample(recommendations, min(5, len(recommendations)))
 
         # Get the book objects for the recommendations
@@ -182,14 +349,123 @@ class BookRecommendationsView(APIView):
         serializer = BookListSerializer(recommended_books, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-    def get_recommendations_for_book(self, model, user_id, book_id, all_books):
-        book_recommendations = []
-        for other_book in all_books:
-            if other_book.id != book_id:
-                predicted_rating = model.predict(user_id, other_book.id).est
-                book_recommendations.append((other_book.id, predicted_rating))
-        
-        # Sort by predicted rating and get top 5 recommendations
-        book_recommendations.sort(key=lambda x: x[1], reverse=True)
-        top_recommendations = [book_id for book_id, _ in book_recommendations[:5]]
-        return top_recommendations
+    def get_recommendation_pool(self, user, liked_book_ids):
+        borrowed_book_ids = Borrow.objects.filter(user=user).values_list('book_id', flat=True)
+        excluded = set(liked_book_ids)
+        excluded.update(borrowed_book_ids)
+        return self.score_pool(user.id, liked_book_ids, excluded)
+
+    @classmethod
+    def score_pool(cls, user_id, liked_book_ids, excluded):
+        pool = []
+        neighbour_index = get_neighbour_index()
+        if neighbour_index is not None:
+            # Merge the precomputed neighbours of the last 5 liked books
+            pool = neighbour_index.recommend(liked_book_ids[:5], cls.candidate_pool_size, exclude=excluded)
+        if len(pool) < cls.candidate_pool_size:
+            # No index built yet, or new and isolated books with few neighbours: the model scores the rest
+            try:
+                scorer = get_scorer()
+            except FileNotFoundError:
+                if not pool:
+                    raise
+                return pool
+            pool += scorer.top_k(user_id, cls.candidate_pool_size - len(pool), exclude=set(excluded) | set(pool))
+        return pool
+
+
+class AsyncBookRecommendationsView(View):
+    """
+    The recommendations endpoint for ASGI deployments.
+
+    Queries use the async ORM and scoring runs in the recommender thread
+    pool, so a slow model load or scoring never blocks the event loop.
+    Concurrent requests from a user with the same likes share one
+    computation. If it takes longer than ``RECOMMENDER_ASYNC_TIMEOUT`` the
+    user's last cached pool is served, or failing that the most borrowed
+    books, while the computation finishes in the background for next time.
+
+    Both need one long-lived event loop, which is why the Procfile serves
+    ``library_system.asgi`` with uvicorn. Under WSGI every request gets its
+    own loop, closed when it returns: nothing is shared and timed out
+    computations are cancelled.
+    """
+    async def get(self, request, *args, **kwargs):
+        try:
+            # A new instance per request, authenticate() keeps per-request state on it
+            authenticated = await sync_to_async(TokenUserAuthentication().authenticate)(request)
+        except AuthenticationFailed as exc:
+            return JsonResponse({"detail": str(exc.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+        if authenticated is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=status.HTTP_401_UNAUTHORIZED)
+        user_id = authenticated[0].id
+
+        liked_book_ids = [
+            book_id async for book_id in Profile.liked_books.through.objects
+            .filter(profile__user_id=user_id).order_by('-book_id').values_list('book_id', flat=True)
+        ]
+        if not liked_book_ids:
+            return JsonResponse({"message": "No liked books found"}, status=status.HTTP_404_NOT_FOUND)
+
+        task = recommendation_concurrency.coalesce(
+            (user_id, recommendation_cache.liked_books_hash(liked_book_ids)),
+            lambda: recommendation_cache.aget_or_compute(
+                user_id, liked_book_ids, lambda: self.get_recommendation_pool(user_id, liked_book_ids)
+            ),
+        )
+        source = 'model'
+        try:
+            recommendations = await asyncio.wait_for(asyncio.shield(task), settings.RECOMMENDER_ASYNC_TIMEOUT)
+        except asyncio.TimeoutError:
+            recommendations = await recommendation_cache.aget_stale(user_id)
+            source = 'cache'
+            if not recommendations:
+                recommendations = await self.get_popular_pool(user_id, liked_book_ids)
+                source = 'popular'
+
+        if not recommendations:
+            return JsonResponse({"message": "No recommendations available"}, status=status.HTTP_404_NOT_FOUND)
+
+        final_recommendations = random.sample(recommendations, min(5, len(recommendations)))
+        books = [
+            book async for book in Book.objects.filter(id__in=final_recommendations).values('id', 'title', 'isbn')
+        ]
+        response = JsonResponse(books, safe=False)
+        response['X-Recommendations-Source'] = source
+        return response
+
+    async def get_excluded_book_ids(self, user_id, liked_book_ids):
+        # Liked and already borrowed books, like BookRecommendationsView
+        excluded = set(liked_book_ids)
+        excluded.update([
+            book_id async for book_id in Borrow.objects.filter(user_id=user_id).values_list('book_id', flat=True)
+        ])
+        return excluded
+
+    async def get_recommendation_pool(self, user_id, liked_book_ids):
+        excluded = await self.get_excluded_book_ids(user_id, liked_book_ids)
+        return await recommendation_concurrency.run_in_executor(
+            BookRecommendationsView.score_pool, user_id, liked_book_ids, excluded
+        )
+
+    async def get_popular_pool(self, user_id, liked_book_ids):
+        cache = recommendation_cache.get_cache()
+        popular = await cache.aget(recommendation_cache.POPULAR_KEY)
+        if popular is None:
+            popular = [
+                book_id async for book_id in Borrow.objects.filter(book__isnull=False)
+                .values('book_id').annotate(borrows=Count('id')).order_by('-borrows', 'book_id')
+                .values_list('book_id', flat=True)[:BookRecommendationsView.candidate_pool_size * 2]
+            ]
+            await cache.aset(recommendation_cache.POPULAR_KEY, popular, settings.RECOMMENDER_CACHE_TIMEOUT)
+        excluded = await self.get_excluded_book_ids(user_id, liked_book_ids)
+        return [book_id for book_id in popular if book_id not in excluded][:BookRecommendationsView.candidate_pool_size]
+
+
+class RecommendationCacheStatsView(APIView):
+    permission_classes = [IsLibrarian | IsAdmin]
+
+    def get(self, request, *args, **kwargs):
+        data = recommendation_cache.stats.as_dict()
+        data['model'] = get_registry().info()
+        return Response(data, status=status.HTTP_200_OK)
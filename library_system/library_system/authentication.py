@@ -0,0 +1,69 @@
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+
+
+class UserStatusCache:
+    """
+    Short-lived, per-process record of which user ids are still active.
+
+    Lets stateless token users be rejected soon after their account is
+    deactivated or deleted without a User query on every request. Entries
+    expire after ``ttl`` seconds and are dropped at once in the process
+    that saves or deletes the user.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def is_active(self, user_id):
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        active = User.objects.filter(pk=user_id, is_active=True).exists()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[user_id] = (active, now + self.ttl)
+        return active
+
+    def forget(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+user_status_cache = UserStatusCache(settings.TOKEN_USER_CACHE_TTL)
+
+
+class TokenUserAuthentication(JWTAuthentication):
+    """
+    JWT authentication that skips the User row fetch on read-only requests.
+
+    GET, HEAD and OPTIONS get a ``TokenUser`` built from the token claims,
+    the user id and role being all read endpoints need. Other methods load
+    the full User as JWTAuthentication does.
+    """
+
+    def authenticate(self, request):
+        self.stateless = request.method in SAFE_METHODS
+        return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        if not self.stateless:
+            return super().get_user(validated_token)
+
+        user = JWTStatelessUserAuthentication.get_user(self, validated_token)
+        if not user_status_cache.is_active(user.id):
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        return user
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, Tags, Warning, register
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    if isinstance(caches[settings.SHARED_CACHE_ALIAS], LocMemCache):
+        return [Warning(
+            f'The {settings.SHARED_CACHE_ALIAS!r} cache is local to each process.',
+            hint=(
+                'Other worker processes will serve stale cached responses and keep honouring role '
+                'claims of demoted users. Use a database, Redis or Memcached cache.'
+            ),
+            id='library_system.W001',
+        )]
+    return []
+
+
+@register(Tags.caches, Tags.database)
+def check_replica_pins(app_configs, **kwargs):
+    if settings.DATABASE_REPLICAS and isinstance(caches[settings.SHARED_CACHE_ALIAS], LocMemCache):
+        return [Error(
+            f'DATABASE_REPLICAS need a {settings.SHARED_CACHE_ALIAS!r} cache shared between processes.',
+            hint=(
+                'Primary pins kept in a process-local cache are lost when the next request reaches '
+                'another worker, which then reads stale data from a replica. Use a database, Redis or '
+                'Memcached cache.'
+            ),
+            id='library_system.E001',
+        )]
+    return []
+
+
+@register(Tags.database)
+def check_persistent_connections(app_configs, **kwargs):
+    if settings.SERVER_INTERFACE != 'asgi':
+        return []
+    return [
+        Error(
+            f'Database {alias!r} keeps connections open across requests (CONN_MAX_AGE={options["CONN_MAX_AGE"]}) under ASGI.',
+            hint=(
+                'Sync views run in a new thread for each request, the connections they leave open are '
+                'never reused or closed until the server runs out of connections. Set CONN_MAX_AGE to 0, '
+                'or DB_POOL=True to reuse connections through the pool.'
+            ),
+            id='library_system.E002',
+        )
+        for alias, options in settings.DATABASES.items()
+        if options.get('CONN_MAX_AGE', 0) != 0
+    ]
@@ -0,0 +1,352 @@
+"""
+Connection pooling for the database backends in this package.
+
+Django 5.0 opens a connection on the first query of a request and closes it
+when the request finishes (``CONN_MAX_AGE = 0``). The backends in
+``library_system.db.postgresql`` and ``library_system.db.sqlite3`` keep
+that lifecycle, but ``get_new_connection()`` borrows a connection from a
+process-wide pool and closing it hands the connection back. A request then
+costs a pool checkout instead of a TCP and authentication handshake.
+
+Pools are configured with the ``POOL`` key of the database settings:
+
+    MIN_SIZE       connections opened when the pool is first used and kept
+                   open while idle
+    MAX_SIZE       connections open at once, checkouts beyond it wait
+    TIMEOUT        seconds a checkout waits before raising OperationalError
+    MAX_LIFETIME   seconds after which a connection is closed instead of reused
+    MAX_IDLE       seconds an idle connection above MIN_SIZE is kept
+    HEALTH_CHECKS  run ``SELECT 1`` on connections idle for longer than
+                   HEALTH_CHECK_AFTER seconds before handing them out
+
+There's one pool per alias and database name, so the test database gets its
+own. Every pool counts checkouts, waits and the time spent waiting,
+``library_system.metrics`` reports them at ``/metrics``.
+"""
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from library_system.metrics import Histogram
+
+DEFAULTS = {
+    'MIN_SIZE': 0,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 5,
+    'MAX_LIFETIME': 30 * 60,
+    'MAX_IDLE': 5 * 60,
+    'HEALTH_CHECKS': True,
+    'HEALTH_CHECK_AFTER': 1,
+}
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.opened = 0
+        self.closed = 0
+        self.failed_checks = 0
+        self.wait_seconds = Histogram(WAIT_BUCKETS)
+
+
+class _Entry:
+    __slots__ = ('connection', 'created_at', 'released_at')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = self.released_at = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    A bounded set of DB-API connections shared by every thread of the process.
+
+    ``acquire(connect)`` returns an idle connection or opens one with
+    ``connect()`` while under ``max_size``, otherwise it waits for a
+    ``release()``. Idle connections are reused last in, first out, so the
+    busiest ones stay warm and the rest age out through ``max_idle``.
+    """
+
+    def __init__(self, name, min_size=0, max_size=10, timeout=5, max_lifetime=None, max_idle=None,
+                 health_checks=True, health_check_after=1):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError(f'Invalid pool size {min_size}..{max_size} for {name}')
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.health_checks = health_checks
+        self.health_check_after = health_check_after
+        self.stats = PoolStats()
+        self._idle = deque()
+        self._in_use = {}
+        # Connections open or being opened, the figure bounded by max_size
+        self._size = 0
+        self._filled = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    @property
+    def in_use(self):
+        return len(self._in_use)
+
+    def acquire(self, connect):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        self._fill(connect)
+        while True:
+            with self._lock:
+                entry = None
+                while entry is None:
+                    if self._closed:
+                        raise PoolTimeout(f'Connection pool {self.name} is closed')
+                    if self._idle:
+                        entry = self._idle.pop()
+                    elif self._size < self.max_size:
+                        # Reserve the slot, the connection is opened outside the lock
+                        self._size += 1
+                        break
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.stats.timeouts += 1
+                            raise PoolTimeout(
+                                f'No connection available in pool {self.name} within {self.timeout}s '
+                                f'({self.max_size} in use)'
+                            )
+                        waited = True
+                        self._available.wait(remaining)
+
+            # Time spent queueing for a slot, opening or checking the connection isn't waiting
+            wait = time.monotonic() - started
+            if entry is None:
+                entry = self._open(connect)
+            elif not self._reusable(entry):
+                self._discard(entry)
+                continue
+
+            with self._lock:
+                self._in_use[id(entry.connection)] = entry
+                self.stats.checkouts += 1
+                self.stats.wait_seconds.observe(wait)
+                if waited:
+                    self.stats.waits += 1
+            return entry.connection
+
+    def release(self, connection):
+        """Hand ``connection`` back, closing it when it's past its lifetime or the pool is closed."""
+        with self._lock:
+            entry = self._in_use.pop(id(connection), None)
+        if entry is None:
+            # Not ours, e.g. the pool was replaced in between
+            _close_quietly(connection)
+            return
+        if self._closed or self._expired(entry, time.monotonic()):
+            self._discard(entry)
+            return
+        entry.released_at = time.monotonic()
+        with self._lock:
+            self._idle.append(entry)
+            stale = self._prune()
+            self._available.notify()
+        for stale_entry in stale:
+            self._discard(stale_entry)
+
+    def discard(self, connection):
+        """Close a connection that can't be reused, e.g. after a failed transaction or a broken socket."""
+        with self._lock:
+            entry = self._in_use.pop(id(connection), None)
+        if entry is None:
+            _close_quietly(connection)
+        else:
+            self._discard(entry)
+
+    def close(self):
+        """Close every idle connection, checked out ones are closed when released."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._available.notify_all()
+        for entry in idle:
+            self._discard(entry)
+
+    def _fill(self, connect):
+        if self._filled:
+            return
+        with self._lock:
+            if self._filled:
+                return
+            self._filled = True
+            missing = max(self.min_size - self._size, 0)
+            self._size += missing
+        entries = []
+        try:
+            for _ in range(missing):
+                entries.append(self._open(connect, reserved=False))
+        finally:
+            with self._lock:
+                # Slots whose connection failed to open are given back
+                self._size -= missing - len(entries)
+                self._idle.extend(entries)
+                self._available.notify(len(entries))
+
+    def _open(self, connect, reserved=True):
+        try:
+            connection = connect()
+        except BaseException:
+            if reserved:
+                with self._lock:
+                    self._size -= 1
+                    self._available.notify()
+            raise
+        with self._lock:
+            self.stats.opened += 1
+        return _Entry(connection)
+
+    def _reusable(self, entry):
+        now = time.monotonic()
+        if self._expired(entry, now):
+            return False
+        if self.health_checks and now - entry.released_at >= self.health_check_after:
+            try:
+                cursor = entry.connection.cursor()
+                try:
+                    cursor.execute('SELECT 1')
+                finally:
+                    cursor.close()
+            except Exception:
+                with self._lock:
+                    self.stats.failed_checks += 1
+                return False
+        return True
+
+    def _expired(self, entry, now):
+        return self.max_lifetime is not None and now - entry.created_at >= self.max_lifetime
+
+    def _prune(self):
+        # Called with the lock held. The oldest released connections are on the left.
+        stale = []
+        if self.max_idle is None:
+            return stale
+        now = time.monotonic()
+        while self._idle and self._size - len(stale) > self.min_size and now - self._idle[0].released_at >= self.max_idle:
+            stale.append(self._idle.popleft())
+        return stale
+
+    def _discard(self, entry):
+        _close_quietly(entry.connection)
+        with self._lock:
+            self._size -= 1
+            self.stats.closed += 1
+            self._available.notify()
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, database, settings_dict):
+    """The pool for ``alias`` connecting to ``database``, created on first use."""
+    key = (alias, database)
+    pool = _pools.get(key)
+    if pool is None or pool._closed:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None or pool._closed:
+                options = {**DEFAULTS, **settings_dict.get('POOL', {})}
+                pool = _pools[key] = ConnectionPool(
+                    f'{alias}:{database}',
+                    min_size=int(options['MIN_SIZE']),
+                    max_size=int(options['MAX_SIZE']),
+                    timeout=float(options['TIMEOUT']),
+                    max_lifetime=options['MAX_LIFETIME'],
+                    max_idle=options['MAX_IDLE'],
+                    health_checks=options['HEALTH_CHECKS'],
+                    health_check_after=float(options['HEALTH_CHECK_AFTER']),
+                )
+    return pool
+
+
+def all_pools():
+    """``{(alias, database): pool}`` for every open pool of this process."""
+    with _pools_lock:
+        return {key: pool for key, pool in _pools.items() if not pool._closed}
+
+
+def close_pools(alias=None):
+    with _pools_lock:
+        keys = [key for key in _pools if alias is None or key[0] == alias]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Mixed into a backend's ``DatabaseWrapper`` so its connections come from a ``ConnectionPool``.
+
+    Use it with ``CONN_MAX_AGE = 0``: Django still closes the connection at
+    the end of each request, which is what returns it to the pool.
+    """
+
+    pool_database_key = 'NAME'
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict[self.pool_database_key], self.settings_dict)
+
+    def get_new_connection(self, conn_params):
+        try:
+            return self.pool.acquire(partial(super().get_new_connection, conn_params))
+        except PoolTimeout as exc:
+            # Surfaces as django.db.OperationalError through wrap_database_errors
+            raise self.Database.OperationalError(str(exc)) from exc
+
+    def _close(self):
+        if self.connection is None:
+            return
+        pool = self.pool
+        # A connection closed mid-transaction, outside autocommit or after an error
+        # may carry state into the next request, so it's closed rather than reused
+        if (
+            self.in_atomic_block
+            or self.autocommit != self.settings_dict['AUTOCOMMIT']
+            or (self.errors_occurred and not self.is_usable())
+        ):
+            pool.discard(self.connection)
+        else:
+            pool.release(self.connection)
+
+
+class PooledDatabaseCreationMixin:
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep the test database busy
+        close_pools(self.connection.alias)
+        super()._destroy_test_db(test_database_name, verbosity)
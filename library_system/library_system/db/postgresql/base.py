@@ -0,0 +1,23 @@
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.creation import DatabaseCreation as BaseDatabaseCreation
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+from ..pool import PooledDatabaseCreationMixin, PooledDatabaseWrapperMixin
+
+
+class DatabaseCreation(PooledDatabaseCreationMixin, BaseDatabaseCreation):
+    pass
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """PostgreSQL with pooled connections."""
+
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        # Django reads the isolation level while opening a connection, a reused one skips that
+        self.isolation_level = IsolationLevel(
+            self.settings_dict['OPTIONS'].get('isolation_level', IsolationLevel.READ_COMMITTED)
+        )
+        return connection
@@ -0,0 +1,290 @@
+"""
+Read replica routing.
+
+``ReplicaRoutingMiddleware`` sends the reads of GET and HEAD requests to one
+of the ``DATABASE_REPLICAS``, picked round-robin among those that passed
+their last health check. Everything else reads from the primary, and every
+write goes to the primary. The choice is kept in a context variable for
+the duration of the request, so it follows the request into async views
+and ``sync_to_async`` calls.
+
+A request that writes pins its user to the primary for
+``DB_REPLICA_PIN_SECONDS``, so they read their own writes (liked books
+before recommendations, a borrow right after creating it) while the
+replicas catch up. Pins live in the shared cache (``SHARED_CACHE_ALIAS``)
+so they hold in every worker process, the system checks refuse replicas
+with a process-local one.
+
+Outside requests, ``reads_from_replica()`` routes the reads of a block, e.g.
+the recommender training commands. ``reads_from_primary()`` does the
+opposite for results shared with other users, such as cached responses.
+"""
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = ('GET', 'HEAD')
+
+# Seconds of replay lag, 0 when the replica has replayed everything it received or isn't a replica
+POSTGRES_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+
+class RoutingState:
+    __slots__ = ('read_alias', 'wrote')
+
+    def __init__(self, read_alias):
+        self.read_alias = read_alias
+        self.wrote = False
+
+
+_routing = ContextVar('db_routing', default=None)
+
+
+class ReplicaSet:
+    """Round-robin over the replicas that passed their latest health check."""
+
+    def __init__(self, aliases, check_interval, max_lag):
+        self.aliases = tuple(aliases)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._counter = itertools.count()
+        # alias: (healthy, checked at)
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """A healthy replica alias, or None when there is none."""
+        healthy = [alias for alias in self.aliases if self.is_healthy(alias)]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    def is_healthy(self, alias):
+        healthy, checked_at = self._health.get(alias, (None, None))
+        if checked_at is not None and time.monotonic() - checked_at < self.check_interval:
+            return healthy
+        with self._lock:
+            # Another thread may have checked while this one waited
+            healthy, checked_at = self._health.get(alias, (None, None))
+            if checked_at is None or time.monotonic() - checked_at >= self.check_interval:
+                healthy = self.check(alias)
+                self._health[alias] = (healthy, time.monotonic())
+        return healthy
+
+    def check(self, alias):
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(POSTGRES_LAG_SQL if connection.vendor == 'postgresql' else 'SELECT 0')
+                lag = float(cursor.fetchone()[0])
+        except DatabaseError as exc:
+            logger.warning('Replica %s is unavailable: %s', alias, exc)
+            return False
+        if lag > self.max_lag:
+            logger.warning('Replica %s is %.1fs behind, reading from the primary', alias, lag)
+            return False
+        return True
+
+
+_replicas = None
+
+
+def get_replicas():
+    global _replicas
+    aliases = tuple(settings.DATABASE_REPLICAS)
+    if _replicas is None or _replicas.aliases != aliases:
+        _replicas = ReplicaSet(aliases, settings.DB_REPLICA_CHECK_INTERVAL, settings.DB_REPLICA_MAX_LAG)
+    return _replicas
+
+
+# app_label of DatabaseCache entries, they live on the primary and writing them isn't a request write
+CACHE_APP_LABEL = 'django_cache'
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == CACHE_APP_LABEL:
+            return DEFAULT_DB_ALIAS
+        state = _routing.get()
+        return state.read_alias if state is not None else None
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None and model._meta.app_label != CACHE_APP_LABEL:
+            # The rest of the request reads what it wrote
+            state.wrote = True
+            state.read_alias = None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the primary's data, so objects from any of them can be related
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def pin_key(user_id):
+    return f'replica_pin:{user_id}'
+
+
+def get_pin_cache():
+    return caches[settings.SHARED_CACHE_ALIAS]
+
+
+def pin_to_primary(user_id):
+    get_pin_cache().set(pin_key(user_id), True, settings.DB_REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    return user_id is not None and get_pin_cache().get(pin_key(user_id)) is not None
+
+
+@contextmanager
+def reads_from_replica():
+    """Read from a healthy replica inside the block, or from the primary when there is none."""
+    alias = get_replicas().choose() if settings.DATABASE_REPLICAS else None
+    token = _routing.set(RoutingState(alias))
+    try:
+        yield alias
+    finally:
+        _routing.reset(token)
+
+
+@contextmanager
+def reads_from_primary():
+    """Read from the primary inside the block, e.g. to build a result other users are served from a cache."""
+    outer = _routing.get()
+    state = RoutingState(None)
+    token = _routing.set(state)
+    try:
+        yield
+    finally:
+        _routing.reset(token)
+        if state.wrote and outer is not None:
+            outer.wrote = True
+            outer.read_alias = None
+
+
+def _token_user_id(request):
+    parts = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(parts) != 2 or parts[0] not in api_settings.AUTH_HEADER_TYPES:
+        return None
+    try:
+        # Only a routing hint, the view's authentication verifies the token
+        return AccessToken(parts[1], verify=False).get(api_settings.USER_ID_CLAIM)
+    except TokenError:
+        return None
+
+
+def _request_user_id(request):
+    user_id = _token_user_id(request)
+    if user_id is None:
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            user_id = user.pk
+    return user_id
+
+
+def _route_stream(content, state):
+    # Streaming responses run their queries while being consumed, after the middleware returned
+    iterator = iter(content)
+    while True:
+        token = _routing.set(state)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _routing.reset(token)
+        yield chunk
+
+
+async def _aroute_stream(content, state):
+    iterator = aiter(content)
+    while True:
+        token = _routing.set(state)
+        try:
+            chunk = await anext(iterator)
+        except StopAsyncIteration:
+            return
+        finally:
+            _routing.reset(token)
+        yield chunk
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+
+        state, user_id = self.route(request)
+        token = _routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.finish(request, response, state, user_id)
+
+    async def __acall__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return await self.get_response(request)
+
+        # Pin lookups and health checks query the cache table and the replicas
+        state, user_id = await sync_to_async(self.route)(request)
+        token = _routing.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return await sync_to_async(self.finish)(request, response, state, user_id)
+
+    def route(self, request):
+        user_id = _request_user_id(request)
+        read_alias = None
+        if request.method in READ_METHODS and not is_pinned(user_id):
+            read_alias = get_replicas().choose()
+        return RoutingState(read_alias), user_id
+
+    def finish(self, request, response, state, user_id):
+        if state.wrote:
+            # DRF has replaced request.user with the authenticated user by now
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                user_id = user.pk
+            if user_id is not None:
+                pin_to_primary(user_id)
+        if response.streaming and state.read_alias is not None:
+            if response.is_async:
+                response.streaming_content = _aroute_stream(response.streaming_content, state)
+            else:
+                response.streaming_content = _route_stream(response.streaming_content, state)
+        return response
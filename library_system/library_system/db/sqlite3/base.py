@@ -0,0 +1,21 @@
+from django.db.backends.sqlite3 import base
+from django.db.backends.sqlite3.creation import DatabaseCreation as BaseDatabaseCreation
+
+from ..pool import PooledDatabaseCreationMixin, PooledDatabaseWrapperMixin
+
+
+class DatabaseCreation(PooledDatabaseCreationMixin, BaseDatabaseCreation):
+    pass
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """SQLite with pooled connections, a stand-in for PostgreSQL in local runs and tests."""
+
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        # An in-memory database lives as long as its connection and Django never
+        # closes one, so there is nothing to pool
+        if self.is_in_memory_db():
+            return base.DatabaseWrapper.get_new_connection(self, conn_params)
+        return super().get_new_connection(conn_params)
@@ -0,0 +1,317 @@
+"""
+Per-endpoint request metrics in Prometheus text format.
+
+``MetricsMiddleware`` times every request and labels it with the resolved
+URL name (``book-list``, ``borrow-detail``, ...) and HTTP method. For a
+sampled fraction of requests (``METRICS_SAMPLE_RATE``) it also counts
+database queries and their time, and times response rendering. Every
+connection gets one ``execute_wrapper`` reporting to the recorder of the
+request in the current context, which ``sync_to_async`` carries into the
+thread running an async request's queries. Requests slower than
+``METRICS_SLOW_REQUEST_MS`` are logged with their most expensive SQL.
+``metrics_view`` serves everything at ``/metrics`` to scrapers presenting
+``METRICS_TOKEN``.
+
+Metrics are kept per process. With several workers each one reports its
+own numbers, so scrape them individually or sum them in Prometheus.
+"""
+import hmac
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+UNRESOLVED_ROUTE = 'unresolved'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms keyed by label values."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.sampled = {}
+            self.latency = {}
+            self.query_counts = {}
+            self.query_seconds = {}
+            self.render_seconds = {}
+
+    def record(self, route, method, status, duration, queries=None, query_seconds=None, render_seconds=None):
+        with self._lock:
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault((route, method), Histogram(LATENCY_BUCKETS)).observe(duration)
+            if queries is None:
+                return
+            labels = (route, method)
+            self.sampled[labels] = self.sampled.get(labels, 0) + 1
+            self.query_counts.setdefault(labels, Histogram(QUERY_COUNT_BUCKETS)).observe(queries)
+            self.query_seconds[labels] = self.query_seconds.get(labels, 0) + query_seconds
+            self.render_seconds[labels] = self.render_seconds.get(labels, 0) + render_seconds
+
+    def render(self):
+        lines = []
+        with self._lock:
+            _counter(lines, 'library_http_requests_total', 'Requests handled', ('route', 'method', 'status'), self.requests)
+            _histogram(lines, 'library_http_request_duration_seconds', 'Request latency', ('route', 'method'), self.latency)
+            _counter(lines, 'library_http_requests_sampled_total', 'Requests with database and render timing', ('route', 'method'), self.sampled)
+            _histogram(lines, 'library_db_queries_per_request', 'Database queries per sampled request', ('route', 'method'), self.query_counts)
+            _counter(lines, 'library_db_query_seconds_total', 'Database time of sampled requests', ('route', 'method'), self.query_seconds)
+            _counter(lines, 'library_http_render_seconds_total', 'Response rendering time of sampled requests', ('route', 'method'), self.render_seconds)
+        _recommendation_cache(lines)
+        _connection_pools(lines)
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}'
+
+
+def _counter(lines, name, help_text, label_names, values):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} counter')
+    for label_values, value in sorted(values.items()):
+        lines.append(f'{name}{_labels(label_names, label_values)} {value}')
+
+
+def _histogram(lines, name, help_text, label_names, histograms):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for label_values, histogram in sorted(histograms.items()):
+        for bound, count in histogram.cumulative():
+            bucket_labels = _labels(label_names, label_values, 'le="%s"' % bound)
+            lines.append(f'{name}_bucket{bucket_labels} {count}')
+        bucket_labels = _labels(label_names, label_values, 'le="+Inf"')
+        lines.append(f'{name}_bucket{bucket_labels} {histogram.count}')
+        lines.append(f'{name}_sum{_labels(label_names, label_values)} {histogram.sum}')
+        lines.append(f'{name}_count{_labels(label_names, label_values)} {histogram.count}')
+
+
+def _recommendation_cache(lines):
+    from library.recommender import cache as recommendation_cache
+
+    stats = recommendation_cache.stats
+    for name, value in (('hits', stats.hits), ('misses', stats.misses)):
+        lines.append(f'# TYPE library_recommendation_cache_{name}_total counter')
+        lines.append(f'library_recommendation_cache_{name}_total {value}')
+
+
+def _connection_pools(lines):
+    from library_system.db.pool import all_pools
+
+    pools = all_pools()
+    labels = ('alias', 'database')
+    for name, help_text, value in (
+        ('size', 'Open connections', lambda pool: pool.size),
+        ('idle', 'Idle connections', lambda pool: pool.idle),
+        ('in_use', 'Checked out connections', lambda pool: pool.in_use),
+        ('max_size', 'Connection limit', lambda pool: pool.max_size),
+    ):
+        lines.append(f'# HELP library_db_pool_{name} {help_text}')
+        lines.append(f'# TYPE library_db_pool_{name} gauge')
+        for key, pool in sorted(pools.items()):
+            lines.append(f'library_db_pool_{name}{_labels(labels, key)} {value(pool)}')
+    for name, help_text in (
+        ('checkouts', 'Connections handed out'),
+        ('waits', 'Checkouts that waited for a free connection'),
+        ('timeouts', 'Checkouts that gave up waiting'),
+        ('opened', 'Connections opened'),
+        ('closed', 'Connections closed'),
+        ('failed_checks', 'Connections that failed their health check'),
+    ):
+        _counter(
+            lines, f'library_db_pool_{name}_total', help_text, labels,
+            {key: getattr(pool.stats, name) for key, pool in pools.items()},
+        )
+    _histogram(
+        lines, 'library_db_pool_wait_seconds', 'Time checkouts waited for a connection', labels,
+        {key: pool.stats.wait_seconds for key, pool in pools.items()},
+    )
+
+
+class QueryRecorder:
+    """``execute_wrapper`` callable counting queries and their time, grouped by SQL text."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            # Parameters aren't part of the key, so N+1 patterns add up to one statement
+            calls, total = self.statements.get(sql, (0, 0))
+            self.statements[sql] = (calls + 1, total + elapsed)
+
+    def top(self, limit):
+        return sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+
+_recorder = ContextVar('metrics_query_recorder', default=None)
+
+
+def record_queries(execute, sql, params, many, context):
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection, **kwargs):
+    # At the front, execute_wrapper() blocks remove the last wrapper when they exit
+    if record_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_queries)
+
+
+connection_created.connect(install_query_recorder, dispatch_uid='library_system.metrics')
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        # Connections opened before the middleware was loaded
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        recorder, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self.finish(request, response, time.perf_counter() - started, recorder)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+
+        started = time.perf_counter()
+        recorder, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        self.finish(request, response, time.perf_counter() - started, recorder)
+        return response
+
+    def start(self, request):
+        request._metrics_render_seconds = 0
+        recorder = QueryRecorder() if random.random() < settings.METRICS_SAMPLE_RATE else None
+        return recorder, _recorder.set(recorder)
+
+    def finish(self, request, response, duration, recorder):
+        match = getattr(request, 'resolver_match', None)
+        route = (match.view_name or match.route) if match else UNRESOLVED_ROUTE
+        if recorder is None:
+            registry.record(route, request.method, response.status_code, duration)
+        else:
+            registry.record(
+                route, request.method, response.status_code, duration,
+                recorder.count, recorder.seconds, request._metrics_render_seconds,
+            )
+
+        if duration * 1000 >= settings.METRICS_SLOW_REQUEST_MS:
+            self.log_slow_request(request, route, response, duration, recorder)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns, time that separately
+        if settings.METRICS_ENABLED:
+            render = response.render
+
+            def timed_render():
+                started = time.perf_counter()
+                try:
+                    return render()
+                finally:
+                    request._metrics_render_seconds += time.perf_counter() - started
+
+            response.render = timed_render
+        return response
+
+    def log_slow_request(self, request, route, response, duration, recorder):
+        message = f'Slow request {request.method} {request.path} ({route}) {response.status_code} in {duration * 1000:.0f}ms'
+        if recorder is None:
+            logger.warning('%s, not sampled so no query details', message)
+            return
+        statements = '\n'.join(
+            f'  {calls}x {total * 1000:.1f}ms  {sql[:500]}'
+            for sql, (calls, total) in recorder.top(settings.METRICS_SLOW_LOG_STATEMENTS)
+        )
+        logger.warning(
+            '%s, %d queries in %.1fms, top statements:\n%s',
+            message, recorder.count, recorder.seconds * 1000, statements,
+        )
+
+
+def metrics_view(request):
+    # Routes, query counts and pool sizes aren't public, without a token nobody is let in
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get('Authorization', '').encode()
+    if not token or not hmac.compare_digest(authorization, f'Bearer {token}'.encode()):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
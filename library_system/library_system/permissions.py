@@ -1,9 +1,109 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
 from rest_framework.permissions import BasePermission
 
+# Access tokens carry the user's Profile.type in this claim
+ROLE_CLAIM = 'role'
+
+
+def role_changed_key(user_id):
+    return f'role_changed:{user_id}'
+
+
+def get_role_cache():
+    # Every worker has to see the change, a per-process cache would keep honouring the old role
+    return caches[settings.SHARED_CACHE_ALIAS]
+
+
+class RoleChangeCache:
+    """
+    Short-lived, per-process copy of the role change markers in the shared cache.
+
+    Users whose role didn't change are the common case, remembering that for
+    ``ttl`` seconds spares a shared cache read on every request. Other
+    processes see a change within ``ttl``, the process that saves it at once.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def changed_at(self, user_id):
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        changed_at = get_role_cache().get(role_changed_key(user_id))
+        self.remember(user_id, changed_at, now)
+        return changed_at
+
+    def remember(self, user_id, changed_at, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[user_id] = (changed_at, now + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+role_change_cache = RoleChangeCache(settings.ROLE_CHANGE_CACHE_TTL)
+
+
+def mark_role_changed(user_id, changed_at):
+    """Make tokens issued before ``changed_at`` fall back to the database for the role."""
+    timeout = settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'].total_seconds()
+    get_role_cache().set(role_changed_key(user_id), changed_at, timeout)
+    role_change_cache.remember(user_id, changed_at)
+
+
+def get_user_role(request):
+    """
+    Resolve the user's Profile.type once per request.
+
+    Taken from the access token's role claim when it's present and was issued
+    after the last role change, otherwise read from the database. The result
+    is cached on the user object so combined permissions share it.
+    """
+    user = request.user
+    if not user.is_authenticated:
+        return None
+    role = getattr(user, '_role', None)
+    if role is None:
+        role = _role_from_token(request.auth, user.id)
+        if role is None:
+            from users.models import Profile
+            role = Profile.objects.filter(user_id=user.id).values_list('type', flat=True).first()
+        user._role = role
+    return role
+
+
+def _role_from_token(token, user_id):
+    try:
+        role = token.get(ROLE_CLAIM)
+        issued_at = token.get('iat')
+    except AttributeError:
+        # Session or forced authentication, there is no token to read
+        return None
+    if role is None:
+        return None
+    changed_at = role_change_cache.changed_at(user_id)
+    if changed_at is not None and (issued_at is None or issued_at <= changed_at):
+        return None
+    return role
+
+
 class IsLibrarian(BasePermission):
     def has_permission(self, request, view):
-        return request.user.is_authenticated and request.user.profile.type == 'LIBRARIAN'
+        return request.user.is_authenticated and get_user_role(request) == 'LIBRARIAN'
 
 class IsAdmin(BasePermission):
     def has_permission(self, request, view):
-        return request.user.is_authenticated and request.user.profile.type == 'ADMIN'
+        return request.user.is_authenticated and get_user_role(request) == 'ADMIN'
@@ -40,11 +40,31 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_PAGINATION_CLASS': 'library.paginations.LibraryPagination',
 }
 
+LIBRARY_PAGE_SIZE = int(os.getenv("LIBRARY_PAGE_SIZE", 20))
+LIBRARY_MAX_PAGE_SIZE = int(os.getenv("LIBRARY_MAX_PAGE_SIZE", 500))
+# Loan period used by borrows/checkout/ when no return_date is given
+LIBRARY_LOAN_DAYS = int(os.getenv("LIBRARY_LOAN_DAYS", 14))
+# Largest list accepted by the books/bulk/ and borrows/bulk/ endpoints
+LIBRARY_MAX_BULK_ITEMS = int(os.getenv("LIBRARY_MAX_BULK_ITEMS", 10000))
+# Rows fetched from the database and encoded per chunk by the export endpoints and command
+LIBRARY_EXPORT_CHUNK_SIZE = int(os.getenv("LIBRARY_EXPORT_CHUNK_SIZE", 2000))
+# Serve book detail from the denormalised Book.related_data column instead of joining authors and genres
+LIBRARY_BOOK_READ_MODEL = os.getenv("LIBRARY_BOOK_READ_MODEL", "True") == "True"
+
+# Seconds a stateless token user's active status is trusted before re-checking the database
+TOKEN_USER_CACHE_TTL = int(os.getenv("TOKEN_USER_CACHE_TTL", 30))
+# Seconds a worker trusts its copy of a user's last role change before reading the shared cache again
+ROLE_CHANGE_CACHE_TTL = int(os.getenv("ROLE_CHANGE_CACHE_TTL", 5))
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    # Embed Profile.type in access tokens so permission checks skip the Profile query
+    'TOKEN_OBTAIN_SERIALIZER': 'users.serializers.RoleTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'users.serializers.RoleTokenRefreshSerializer',
 }
 
 
@@ -66,11 +86,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so the metrics cover the whole middleware stack
+    'library_system.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'library_system.db.replicas.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -95,22 +118,69 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'library_system.wsgi.application'
+# "asgi" when served by uvicorn (see Procfile), "wsgi" under a WSGI server such as gunicorn
+SERVER_INTERFACE = os.getenv("SERVER_INTERFACE", "asgi")
 
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# "postgresql", or "sqlite3" with DB_NAME as the file path for local runs
+DB_ENGINE = os.getenv("DB_ENGINE", "postgresql")
+# Pooled connections (library_system/db/pool.py), handed back to the pool after each request.
+# Off by default: every worker process keeps its own pool, size DB_POOL_MAX_SIZE times the
+# number of workers against the server's max_connections (or a PgBouncer) before turning it on
+DB_POOL = os.getenv("DB_POOL", "False") == "True"
+
 DATABASES = {
     'default': {
-        "ENGINE": "django.db.backends.postgresql",
+        "ENGINE": f"library_system.db.{DB_ENGINE}" if DB_POOL else f"django.db.backends.{DB_ENGINE}",
         "NAME": os.getenv("DB_NAME"),
         "USER": os.getenv("DB_USER"),
         "PASSWORD": os.getenv("DB_PWD"),
         "HOST": os.getenv("DB_HOST"),
         "PORT": os.getenv("DB_PORT"),
+        # Without the pool, seconds to keep a connection open across requests. Not under ASGI:
+        # sync views run in a new thread per request, a connection left open there is never
+        # reused or closed (see the library_system.E002 check)
+        "CONN_MAX_AGE": 0 if DB_POOL else int(os.getenv("DB_CONN_MAX_AGE", 0 if SERVER_INTERFACE == "asgi" else 60)),
+        "CONN_HEALTH_CHECKS": os.getenv("DB_HEALTH_CHECKS", "True") == "True",
+        "POOL": {
+            "MIN_SIZE": int(os.getenv("DB_POOL_MIN_SIZE", 2)),
+            "MAX_SIZE": int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+            # Seconds a request waits for a free connection before failing
+            "TIMEOUT": float(os.getenv("DB_POOL_TIMEOUT", 5)),
+            "MAX_LIFETIME": int(os.getenv("DB_POOL_MAX_LIFETIME", 30 * 60)),
+            "MAX_IDLE": int(os.getenv("DB_POOL_MAX_IDLE", 5 * 60)),
+            "HEALTH_CHECKS": os.getenv("DB_HEALTH_CHECKS", "True") == "True",
+            # Connections idle for less than this many seconds are handed out unchecked
+            "HEALTH_CHECK_AFTER": float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", 1)),
+        },
     }
 }
 
+# Read replicas, comma separated "host" or "host:port" entries, or file paths with sqlite3.
+# GET and HEAD requests read from them (library_system/db/replicas.py)
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.getenv("DB_REPLICAS", "").split(",")), 1):
+    alias = f'replica{number}'
+    if DB_ENGINE == "sqlite3":
+        location = {"NAME": replica.strip()}
+    else:
+        host, _, port = replica.strip().partition(":")
+        location = {"HOST": host, "PORT": port or DATABASES['default']["PORT"]}
+    # Tests run against the primary's test database
+    DATABASES[alias] = {**DATABASES['default'], **location, "TEST": {"MIRROR": "default"}}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['library_system.db.replicas.ReplicaRouter']
+# Seconds a user's reads stay on the primary after a request of theirs wrote something
+DB_REPLICA_PIN_SECONDS = int(os.getenv("DB_REPLICA_PIN_SECONDS", 10))
+# Seconds between health checks of each replica
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", 5))
+# Replicas further behind the primary than this many seconds are skipped (PostgreSQL only)
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 30))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -156,4 +226,58 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOW_CREDENTIALS = True
 
-DATA_UPLOAD_MAX_NUMBER_FIELDS = 20000
\ No newline at end of file
+DATA_UPLOAD_MAX_NUMBER_FIELDS = 20000
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv("CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv("CACHE_LOCATION", ''),
+    },
+    # Small keys every worker process has to agree on: response cache versions, role changes.
+    # A database table by default (run createcachetable), or point it at Redis or Memcached
+    'shared': {
+        'BACKEND': os.getenv("SHARED_CACHE_BACKEND", 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.getenv("SHARED_CACHE_LOCATION", 'library_shared_cache'),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv("SHARED_CACHE_MAX_ENTRIES", 100000))},
+    },
+}
+SHARED_CACHE_ALIAS = 'shared'
+
+# Cache for book list and detail responses. Their version keys always live in the shared cache,
+# so a write in one process invalidates every process's entries
+LIBRARY_CACHE_ALIAS = os.getenv("LIBRARY_CACHE_ALIAS", 'default')
+LIBRARY_CACHE_TIMEOUT = int(os.getenv("LIBRARY_CACHE_TIMEOUT", 10 * 60))
+
+
+# Metrics, served at /metrics in Prometheus text format
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True") == "True"
+# Fraction of requests that also get query counts, query time and render time
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", 1.0))
+# Requests slower than this are logged with their most expensive statements
+METRICS_SLOW_REQUEST_MS = int(os.getenv("METRICS_SLOW_REQUEST_MS", 1000))
+METRICS_SLOW_LOG_STATEMENTS = int(os.getenv("METRICS_SLOW_LOG_STATEMENTS", 5))
+# /metrics requires "Authorization: Bearer <token>", it answers 403 to everyone while unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", '')
+
+
+# Recommender
+
+RECOMMENDER_MODEL_PATH = os.getenv("RECOMMENDER_MODEL_PATH", str(BASE_DIR / 'library' / 'recommender' / 'book_recommender_model.pkl'))
+# Memory-map the factor matrices so gunicorn workers share one copy
+RECOMMENDER_MMAP = os.getenv("RECOMMENDER_MMAP", "False") == "True"
+# Nearest-neighbour table written by the build_book_neighbours command
+RECOMMENDER_NEIGHBOURS_PATH = os.getenv("RECOMMENDER_NEIGHBOURS_PATH", str(BASE_DIR / 'library' / 'recommender' / 'book_neighbours.npz'))
+# Load the model when the app starts instead of on the first request
+RECOMMENDER_PRELOAD = os.getenv("RECOMMENDER_PRELOAD", "False") == "True"
+# Cache alias and lifetime (seconds) of per-user recommendation results
+RECOMMENDER_CACHE_ALIAS = os.getenv("RECOMMENDER_CACHE_ALIAS", 'default')
+RECOMMENDER_CACHE_TIMEOUT = int(os.getenv("RECOMMENDER_CACHE_TIMEOUT", 60 * 60))
+# Threads scoring for the async recommendation view, and seconds it waits before serving a fallback
+RECOMMENDER_ASYNC_WORKERS = int(os.getenv("RECOMMENDER_ASYNC_WORKERS", 2))
+RECOMMENDER_ASYNC_TIMEOUT = float(os.getenv("RECOMMENDER_ASYNC_TIMEOUT", 2))
+# Directory of versioned model artifacts written by the train_recommender command
+RECOMMENDER_ARTIFACT_DIR = os.getenv("RECOMMENDER_ARTIFACT_DIR", str(BASE_DIR / 'library' / 'recommender' / 'artifacts'))
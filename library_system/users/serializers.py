@@ -3,6 +3,8 @@ from rest_framework import serializers
 from .models import Profile
 from library.serializers import BookListSerializer
 from library.models import Book
+from library_system.permissions import ROLE_CLAIM
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -48,6 +50,25 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
         return instance
 
+class RoleTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token[ROLE_CLAIM] = user.profile.type
+        return token
+
+class RoleTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        # Re-read the role so refreshed access tokens pick up role changes
+        refresh = self.token_class(attrs['refresh'])
+        access = refresh.access_token
+        access[ROLE_CLAIM] = Profile.objects.filter(user_id=refresh['user_id']).values_list('type', flat=True).first()
+        # Issued now, not with the refresh token, or a role changed since would keep the claim distrusted
+        access.set_iat()
+        data['access'] = str(access)
+        return data
+
 class ChangePasswordSerializer(serializers.Serializer):
     old_password = serializers.CharField(required=True)
     new_password = serializers.CharField(required=True)
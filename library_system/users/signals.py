@@ -1,7 +1,11 @@
-from django.db.models.signals import post_save
+import time
+
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from .models import Profile
+from library_system.authentication import user_status_cache
+from library_system.permissions import mark_role_changed
 
 @receiver(post_save, sender=User)
 def create_or_update_profile(sender, instance, created, **kwargs):
@@ -11,4 +15,18 @@ def create_or_update_profile(sender, instance, created, **kwargs):
         try:
             instance.profile.save()
         except Profile.DoesNotExist:
-            Profile.objects.create(user=instance)
\ No newline at end of file
+            Profile.objects.create(user=instance)
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_status(sender, instance, **kwargs):
+    user_status_cache.forget(instance.pk)
+
+@receiver(pre_save, sender=Profile)
+def invalidate_role_claim(sender, instance, **kwargs):
+    if instance.pk is None:
+        return
+    old_type = Profile.objects.filter(pk=instance.pk).values_list('type', flat=True).first()
+    if old_type is not None and old_type != instance.type:
+        # iat claims have one second resolution, round up so same-second tokens are stale too
+        mark_role_changed(instance.user_id, int(time.time()) + 1)
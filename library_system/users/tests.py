@@ -1,3 +1,89 @@
-from django.test import TestCase
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from library.models import Book, Genre
+from library_system.permissions import role_change_cache
+
+
+class RoleClaimTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('librarian', password='password')
+        # Promoted a while ago, before any of the tokens below were issued
+        with mock.patch('time.time', return_value=time.time() - 5):
+            self.user.profile.type = 'LIBRARIAN'
+            self.user.profile.save()
+        role_change_cache.clear()
+
+    def obtain_tokens(self):
+        response = self.client.post('/api/token/', {'username': 'librarian', 'password': 'password'})
+        return response.data
+
+    def test_access_token_carries_role(self):
+        access = AccessToken(self.obtain_tokens()['access'])
+        self.assertEqual(access['role'], 'LIBRARIAN')
+
+    def test_permission_check_uses_claim_without_profile_query(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.obtain_tokens()["access"]}')
+        Genre.objects.create(name='Genre')
+        # The authenticated user, the role change marker in the shared cache, then the genre count and page
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/library/genres/')
+        self.assertEqual(response.status_code, 200)
+        # The worker remembers the marker, only the user, count and page are left
+        with self.assertNumQueries(3):
+            self.client.get('/api/library/genres/')
+
+    def test_role_change_invalidates_claim(self):
+        # Tokens from a login a while ago, the role changed since, and then a refresh now
+        with mock.patch('rest_framework_simplejwt.tokens.aware_utcnow', return_value=timezone.now() - timedelta(seconds=10)):
+            tokens = self.obtain_tokens()
+        with mock.patch('time.time', return_value=time.time() - 5):
+            self.user.profile.type = 'USER'
+            self.user.profile.save()
+        # Like a worker that didn't handle the change, the marker has to come from the shared cache
+        cache.clear()
+        role_change_cache.clear()
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.assertEqual(self.client.get('/api/library/genres/').status_code, 403)
+
+        # Issued after the change, so the refreshed claim is trusted without a Profile query
+        refreshed = self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}).data
+        self.assertEqual(AccessToken(refreshed['access'])['role'], 'USER')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refreshed["access"]}')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/api/library/genres/').status_code, 403)
+        self.assertFalse([query for query in queries if 'users_profile' in query['sql']])
+
+
+class TokenUserAuthenticationTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader', password='password')
+        Book.objects.create(title='Book', description='', isbn='0000000000001')
+        access = self.client.post('/api/token/', {'username': 'reader', 'password': 'password'}).data['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def test_book_list_skips_user_query(self):
+        self.client.get('/api/library/books/')
+        # Response cache versions, book count and page, the user's status is cached from the first
+        # request. Another URL, so the list response itself isn't served from the cache
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/library/books/', {'page': 1})
+        self.assertEqual(response.status_code, 200)
+
+    def test_deactivated_user_is_rejected(self):
+        self.assertEqual(self.client.get('/api/library/books/').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/library/books/').status_code, 401)
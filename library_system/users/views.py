@@ -9,6 +9,7 @@ from library_system.permissions import IsLibrarian, IsAdmin
 from rest_framework.decorators import action
 from .models import Profile 
 from .serializers import LikedBooksSerializer
+from library.recommender import cache as recommendation_cache
 class CreateUserView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -95,5 +96,6 @@ class UpdateLikedBooksView(APIView):
             liked_books = serializer.validated_data.get('liked_books')
             profile.liked_books.set(liked_books)
             profile.save()
+            recommendation_cache.invalidate_user(user.id)
             return Response({"message": "Liked books updated successfully"}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file